@@ -0,0 +1,239 @@
+"""
+Dynamic memory, the runtime behind alloc, free and realloc.
+
+Every block has a header of 8 bytes before the address alloc returns. Small
+blocks, up to LARGEST_BLOCK bytes with the header, come from an arena that
+grows by mapping ARENA_CHUNK bytes at a time. Their sizes are powers of two and
+a freed block goes to the free list of its size, where the next alloc of that
+size finds it. Their header is the size of the block.
+
+Bigger blocks are mappings of their own, unmapped by free and grown with
+mremap by realloc. Their header is the length of the mapping plus one, odd
+headers tell them apart.
+
+With --huge-pages mappings of HUGE_PAGE_SIZE or more ask for huge pages with
+MAP_HUGETLB, and if the system has none reserved get a regular mapping with a
+MADV_HUGEPAGE hint instead.
+
+alloc and realloc return 0 when there's no memory left, realloc keeps the
+block it got then.
+"""
+import global_state
+
+
+SMALLEST_BLOCK = 16
+LARGEST_BLOCK = 4096
+CLASSES = 9  # Sizes of small blocks, from SMALLEST_BLOCK to LARGEST_BLOCK
+PAGE_SIZE = 4096
+HUGE_PAGE_SIZE = 2 * 1024 * 1024
+ARENA_CHUNK = HUGE_PAGE_SIZE  # Only the pages that get used take memory
+
+MAP_PRIVATE_ANONYMOUS = 0x22
+MAP_HUGETLB = 0x40000
+MADV_HUGEPAGE = 14
+
+
+def _map() -> list:
+    """heap_map, with huge pages for big mappings when they're on."""
+    if not global_state.huge_pages:
+        return [
+            'heap_map:  ;; rsi is the length, returns the address in rax, negative if it failed',
+           f'    mov     r10, {MAP_PRIVATE_ANONYMOUS}',
+            '    jmp     heap_mmap',
+        ]
+    return [
+        'heap_map:  ;; rsi is the length, returns the address in rax, negative if it failed',
+       f'    mov     r10, {MAP_PRIVATE_ANONYMOUS}',
+       f'    cmp     rsi, {HUGE_PAGE_SIZE}',
+        '    jb      heap_mmap',
+       f'    mov     r10, {MAP_PRIVATE_ANONYMOUS | MAP_HUGETLB}',
+        '    call    heap_mmap',
+        '    test    rax, rax',
+        '    jns     .map_done',
+       f'    mov     r10, {MAP_PRIVATE_ANONYMOUS}',  # No huge pages reserved
+        '    call    heap_mmap',
+        '    test    rax, rax',
+        '    js      .map_done',
+        '    push    rax',
+        '    mov     rdi, rax',
+       f'    mov     rdx, {MADV_HUGEPAGE}',
+        '    mov     rax, SYS_MADVISE',
+        '    syscall  ;; Only a hint, it may fail',
+        '    pop     rax',
+        '.map_done:',
+        '    ret',
+    ]
+
+
+def _length() -> list:
+    """heap_length, rounded to huge pages for big mappings when they're on."""
+    inst = [
+        'heap_length:  ;; rax is the size of a block, returns the length of its mapping in rsi',
+       f'    lea     rsi, [rax + {PAGE_SIZE - 1}]',
+       f'    and     rsi, {-PAGE_SIZE}',
+    ]
+    if global_state.huge_pages:
+        inst.extend([
+           f'    cmp     rsi, {HUGE_PAGE_SIZE}',
+            '    jb      .length_done',
+           f'    add     rsi, {HUGE_PAGE_SIZE - 1}',
+           f'    and     rsi, {-HUGE_PAGE_SIZE}',
+            '.length_done:',
+        ])
+    return inst + ['    ret']
+
+
+def generate_runtime() -> list:
+    """The free lists, the arena and the routines of the allocator."""
+    return [
+        'segment .bss',
+        f'heap_free_blocks: resb {8 * CLASSES}',
+        'heap_arena_next:  resb 8',
+        'heap_arena_end:   resb 8',
+        'segment .text',
+        '',
+        'heap_alloc:  ;; rdi is the size, returns the address in rax, 0 if there is no memory left',
+        '    lea     rax, [rdi + 8]  ;; Room for the header',
+        f'    cmp     rax, {LARGEST_BLOCK}',
+        '    ja      .alloc_large',
+        '    call    heap_class',
+        '    mov     rax, [heap_free_blocks + rcx*8]',
+        '    test    rax, rax',
+        '    je      .alloc_bump',
+        '    mov     rsi, [rax]  ;; Freed blocks hold the next one of their size',
+        '    mov     [heap_free_blocks + rcx*8], rsi',
+        '    ret',
+        '.alloc_bump:',
+        '    mov     rax, [heap_arena_next]',
+        '    lea     rsi, [rax + rdx]',
+        '    cmp     rsi, [heap_arena_end]',
+        '    ja      .alloc_grow',
+        '    mov     [heap_arena_next], rsi',
+        '    mov     [rax], rdx',
+        '    add     rax, 8',
+        '    ret',
+        '.alloc_grow:  ;; What was left of the arena is lost',
+        '    push    rdx',
+        f'    mov     rsi, {ARENA_CHUNK}',
+        '    call    heap_map',
+        '    pop     rdx',
+        '    test    rax, rax',
+        '    js      .alloc_failed',
+        '    mov     [heap_arena_next], rax',
+        f'    add     rax, {ARENA_CHUNK}',
+        '    mov     [heap_arena_end], rax',
+        '    jmp     .alloc_bump',
+        '.alloc_large:',
+        '    call    heap_length',
+        '    call    heap_map',
+        '    test    rax, rax',
+        '    js      .alloc_failed',
+        '    lea     rdx, [rsi + 1]',
+        '    mov     [rax], rdx',
+        '    add     rax, 8',
+        '    ret',
+        '.alloc_failed:',
+        '    mov     rax, 0',
+        '    ret',
+        '',
+        'heap_free:  ;; rdi is the address, 0 is ignored',
+        '    test    rdi, rdi',
+        '    je      .free_done',
+        '    mov     rax, [rdi - 8]',
+        '    test    rax, 1',
+        '    jne     .free_large',
+        '    call    heap_class',
+        '    mov     rax, [heap_free_blocks + rcx*8]',
+        '    mov     [rdi], rax',
+        '    mov     [heap_free_blocks + rcx*8], rdi',
+        '.free_done:',
+        '    ret',
+        '.free_large:',
+        '    lea     rsi, [rax - 1]',
+        '    sub     rdi, 8',
+        '    mov     rax, SYS_MUNMAP',
+        '    syscall',
+        '    ret',
+        '',
+        'heap_realloc:  ;; rdi is the address and rsi the new size, returns the new address in rax',
+        '    test    rdi, rdi',
+        '    jne     .realloc_block',
+        '    mov     rdi, rsi',
+        '    jmp     heap_alloc',
+        '.realloc_block:',
+        '    mov     rax, [rdi - 8]',
+        '    mov     rdx, rax',
+        '    and     rdx, -2',
+        '    sub     rdx, 8  ;; What fits in the block',
+        '    cmp     rsi, rdx',
+        '    ja      .realloc_grow',
+        '    mov     rax, rdi  ;; Blocks never shrink',
+        '    ret',
+        '.realloc_grow:',
+        '    test    rax, 1',
+        '    je      .realloc_move',
+        '    push    rdi',
+        '    push    rsi',
+        '    lea     rax, [rsi + 8]',
+        '    call    heap_length',
+        '    mov     rdx, rsi',
+        '    mov     rsi, [rdi - 8]',
+        '    sub     rsi, 1',
+        '    sub     rdi, 8',
+        '    mov     r10, 1  ;; MREMAP_MAYMOVE',
+        '    mov     rax, SYS_MREMAP',
+        '    syscall',
+        '    pop     rsi',
+        '    pop     rdi',
+        '    test    rax, rax',
+        '    js      .realloc_move  ;; Huge pages can only be remapped on recent kernels',
+        '    add     rdx, 1',
+        '    mov     [rax], rdx',
+        '    add     rax, 8',
+        '    ret',
+        '.realloc_move:',
+        '    push    rdi',
+        '    mov     rdi, rsi',
+        '    call    heap_alloc',
+        '    pop     rsi',
+        '    test    rax, rax',
+        '    je      .realloc_failed',
+        '    push    rax',
+        '    push    rsi',
+        '    mov     rdi, rax',
+        '    mov     rcx, [rsi - 8]',
+        '    and     rcx, -2',
+        '    sub     rcx, 8',
+        '    rep     movsb',
+        '    pop     rdi',
+        '    call    heap_free',
+        '    pop     rax',
+        '.realloc_failed:',
+        '    ret',
+        '',
+        'heap_class:  ;; rax is the size of a small block, returns its class in rcx and its real size in rdx',
+        '    mov     rcx, 0',
+        f'    mov     rdx, {SMALLEST_BLOCK}',
+        '.class_next:',
+        '    cmp     rax, rdx',
+        '    jbe     .class_done',
+        '    add     rdx, rdx',
+        '    add     rcx, 1',
+        '    jmp     .class_next',
+        '.class_done:',
+        '    ret',
+        '',
+        *_length(),
+        '',
+        *_map(),
+        '',
+        'heap_mmap:  ;; rsi is the length and r10 the flags',
+        '    mov     rdi, 0',
+        '    mov     rdx, 3  ;; PROT_READ | PROT_WRITE',
+        '    mov     r8, -1',
+        '    mov     r9, 0',
+        '    mov     rax, SYS_MMAP',
+        '    syscall',
+        '    ret',
+        '',
+    ]
@@ -0,0 +1,517 @@
+"""
+Assembler for the x86-64 code the generators emit.
+
+It turns the generated assembly straight into a static ELF64 executable, so
+building a program needs neither nasm nor ld. Only what the generators use is
+supported:
+
+- %define, global, segment .text and segment .bss
+- labels, nasm style .local labels included, resb in .bss and db in .text
+- push, pop, mov, movzx, lea, add, sub, and, or, xor, cmp, test, imul, mul,
+  idiv, div, not, neg, shl, shr, sar, cmovcc, setcc, jmp, jcc, call, ret,
+  leave, syscall and rdtsc on 64 bit registers, plus the 8 and 32 bit
+  registers and memory operands the generators use, and bsf
+- movsb, cmpsb, stosb and scasb, maybe with a rep prefix
+- movdqa, movdqu, movq, pcmpeqb, pmovmskb, pxor and punpcklqdq on xmm registers
+
+Jumps and calls always take a 32 bit displacement and so do immediates and
+memory operands that depend on a label. That way the size of every instruction
+is known before the addresses of the labels are, one pass finds the addresses
+and a second one encodes the instructions.
+
+Anything else, like arithmetic on bytes or an immediate that a 64 bit
+instruction would sign extend to another value, is rejected rather than
+encoded as something close to it.
+"""
+import os
+import re
+import struct
+import peephole
+
+
+BASE_ADDRESS = 0x400000
+PAGE_SIZE = 0x1000
+
+_REGISTERS_64 = ['rax', 'rcx', 'rdx', 'rbx', 'rsp', 'rbp', 'rsi', 'rdi'] + [f'r{i}' for i in range(8, 16)]
+_REGISTERS_32 = ['eax', 'ecx', 'edx', 'ebx', 'esp', 'ebp', 'esi', 'edi'] + [f'r{i}d' for i in range(8, 16)]
+_REGISTERS_8 = ['al', 'cl', 'dl', 'bl', 'spl', 'bpl', 'sil', 'dil'] + [f'r{i}b' for i in range(8, 16)]
+_REGISTERS = {
+    **{f'xmm{number}': (number, 16) for number in range(16)},
+    **{name: (number, 8) for number, name in enumerate(_REGISTERS_64)},
+    **{name: (number, 4) for number, name in enumerate(_REGISTERS_32)},
+    **{name: (number, 1) for number, name in enumerate(_REGISTERS_8)},
+}
+
+_CONDITIONS = {
+    'o': 0, 'no': 1, 'b': 2, 'c': 2, 'nae': 2, 'ae': 3, 'nb': 3, 'nc': 3,
+    'e': 4, 'z': 4, 'ne': 5, 'nz': 5, 'be': 6, 'na': 6, 'a': 7, 'nbe': 7,
+    's': 8, 'ns': 9, 'p': 10, 'pe': 10, 'np': 11, 'po': 11,
+    'l': 12, 'nge': 12, 'ge': 13, 'nl': 13, 'le': 14, 'ng': 14, 'g': 15, 'nle': 15,
+}
+
+# Opcode extension of the instructions that take an immediate or a single operand
+_ARITHMETIC = {'add': 0, 'or': 1, 'and': 4, 'sub': 5, 'xor': 6, 'cmp': 7}
+_UNARY = {'not': 2, 'neg': 3, 'mul': 4, 'div': 6, 'idiv': 7}
+_SHIFTS = {'shl': 4, 'shr': 5, 'sar': 7}
+_STRING_INSTRUCTIONS = {'movsb': 0xa4, 'cmpsb': 0xa6, 'stosb': 0xaa, 'scasb': 0xae}
+_REPEAT_PREFIXES = {'rep': 0xf3, 'repe': 0xf3, 'repz': 0xf3, 'repne': 0xf2, 'repnz': 0xf2}
+# Mandatory prefix and opcode of the SSE2 instructions taking an xmm register and an xmm register or memory
+_SSE = {
+    'movdqa':     (b'\x66', b'\x0f\x6f'),  # noqa e241
+    'movdqu':     (b'\xf3', b'\x0f\x6f'),  # noqa e241
+    'pcmpeqb':    (b'\x66', b'\x0f\x74'),  # noqa e241
+    'pxor':       (b'\x66', b'\x0f\xef'),  # noqa e241
+    'punpcklqdq': (b'\x66', b'\x0f\x6c'),
+}
+_SIZES = {'BYTE': 1, 'WORD': 2, 'DWORD': 4, 'QWORD': 8}
+_SCALES = {1: 0, 2: 1, 4: 2, 8: 3}
+
+_DEFINE = re.compile(r'%define\s+(\S+)\s+(.*)')
+_RESERVE = re.compile(r'([A-Za-z_.$][\w.$]*):\s*resb\s+(.+)')
+_TERM = re.compile(r'[+\-*]|[^+\-*\s]+')
+
+
+class Register:
+    __slots__ = ('number', 'size')
+
+    def __init__(self, number: int, size: int):
+        self.number = number
+        self.size = size
+
+
+class Memory:
+    __slots__ = ('base', 'index', 'scale', 'displacement', 'size', 'relocatable')
+
+    def __init__(self, base: int = None, index: int = None, scale: int = 1, displacement: int = 0, size: int = None):
+        self.base = base
+        self.index = index
+        self.scale = scale
+        self.displacement = displacement
+        self.size = size
+        self.relocatable = False  # The displacement depends on the address of a label
+
+
+class Immediate:
+    __slots__ = ('value', 'relocatable')
+
+    def __init__(self, value: int, relocatable: bool):
+        self.value = value
+        self.relocatable = relocatable  # Depends on the address of a label
+
+    def fits_byte(self) -> bool:
+        return not self.relocatable and -128 <= self.value < 128
+
+
+class _Assembler:
+    """The state of assembling one program."""
+
+    def __init__(self):
+        self.defines = {}
+        self.symbols = {}  # Label -> address, None while the addresses aren't known yet
+        self.scope = ''    # Label .local labels belong to
+
+    def qualify(self, label: str) -> str:
+        return self.scope + label if label.startswith('.') else label
+
+    def evaluate(self, expression: str) -> Immediate:
+        """Value of a sum of numbers, defines and labels."""
+        value = 0
+        relocatable = False
+        sign = 1
+        for term in _TERM.findall(expression):
+            if term in '+-':
+                sign = -1 if term == '-' else 1
+                continue
+            if term in self.defines:
+                immediate = self.evaluate(self.defines[term])
+                relocatable = relocatable or immediate.relocatable
+                term_value = immediate.value
+            elif re.fullmatch(r'-?(0x[0-9a-fA-F]+|[0-9]+)', term):
+                term_value = int(term, 0)
+            else:
+                label = self.qualify(term)
+                if label not in self.symbols:
+                    raise RuntimeError(f'Unknown symbol {term} in {expression}')
+                relocatable = True
+                term_value = self.symbols[label] or 0
+            value += sign * term_value
+            sign = 1
+        return Immediate(value, relocatable)
+
+    def operand(self, text: str):
+        text = self.defines.get(text, text)
+        if text in _REGISTERS:
+            return Register(*_REGISTERS[text])
+        if text in _STRING_INSTRUCTIONS:
+            return text  # After a rep prefix
+
+        size = None
+        prefix, _, rest = text.partition(' ')
+        if prefix.upper() in _SIZES and rest.strip().startswith('['):
+            size = _SIZES[prefix.upper()]
+            text = rest.strip()
+        if not text.startswith('['):
+            return self.evaluate(text)
+
+        memory = Memory(size=size)
+        terms = _TERM.findall(text[1:-1])
+        sign = 1
+        i = 0
+        while i < len(terms):
+            term = terms[i]
+            if term in '+-':
+                sign = -1 if term == '-' else 1
+                i += 1
+                continue
+            if i + 2 < len(terms) and terms[i + 1] == '*':
+                register, scale = (term, terms[i + 2]) if term in _REGISTERS else (terms[i + 2], term)
+                memory.index, memory.scale = _REGISTERS[register][0], int(scale, 0)
+                i += 3
+            elif term in _REGISTERS:
+                if memory.base is None:
+                    memory.base = _REGISTERS[term][0]
+                else:
+                    memory.index = _REGISTERS[term][0]
+                i += 1
+            else:
+                immediate = self.evaluate(term)
+                memory.displacement += sign * immediate.value
+                memory.relocatable = memory.relocatable or immediate.relocatable
+                i += 1
+            sign = 1
+        return memory
+
+
+def _rex(w: int, r: int, x: int, b: int, force: bool = False) -> bytes:
+    if w or r or x or b or force:
+        return bytes([0x40 | w << 3 | r << 2 | x << 1 | b])
+    return b''
+
+
+def _needs_rex(register: Register) -> bool:
+    """spl, bpl, sil and dil are ah, ch, dh and bh without a REX prefix."""
+    return register.size == 1 and 4 <= register.number < 8
+
+
+def _encode(opcode: bytes, reg: int, rm, w: int = 1, force: bool = False) -> bytes:
+    """
+    An instruction with a ModRM byte, reg being a register number or an opcode
+    extension. force adds a REX prefix even if it's empty, for when reg is an
+    8 bit register that needs it.
+    """
+    if isinstance(rm, Register):
+        return _rex(w, reg >> 3, 0, rm.number >> 3, force or _needs_rex(rm)) + opcode \
+            + bytes([0xC0 | (reg & 7) << 3 | rm.number & 7])
+
+    base, index, displacement = rm.base, rm.index, rm.displacement
+    if index == 4:
+        raise RuntimeError('rsp can not be an index')
+    rex = _rex(w, reg >> 3, (index or 0) >> 3, (base or 0) >> 3, force)
+    if base is None:
+        modrm = (reg & 7) << 3 | 4
+        sib = _SCALES[rm.scale] << 6 | (4 if index is None else index & 7) << 3 | 5
+        return rex + opcode + bytes([modrm, sib]) + struct.pack('<i', displacement)
+
+    if rm.relocatable:
+        mod, displacement_bytes = 2, struct.pack('<i', displacement)
+    elif displacement == 0 and base & 7 != 5:
+        mod, displacement_bytes = 0, b''
+    elif -128 <= displacement < 128:
+        mod, displacement_bytes = 1, struct.pack('<b', displacement)
+    else:
+        mod, displacement_bytes = 2, struct.pack('<i', displacement)
+
+    if index is None and base & 7 != 4:
+        return rex + opcode + bytes([mod << 6 | (reg & 7) << 3 | base & 7]) + displacement_bytes
+    sib = _SCALES[rm.scale] << 6 | (4 if index is None else index & 7) << 3 | base & 7
+    return rex + opcode + bytes([mod << 6 | (reg & 7) << 3 | 4, sib]) + displacement_bytes
+
+
+def _immediate(immediate: Immediate, size: int) -> bytes:
+    value = immediate.value
+    if size == 1:
+        return struct.pack('<B', value & 0xff)
+    if not -2 ** 31 <= value < 2 ** 32:
+        raise RuntimeError(f'{value} does not fit in 32 bits')
+    return struct.pack('<I', value & 0xffffffff)
+
+
+def _wide(operand) -> int:
+    return int(operand.size == 8)
+
+
+def _operation_size(operands: list):
+    """
+    Size of an instruction on 32 or 64 bits, None if its registers and memory
+    operands are of other sizes, don't agree or don't give one.
+    """
+    sizes = {operand.size for operand in operands if isinstance(operand, (Register, Memory)) and operand.size}
+    if len(sizes) == 1 and sizes <= {4, 8}:
+        return sizes.pop()
+    return None
+
+
+def _sign_extends(immediate: Immediate) -> bool:
+    """Whether an immediate keeps its value sign extended from 32 to 64 bits."""
+    return immediate.relocatable or -2 ** 31 <= immediate.value < 2 ** 31
+
+
+def _encode_instruction(mnemonic: str, operands: list, address: int) -> bytes:
+    """Machine code of an instruction, address is the one right after the previous instruction."""
+    kinds = tuple(type(operand) for operand in operands)
+
+    if mnemonic == 'push' and kinds == (Register,):
+        register = operands[0].number
+        return _rex(0, 0, 0, register >> 3) + bytes([0x50 | register & 7])
+    if mnemonic == 'push' and kinds == (Immediate,) and _sign_extends(operands[0]):
+        if operands[0].fits_byte():
+            return b'\x6a' + _immediate(operands[0], 1)
+        return b'\x68' + _immediate(operands[0], 4)
+    if mnemonic == 'pop' and kinds == (Register,):
+        register = operands[0].number
+        return _rex(0, 0, 0, register >> 3) + bytes([0x58 | register & 7])
+
+    if mnemonic == 'mov':
+        destination, source = operands
+        if kinds == (Register, Immediate):
+            if destination.size == 8 and (source.relocatable or -2 ** 31 <= source.value < 2 ** 31):
+                return _encode(b'\xc7', 0, destination) + _immediate(source, 4)
+            if destination.size == 8:
+                return _rex(1, 0, 0, destination.number >> 3) + bytes([0xb8 | destination.number & 7]) \
+                    + struct.pack('<Q', source.value & 0xffffffffffffffff)
+            if destination.size == 4:
+                return _rex(0, 0, 0, destination.number >> 3) + bytes([0xb8 | destination.number & 7]) \
+                    + _immediate(source, 4)
+            return _encode(b'\xc6', 0, destination, w=0) + _immediate(source, 1)
+        if kinds == (Memory, Immediate):
+            if destination.size is None:
+                raise RuntimeError('The size of the memory has to be given to mov an immediate into it')
+            if destination.size == 1:
+                return _encode(b'\xc6', 0, destination, w=0) + _immediate(source, 1)
+            if destination.size == 8 and _sign_extends(source):
+                return _encode(b'\xc7', 0, destination) + _immediate(source, 4)
+        if isinstance(source, Register):
+            opcode = b'\x88' if source.size == 1 else b'\x89'
+            return _encode(opcode, source.number, destination, w=_wide(source), force=_needs_rex(source))
+        if kinds == (Register, Memory):
+            opcode = b'\x8a' if destination.size == 1 else b'\x8b'
+            return _encode(opcode, destination.number, source, w=_wide(destination), force=_needs_rex(destination))
+
+    if mnemonic == 'movzx' and isinstance(operands[0], Register) and operands[0].size in {4, 8} \
+            and operands[1].size == 1:
+        return _encode(b'\x0f\xb6', operands[0].number, operands[1], w=_wide(operands[0]))
+    if mnemonic == 'lea' and kinds == (Register, Memory):
+        return _encode(b'\x8d', operands[0].number, operands[1])
+
+    size = _operation_size(operands)
+    # Immediates of 64 bit instructions are sign extended
+    immediate = next((operand for operand in operands if isinstance(operand, Immediate)), None)
+    if immediate is not None and size == 8 and not _sign_extends(immediate):
+        size = None
+
+    if mnemonic in _ARITHMETIC and size:
+        destination, source = operands
+        extension = _ARITHMETIC[mnemonic]
+        w = int(size == 8)
+        if kinds[1] is Immediate:
+            if source.fits_byte():
+                return _encode(b'\x83', extension, destination, w=w) + _immediate(source, 1)
+            return _encode(b'\x81', extension, destination, w=w) + _immediate(source, 4)
+        if kinds[1] is Register:
+            return _encode(bytes([extension << 3 | 1]), source.number, destination, w=_wide(source))
+        if kinds == (Register, Memory):
+            return _encode(bytes([extension << 3 | 3]), destination.number, source, w=w)
+    if mnemonic == 'test' and size:
+        destination, source = operands
+        if kinds[1] is Immediate:
+            return _encode(b'\xf7', 0, destination, w=int(size == 8)) + _immediate(source, 4)
+        return _encode(b'\x85', source.number, destination, w=int(size == 8))
+    if mnemonic == 'imul' and len(operands) == 2 and size == 8:
+        destination, source = operands
+        if kinds[1] is Immediate:
+            if source.fits_byte():
+                return _encode(b'\x6b', destination.number, destination) + _immediate(source, 1)
+            return _encode(b'\x69', destination.number, destination) + _immediate(source, 4)
+        return _encode(b'\x0f\xaf', destination.number, source)
+    if (mnemonic in _UNARY or mnemonic == 'imul') and len(operands) == 1 and size:
+        return _encode(b'\xf7', _UNARY.get(mnemonic, 5), operands[0], w=_wide(operands[0]))
+    if mnemonic in _SHIFTS and kinds[1] is Register:  # By cl
+        return _encode(b'\xd3', _SHIFTS[mnemonic], operands[0], w=_wide(operands[0]))
+    if mnemonic in _SHIFTS:
+        return _encode(b'\xc1', _SHIFTS[mnemonic], operands[0], w=_wide(operands[0])) + _immediate(operands[1], 1)
+
+    if mnemonic == 'bsf' and kinds[0] is Register:
+        return _encode(b'\x0f\xbc', operands[0].number, operands[1], w=_wide(operands[0]))
+
+    # The mandatory prefix goes before the REX prefix
+    if mnemonic in _SSE:
+        prefix, opcode = _SSE[mnemonic]
+        return prefix + _encode(opcode, operands[0].number, operands[1], w=0)
+    if mnemonic == 'pmovmskb':
+        return b'\x66' + _encode(b'\x0f\xd7', operands[0].number, operands[1], w=0)
+    if mnemonic == 'movq' and kinds == (Register, Register) and operands[0].size == 16:
+        return b'\x66' + _encode(b'\x0f\x6e', operands[0].number, operands[1])
+
+    if mnemonic.startswith('cmov') and mnemonic[4:] in _CONDITIONS:
+        return _encode(bytes([0x0f, 0x40 | _CONDITIONS[mnemonic[4:]]]), operands[0].number, operands[1])
+    if mnemonic.startswith('set') and mnemonic[3:] in _CONDITIONS:
+        return _encode(bytes([0x0f, 0x90 | _CONDITIONS[mnemonic[3:]]]), 0, operands[0], w=0)
+
+    if mnemonic in {'jmp', 'call'} and kinds == (Immediate,):
+        return _relative(b'\xe9' if mnemonic == 'jmp' else b'\xe8', operands[0], address)
+    if mnemonic.startswith('j') and mnemonic[1:] in _CONDITIONS and kinds == (Immediate,):
+        return _relative(bytes([0x0f, 0x80 | _CONDITIONS[mnemonic[1:]]]), operands[0], address)
+
+    if mnemonic == 'ret' and not operands:
+        return b'\xc3'
+    if mnemonic == 'leave' and not operands:
+        return b'\xc9'
+    if mnemonic == 'syscall' and not operands:
+        return b'\x0f\x05'
+    if mnemonic == 'rdtsc' and not operands:
+        return b'\x0f\x31'
+    if mnemonic in _STRING_INSTRUCTIONS and not operands:
+        return bytes([_STRING_INSTRUCTIONS[mnemonic]])
+    if mnemonic in _REPEAT_PREFIXES and len(operands) == 1 and operands[0] in _STRING_INSTRUCTIONS:
+        return bytes([_REPEAT_PREFIXES[mnemonic], _STRING_INSTRUCTIONS[operands[0]]])
+
+    raise RuntimeError(f'Unsupported instruction {mnemonic} {", ".join(type(operand).__name__ for operand in operands)}')
+
+
+def _relative(opcode: bytes, target: Immediate, address: int) -> bytes:
+    end = address + len(opcode) + 4
+    return opcode + struct.pack('<i', (target.value - end) if target.value else 0)
+
+
+def _data(operands: list) -> bytes:
+    data = b''
+    for operand in operands:
+        if operand[:1] in {'"', "'"} and operand[-1:] == operand[:1]:
+            data += operand[1:-1].encode()
+        else:
+            data += struct.pack('<B', int(operand, 0) & 0xff)
+    return data
+
+
+def _elf(text: bytes, bss_size: int, entry: int) -> bytes:
+    """A static ELF64 executable with text right after the headers and bss in the pages after it."""
+    header_size = 64
+    program_header_size = 56
+    segments = 3 if bss_size else 2
+    text_address = BASE_ADDRESS + header_size + program_header_size * segments
+    assert text_address == _text_address(bss_size)
+    size = header_size + program_header_size * segments + len(text)
+
+    elf_header = struct.pack(
+        '<16sHHIQQQIHHHHHH',
+        b'\x7fELF\x02\x01\x01' + bytes(9),  # 64 bit, little endian, version 1, System V
+        2,       # Executable
+        0x3e,    # x86-64
+        1,
+        entry,
+        header_size,  # The program headers come right after this one
+        0,       # No section headers
+        0,
+        header_size,
+        program_header_size,
+        segments,
+        64,
+        0,
+        0,
+    )
+
+    def program_header(kind, flags, offset, address, file_size, memory_size, alignment):
+        return struct.pack('<IIQQQQQQ', kind, flags, offset, address, address, file_size, memory_size, alignment)
+
+    program_headers = program_header(1, 0b101, 0, BASE_ADDRESS, size, size, PAGE_SIZE)  # Text, read and execute
+    if bss_size:
+        program_headers += program_header(1, 0b110, 0, _bss_address(len(text), bss_size), 0, bss_size, PAGE_SIZE)
+    program_headers += program_header(0x6474e551, 0b110, 0, 0, 0, 0, 16)  # Non executable stack
+
+    return elf_header + program_headers + text
+
+
+def _text_address(bss_size: int) -> int:
+    return BASE_ADDRESS + 64 + 56 * (3 if bss_size else 2)
+
+
+def _bss_address(text_size: int, bss_size: int) -> int:
+    end = _text_address(bss_size) + text_size
+    return (end + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+
+
+def assemble(assembly: str) -> bytes:
+    """Assemble the generated assembly into the contents of a static executable."""
+    assembler = _Assembler()
+    items = []  # ('label', name), ('instruction', mnemonic, operands) or ('data', bytes)
+    bss = []    # (label, size)
+    segment = '.text'
+
+    for instruction in peephole.parse(assembly):
+        text = (instruction.text or '').strip()
+        if instruction.label is not None:
+            if not instruction.label.startswith('.'):
+                assembler.scope = instruction.label
+            label = assembler.qualify(instruction.label)
+            if segment != '.text':
+                raise RuntimeError(f'Only labels with resb are supported in {segment}')
+            items.append(('label', label))
+            assembler.symbols[label] = None
+        elif instruction.mnemonic is not None:
+            if segment != '.text':
+                raise RuntimeError(f'Only resb is supported in {segment}')
+            if instruction.mnemonic == 'db':
+                items.append(('data', _data(instruction.operands)))
+            else:
+                items.append(('instruction', instruction.mnemonic, instruction.operands, assembler.scope))
+        elif not text or text.startswith(';'):
+            continue
+        elif _DEFINE.fullmatch(text):
+            name, value = _DEFINE.fullmatch(text).groups()
+            assembler.defines[name] = value.strip()
+        elif text.startswith(('segment ', 'section ')):
+            segment = text.split()[1]
+        elif text.startswith('global '):
+            continue  # Everything is in the same file
+        elif text.startswith('extern '):
+            raise RuntimeError(f'{text} needs a linker, build it with --nasm')
+        elif _RESERVE.fullmatch(text) and segment == '.bss':
+            label, size = _RESERVE.fullmatch(text).groups()
+            bss.append((label, assembler.evaluate(size).value))
+            assembler.symbols[label] = None
+        else:
+            raise RuntimeError(f'Unsupported assembly: {text}')
+
+    bss_size = sum(size for _, size in bss)
+
+    def encode_all() -> bytes:
+        code = bytearray()  # Adding to bytes copies them every time
+        start = _text_address(bss_size)
+        for item in items:
+            if item[0] == 'label':
+                assembler.symbols[item[1]] = start + len(code)
+            elif item[0] == 'data':
+                code += item[1]
+            else:
+                _, mnemonic, operands, assembler.scope = item
+                code += _encode_instruction(mnemonic, [assembler.operand(operand) for operand in operands],
+                                            start + len(code))
+        return bytes(code)
+
+    # The sizes don't depend on the addresses, the first pass finds them and the second one uses them
+    text = encode_all()
+    address = _bss_address(len(text), bss_size)
+    for label, size in bss:
+        assembler.symbols[label] = address
+        address += size
+    text = encode_all()
+
+    if '_start' not in assembler.symbols:
+        raise RuntimeError('The program has no main procedure')
+    return _elf(text, bss_size, assembler.symbols['_start'])
+
+
+def write_executable(path: str, executable: bytes):
+    with open(path, 'wb') as f:
+        f.write(executable)
+    os.chmod(path, 0o755)
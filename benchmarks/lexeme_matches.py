@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Microbenchmark for lexeme classification."""
+import argparse
+import os
+import re
+import sys
+import timeit
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, ROOT.as_posix())
+os.chdir(ROOT)  # Imports are resolved relative to the working directory
+
+from definitions import Operator, lexeme_matches  # noqa e402
+from parsing_utils import pyre_split  # noqa e402
+import pyre  # noqa e402
+import global_state  # noqa e402
+
+
+def linear_lexeme_matches(item) -> Operator:
+    """The linear scan over every operator lexeme_matches used to do."""
+    def filter_operators(operators, value_types):
+        def does_value_match(operator):
+            return any(isinstance(operator.value, value_type) for value_type in value_types)
+        return filter(does_value_match, operators)
+
+    for operator in filter_operators(Operator, [str]):
+        if item == operator.value:
+            return operator
+
+    for operator in filter_operators(Operator, [set, list, dict]):
+        if item in operator.value:
+            return operator
+
+    for operator in filter_operators(Operator, [re.Pattern]):
+        if operator.value.fullmatch(item) is not None:
+            return operator
+
+    raise ValueError(f'Lexeme {item} does not match any known operator')
+
+
+def load_lexemes(sources) -> list:
+    """Tokenize the sources (to register procedures and macros) and return their lexemes."""
+    lexemes = []
+    for source in sources:
+        with open(source, 'r') as f:
+            program = f.read()
+        if source not in global_state.imports:
+            pyre.tokenize(program)
+        lexemes.extend(pyre_split(program, source))
+    return lexemes
+
+
+def bench(function, lexemes, repeat) -> float:
+    """Return the best lexemes per second over a few runs."""
+    def run():
+        for lexeme in lexemes:
+            function(lexeme)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return len(lexemes) / best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark lexeme classification.')
+    parser.add_argument('sources', nargs='*', default=['rule110.pyre', 'std.pyre', 'fcntl.pyre'],
+                        help='sources whose lexemes are classified')
+    parser.add_argument('-n', type=int, default=20_000, help='number of lexemes to classify')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='number of timed runs')
+    args = parser.parse_args()
+
+    lexemes = load_lexemes(args.sources)
+    lexemes = (lexemes * (args.n // len(lexemes) + 1))[:args.n]
+
+    for lexeme in set(lexemes):
+        assert lexeme_matches(lexeme) is linear_lexeme_matches(lexeme), lexeme
+
+    before = bench(linear_lexeme_matches, lexemes, args.repeat)
+    after = bench(lexeme_matches, lexemes, args.repeat)
+    print(f'linear scan:  {before:12,.0f} lexemes/s')
+    print(f'table driven: {after:12,.0f} lexemes/s')
+    print(f'speedup:      {after / before:12.1f}x')
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Benchmark of the memory and string operators against byte at a time loops.
+
+The loops are compiled into the same program next to the operators and the
+helpers of std, so both go through the same compiler. The memory is filled
+with a string of 1 MiB. Every round copies 1 MiB, half of the memory one way
+and then back, sets all of it, finds the length of the string and compares
+its halves.
+"""
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+HALF = 512 * 1024  # Half of the memory, a round copies it both ways
+
+OLD_PROCEDURES = '''
+procedure old_set_mem c a b -- in
+    while a b < do
+        c !memory:uint8[a]
+        a++
+    end
+end
+
+procedure old_copy_mem dest start stop -- in
+    2dup + swap drop  # Replace len with source + len
+    while start stop < do
+        memory:uint8[start] !memory:uint8[dest]
+        start++
+        dest++
+    end
+end
+
+procedure old_strlen address -- length in
+    0 !length
+    while address load1 0 != do
+        address++
+        length++
+    end
+end
+
+procedure old_memcmp a b length -- order in
+    0 !order
+    while length 0 > do
+        if a load1 b load1 != do
+            if a load1 b load1 > do 1 !order else 0 1 - !order end
+            0 !length
+        else
+            a++
+            b++
+            length--
+        end
+    end
+end
+'''
+
+PROGRAMS = {
+    'copy_mem': f'0 {HALF} {HALF} {{prefix}}copy_mem {HALF} 0 {HALF} {{prefix}}copy_mem',
+    'set_mem':  f'97 0 {2 * HALF - 1} {{prefix}}set_mem',  # noqa e241
+    'strlen':   'memory {prefix}strlen drop',  # noqa e241
+    'memcmp':   f'memory memory {HALF} + {HALF} {{prefix}}memcmp drop',  # noqa e241
+}
+
+
+def program(body: str, rounds: int) -> str:
+    return '\n'.join([
+        'import "std"',
+        OLD_PROCEDURES,
+        'procedure main -- in',
+        f'    97 0 {2 * HALF - 1} set_mem  # All a but the last byte',
+        f'    0 where i in while i {rounds} < do {body} i 1 + !i end end drop',
+        'end',
+        '',
+    ])
+
+
+def time_program(code: str, directory: str, flags: list) -> float:
+    """Seconds it takes to run code once compiled."""
+    source = Path(directory, 'memory.pyre')
+    source.write_text(code)
+    subprocess.run([sys.executable, 'pyre.py', source.as_posix(), *flags], cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL)
+    start = time.perf_counter()
+    subprocess.run([source.with_suffix('').as_posix()], check=True)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark copy_mem and set_mem, other flags go to pyre.py.')
+    parser.add_argument('-r', '--rounds', type=int, default=100, help='MiB copied and set by every program')
+    args, flags = parser.parse_known_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, body in PROGRAMS.items():
+            old = time_program(program(body.format(prefix='old_'), args.rounds), directory, flags)
+            new = time_program(program(body.format(prefix=''), args.rounds), directory, flags)
+            print(f'{name}: {args.rounds / old:8.1f} -> {args.rounds / new:8.1f} MiB/s ({old / new:.0f}x)')
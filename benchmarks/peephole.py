@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Benchmark comparing programs compiled with and without the peephole optimizer."""
+import argparse
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, ROOT.as_posix())
+
+import peephole  # noqa e402
+
+DEFAULT_SOURCES = ['rule110.pyre', 'examples/fibonacci.pyre', 'examples/fizzbuzz.pyre']
+
+
+def compile_source(source: Path, destination: Path, *flags) -> int:
+    """Compile source into destination and count the instructions of its assembly."""
+    subprocess.run([sys.executable, 'pyre.py', source.as_posix(), '--nasm', *flags],
+                   cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    shutil.copy(source.with_suffix(''), destination)
+    return peephole.count_instructions(peephole.parse(source.with_suffix('.asm').read_text()))
+
+
+def time_runs(executable: Path, runs: int) -> float:
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run([executable.as_posix()], check=True, stdout=subprocess.DEVNULL)
+    return (time.perf_counter() - start) / runs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the peephole optimizer.')
+    parser.add_argument('sources', nargs='*', default=DEFAULT_SOURCES, help='programs to compile')
+    parser.add_argument('-r', '--runs', type=int, default=200, help='times every program is run')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for source in args.sources:
+            source = (ROOT / source).resolve()
+            plain, optimized = Path(directory, 'plain'), Path(directory, 'optimized')
+            plain_count = compile_source(source, plain)
+            optimized_count = compile_source(source, optimized, '-O')
+            plain_time = time_runs(plain, args.runs)
+            optimized_time = time_runs(optimized, args.runs)
+            print(f'{source.relative_to(ROOT)}: '
+                  f'{plain_count} -> {optimized_count} instructions '
+                  f'({1 - optimized_count / plain_count:.0%} fewer), '
+                  f'{plain_time * 1e6:.0f} -> {optimized_time * 1e6:.0f} us per run')
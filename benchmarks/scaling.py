@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Benchmark of how compile time grows with the size of the program.
+
+Synthetic programs of increasing size, from 1k to 1M tokens, are compiled with
+--timings --timings-format json in a few shapes: many small procedures, deeply
+nested blocks, deep macros used everywhere and lots of string literals. For
+every phase an exponent is fitted, time ~ tokens ** exponent, and a phase
+growing faster than MAX_EXPONENT fails the run. That's how a quadratic
+tokenize, token creation or expand_macros gets caught.
+
+Every run is appended to RESULTS with the commit it ran on, --compare shows
+the previous run next to this one.
+"""
+import argparse
+import datetime
+import json
+import math
+import random
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS = ROOT / 'benchmarks' / 'results' / 'scaling.jsonl'
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+MAX_EXPONENT = 1.5   # Halfway to quadratic, garbage collections landing in a phase make it noisy
+MIN_PHASE_TIME = 0.01  # Seconds at the largest size for a phase to be checked
+FIT_FROM = 10_000    # Smaller programs are mostly the cost of starting the compiler
+
+# statements per procedure, how deep blocks nest and how often a statement is a
+# block, how deep macros nest and how often a statement uses one, and how often
+# a statement is a string literal
+SHAPES = {
+    'procedures': dict(statements=4, nesting=1, blocks=0.2, macro_depth=1, macros=0.1, strings=0.05),
+    'nested':     dict(statements=40, nesting=8, blocks=0.9, macro_depth=1, macros=0.1, strings=0.05),  # noqa e241
+    'macros':     dict(statements=40, nesting=1, blocks=0.1, macro_depth=8, macros=0.8, strings=0.0),   # noqa e241
+    'strings':    dict(statements=40, nesting=1, blocks=0.1, macro_depth=1, macros=0.0, strings=0.8),   # noqa e241
+}
+
+
+class ProgramGenerator:
+    """Writes a random but valid program of some shape."""
+
+    def __init__(self, shape: dict, seed: int = 0):
+        self.shape = shape
+        self.random = random.Random(seed)
+        self.strings = 0
+
+    def statement(self, depth: int) -> str:
+        """Code that leaves the stack as it found it, in a procedure with an input x and a return r."""
+        shape = self.shape
+        choice = self.random.random()
+        if choice < shape['strings']:
+            self.strings += 1
+            return f'"string {self.strings}" drop drop'
+        choice -= shape['strings']
+        if choice < shape['macros']:
+            return f'r m{shape["macro_depth"]} !r'
+        if depth < shape['nesting'] and self.random.random() < shape['blocks']:
+            # A single statement inside keeps the size linear in the nesting depth
+            inner = self.statement(depth + 1)
+            if self.random.random() < 0.5:
+                return f'if x {depth} > do {inner} else r 1 + !r end'
+            i = f'i{depth}'
+            return f'0 where {i} in while {i} 2 < do {inner} {i} 1 + !{i} end end drop'
+        return f'r x + {self.random.randint(1, 9)} * 1000 % !r'
+
+    def program(self, tokens: int) -> str:
+        """A program with about tokens tokens once the macros are expanded."""
+        lines = ['import "std"', '', 'macro m1 1 + end']
+        lines.extend(f'macro m{depth} m{depth - 1} 1 + end' for depth in range(2, self.shape['macro_depth'] + 1))
+        expansion = 2 * self.shape['macro_depth']
+
+        count = 0
+        procedures = 0
+        while count < tokens:
+            body = [self.statement(0) for _ in range(self.shape['statements'])]
+            lines.append(f'procedure p{procedures} x -- r in')
+            lines.append('    0 !r')
+            lines.extend(f'    {statement}' for statement in body)
+            lines.append('end')
+            count += sum(len(statement.split()) + statement.count(' m') * (expansion - 1) for statement in body) + 8
+            procedures += 1
+
+        lines.append('procedure main -- in')
+        lines.extend(f'    {procedure} p{procedure} drop' for procedure in range(procedures))
+        lines.append('end')
+        return '\n'.join(lines) + '\n'
+
+
+def compile_timings(source: Path, repeat: int) -> dict:
+    """Timings of compiling source, the fastest of repeat compilations for every phase."""
+    best = None
+    for _ in range(repeat):
+        command = [sys.executable, 'pyre.py', source.as_posix(), '--timings', '--timings-format', 'json']
+        completed_process = subprocess.run(command, cwd=ROOT, check=True, capture_output=True, text=True)
+        timings = json.loads(completed_process.stdout.splitlines()[-1])
+        if best is None:
+            best = timings
+        else:
+            best['phases'] = {phase: min(seconds, timings['phases'][phase])
+                              for phase, seconds in best['phases'].items()}
+    best['total'] = sum(best['phases'].values())
+    del best['program']
+    return best
+
+
+def fit_exponent(points: list) -> float:
+    """Slope of the least squares line through the (tokens, seconds) points in log-log."""
+    xs = [math.log(tokens) for tokens, _ in points]
+    ys = [math.log(max(seconds, 1e-7)) for _, seconds in points]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    variance = sum((x - x_mean) ** 2 for x in xs)
+    return sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / variance
+
+
+def exponents(runs: list) -> dict:
+    """Fitted exponent of every phase and of the total."""
+    fitted = [run for run in runs if run['tokens_after_expansion'] >= FIT_FROM]
+    if len(fitted) < 2:
+        fitted = runs
+    if len(fitted) < 2:
+        return {}
+    phases = list(fitted[-1]['phases']) + ['total']
+
+    def seconds(run, phase):
+        return run['total'] if phase == 'total' else run['phases'][phase]
+
+    return {phase: fit_exponent([(run['tokens_after_expansion'], seconds(run, phase)) for run in fitted])
+            for phase in phases}
+
+
+def commit() -> tuple:
+    """Hash of the commit the tree is at and whether it has changes on top."""
+    def git(*arguments):
+        return subprocess.run(['git', *arguments], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return git('rev-parse', '--short', 'HEAD') or None, bool(git('status', '--porcelain', '--untracked-files=no'))
+
+
+def report(name: str, runs: list, fitted: dict, previous: dict = None) -> list:
+    """Table of the seconds of every phase at every size, and the phases that grow too fast."""
+    sizes = ''.join(f'{run["tokens_after_expansion"]:>12,}' for run in runs)
+    print(f'{name}:')
+    print(f'    {"tokens":<24}{sizes}    exponent')
+    too_fast = []
+    for phase in list(runs[-1]['phases']) + ['total']:
+        values = [run['total'] if phase == 'total' else run['phases'][phase] for run in runs]
+        exponent = fitted.get(phase)
+        line = f'    {phase:<24}' + ''.join(f'{value * 1000:10.1f}ms' for value in values)
+        if exponent is not None:
+            line += f'{exponent:8.2f}'
+            if previous and phase in previous:
+                line += f' (was {previous[phase]:.2f})'
+            if exponent > MAX_EXPONENT and values[-1] >= MIN_PHASE_TIME:
+                line += '  <- grows too fast'
+                too_fast.append(f'{name} {phase}')
+        print(line)
+    return too_fast
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark how compile time grows with the program.')
+    parser.add_argument('-s', '--shapes', nargs='+', choices=list(SHAPES), default=list(SHAPES),
+                        help='shapes of programs to generate')
+    parser.add_argument('--max-tokens', type=int, default=SIZES[-1], help='size of the largest program')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='compilations of every program, the best counts')
+    parser.add_argument('--compare', action='store_true', help=f'show the exponents of the last run in {RESULTS}')
+    parser.add_argument('--no-save', action='store_false', dest='save', help=f'do not append the run to {RESULTS}')
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare and RESULTS.exists():
+        lines = RESULTS.read_text().splitlines()
+        previous = json.loads(lines[-1]) if lines else None
+        if previous:
+            print(f'comparing with {previous["commit"]}{" with changes" if previous["dirty"] else ""} '
+                  f'from {previous["date"]}')
+
+    sizes = [size for size in SIZES if size <= args.max_tokens]
+    results = {}
+    too_fast = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.shapes:
+            runs = []
+            for size in sizes:
+                source = Path(directory, f'{name}_{size}.pyre')
+                source.write_text(ProgramGenerator(SHAPES[name]).program(size))
+                runs.append(compile_timings(source, args.repeat))
+            fitted = exponents(runs)
+            results[name] = {'runs': runs, 'exponents': fitted}
+            previous_exponents = previous['results'].get(name, {}).get('exponents') if previous else None
+            too_fast.extend(report(name, runs, fitted, previous_exponents))
+
+    if args.save:
+        hash, dirty = commit()
+        RESULTS.parent.mkdir(exist_ok=True)
+        with open(RESULTS, 'a') as f:
+            f.write(json.dumps({
+                'commit': hash,
+                'dirty': dirty,
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': sys.version.split()[0],
+                'results': results,
+            }) + '\n')
+
+    if too_fast:
+        print(f'grow faster than tokens ** {MAX_EXPONENT}: {", ".join(too_fast)}')
+        sys.exit(1)
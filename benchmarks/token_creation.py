@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+"""Benchmark showing the cost of creating a token doesn't grow with the number of tokens."""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, ROOT.as_posix())
+
+from definitions import Operator  # noqa e402
+from implementations import operator_to_token  # noqa e402
+from parsing_utils import Lexeme  # noqa e402
+
+
+def create_tokens(tokens: list, count: int):
+    lexeme = Lexeme('+', '<benchmark>', 1, 1)
+    for _ in range(count):
+        tokens.append(operator_to_token(Operator.ADD, lexeme, iter(())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark token creation.')
+    parser.add_argument('-n', '--batches', type=int, default=10, help='number of batches')
+    parser.add_argument('-b', '--batch-size', type=int, default=100_000, help='tokens per batch')
+    args = parser.parse_args()
+
+    tokens = []  # Keep every token alive like the compiler does
+    timings = []
+    for batch in range(args.batches):
+        start = time.perf_counter()
+        create_tokens(tokens, args.batch_size)
+        elapsed = time.perf_counter() - start
+        timings.append(elapsed)
+        print(f'tokens {batch * args.batch_size:>10,} .. {(batch + 1) * args.batch_size:>10,}: '
+              f'{elapsed / args.batch_size * 1e9:8.1f} ns/token')
+
+    print(f'last batch / first batch: {timings[-1] / timings[0]:.2f}')
@@ -0,0 +1,65 @@
+"""
+Call graph of a program.
+
+Procedures that can't be reached from main are left out of the program, and
+the string literals they use with them.
+"""
+from definitions import Operator, PROCEDURE_PREFIX
+
+
+def call_graph(program: list) -> dict:
+    """Map every procedure in a referenced program to the procedures it calls."""
+    graph = {}
+    for token in program:
+        if token.operator is Operator.PROCEDURE:
+            graph[token.value] = {
+                program[address].value[len(PROCEDURE_PREFIX):]
+                for address in range(token.address, token.end)
+                if program[address].operator is Operator.PROCEDURE_CALL
+            }
+    return graph
+
+
+def reachable_procedures(graph: dict, root: str = 'main') -> set:
+    reached = {root}
+    pending = [root]
+    while pending:
+        for callee in graph.get(pending.pop(), ()):
+            if callee not in reached:
+                reached.add(callee)
+                pending.append(callee)
+    return reached
+
+
+def remove_dead_procedures(program: list, verbose: bool = False) -> list:
+    """
+    Leave out the procedures main never calls.
+
+    Works on a referenced program and gives back the tokens without references.
+    Nothing is removed from a program without a main procedure.
+    """
+    graph = call_graph(program)
+    if 'main' not in graph:
+        return program
+    reached = reachable_procedures(graph)
+
+    result = []
+    procedures = 0
+    strings = 0
+    address = 0
+    while address < len(program):
+        token = program[address]
+        if token.operator is Operator.PROCEDURE and token.value not in reached:
+            body = program[address:token.end + 1]
+            procedures += 1
+            strings += sum(1 for item in body if item.operator is Operator.PUSH_STRING)
+            if verbose:
+                print(f'{token.where()}: dropped procedure {token.value}, nothing calls it')
+            address = token.end + 1
+            continue
+        result.append(token)
+        address += 1
+
+    if verbose:
+        print(f'dropped {procedures} procedures and {strings} string literals')
+    return result
@@ -0,0 +1,171 @@
+"""
+Constant folding over the token stream.
+
+Operators whose operands are all constants pushed right before them are
+replaced by their result, shuffles of constants by the shuffled constants.
+Blocks whose condition ends up being a constant keep only the branch that
+runs. Adding constants to `memory` becomes a single push of the address.
+
+It works on a referenced program and gives back the tokens without
+references, create_references has to run on them again.
+"""
+from definitions import Token, Operator
+
+
+_CONSTANTS = {Operator.PUSH_UINT, Operator.PUSH_CHAR}
+_MAX_CONSTANT = 2 ** 31  # Constants are pushed as 32 bit immediates
+
+_BINARY = {
+    Operator.ADD                  : lambda a, b: a + b,                     # noqa e241
+    Operator.SUB                  : lambda a, b: a - b,                     # noqa e241
+    Operator.MUL                  : lambda a, b: a * b,                     # noqa e241
+    Operator.DIV                  : lambda a, b: a // b if b else None,     # noqa e241
+    Operator.MOD                  : lambda a, b: a % b if b else None,      # noqa e241
+    Operator.AND                  : lambda a, b: a & b,                     # noqa e241
+    Operator.OR                   : lambda a, b: a | b,                     # noqa e241
+    Operator.EQUAL                : lambda a, b: int(a == b),               # noqa e241
+    Operator.NOT_EQUAL            : lambda a, b: int(a != b),               # noqa e241
+    Operator.LESS_THAN            : lambda a, b: int(a < b),                # noqa e241
+    Operator.GREATER_THAN         : lambda a, b: int(a > b),                # noqa e241
+    Operator.LESS_OR_EQUAL_THAN   : lambda a, b: int(a <= b),               # noqa e241
+    Operator.GREATER_OR_EQUAL_THAN: lambda a, b: int(a >= b),               # noqa e241
+}
+
+_UNARY = {
+    Operator.NOT                  : lambda a: ~a & 1,                       # noqa e241
+    Operator.BOOL                 : lambda a: int(a != 0),                  # noqa e241
+}
+
+# How many constants a shuffle takes and which of them it leaves, bottom first
+_SHUFFLES = {
+    Operator.DROP                 : (1, ()),                                # noqa e241
+    Operator.DUP                  : (1, (0, 0)),                            # noqa e241
+    Operator.ROT2                 : (2, (1, 0)),                            # noqa e241
+    Operator.ROT3                 : (3, (1, 2, 0)),                         # noqa e241
+    Operator.DROT2                : (4, (2, 3, 0, 1)),                      # noqa e241
+    Operator.DUP2                 : (2, (0, 1, 0, 1)),                      # noqa e241
+    Operator.DUP3                 : (3, (0, 1, 2, 0, 1, 2)),                # noqa e241
+}
+
+# Operators that do nothing when their second operand is this constant
+_IDENTITIES = {
+    Operator.ADD: 0,
+    Operator.SUB: 0,
+    Operator.MUL: 1,
+    Operator.DIV: 1,
+}
+
+
+def _is_constant(token: Token) -> bool:
+    return token.operator in _CONSTANTS
+
+
+def _constant(value: int, position: tuple) -> Token:
+    return Token(Operator.PUSH_UINT, value=value, position=position)
+
+
+def _chain_end(token: Token) -> int:
+    """Address of the end of the if block the token after a do belongs to."""
+    return token.end if token.operator in {Operator.ELIF, Operator.ELSE} else token.address
+
+
+def fold_constants(program: list, verbose: bool = False) -> list:
+    """Fold the constants in a referenced program."""
+    result = []
+    skips = {}       # Address -> address to continue from
+    dropped = set()  # Addresses of tokens that go away
+    to_if = set()    # Addresses of elifs that start their block now
+
+    def log(token, message):
+        if verbose:
+            print(f'{token.where()}: {message}')
+
+    def describe(tokens):
+        return ' '.join(str(token.value) for token in tokens)
+
+    address = 0
+    while address < len(program):
+        if address in skips:
+            address = skips.pop(address)
+            continue
+        token = program[address]
+        address += 1
+        operator = token.operator
+
+        if token.address in dropped:
+            continue
+        if token.address in to_if:
+            result.append(Token(Operator.IF, value='if', position=token.position))
+            continue
+
+        if operator in _BINARY and len(result) >= 2 and _is_constant(result[-1]) and _is_constant(result[-2]):
+            value = _BINARY[operator](result[-2].value, result[-1].value)
+            if value is not None and 0 <= value < _MAX_CONSTANT:
+                log(token, f'folded {describe(result[-2:])} {token.value} into {value}')
+                result[-2:] = [_constant(value, token.position)]
+                continue
+        if operator in _IDENTITIES and result and _is_constant(result[-1]) and result[-1].value == _IDENTITIES[operator]:
+            log(token, f'removed {result[-1].value} {token.value}')
+            result.pop()
+            continue
+        if (operator is Operator.ADD and len(result) >= 2
+                and {result[-2].operator, result[-1].operator} == {Operator.MEMORY, Operator.PUSH_UINT}):
+            memory, offset = sorted(result[-2:], key=lambda item: item.operator is Operator.PUSH_UINT)
+            value = (memory.value if isinstance(memory.value, int) else 0) + offset.value
+            if value < _MAX_CONSTANT:
+                log(token, f'folded memory {offset.value} + into memory + {value}')
+                result[-2:] = [Token(Operator.MEMORY, value=value, position=memory.position)]
+                continue
+        if operator in _UNARY and result and _is_constant(result[-1]):
+            value = _UNARY[operator](result[-1].value)
+            log(token, f'folded {result[-1].value} {token.value} into {value}')
+            result[-1] = _constant(value, token.position)
+            continue
+        if operator in _SHUFFLES:
+            count, order = _SHUFFLES[operator]
+            operands = result[len(result) - count:]
+            if len(operands) == count and all(_is_constant(operand) for operand in operands):
+                shuffled = [_constant(operands[i].value, operands[i].position) for i in order]
+                log(token, f'folded {describe(operands)} {token.value} into {describe(shuffled) or "nothing"}')
+                result[-count:] = shuffled
+                continue
+
+        if (operator is Operator.DO and len(result) >= 2 and _is_constant(result[-1])
+                and result[-2].operator in {Operator.IF, Operator.ELIF, Operator.WHILE}):
+            opener = result[-2]
+            taken = result[-1].value == 1  # do only jumps over its block when it's not exactly TRUE
+            following = program[token.end]
+
+            if opener.operator is Operator.WHILE:
+                if not taken:
+                    log(token, 'removed a loop that never runs')
+                    del result[-2:]
+                    address = token.end + 1
+                    continue
+            elif taken:
+                del result[-2:]
+                end = _chain_end(following)
+                if opener.operator is Operator.IF:
+                    log(token, 'kept the only branch that runs')
+                    skips[following.address] = end + 1
+                else:
+                    log(token, 'made the branch that always runs the else')
+                    result.append(Token(Operator.ELSE, value='else', position=opener.position))
+                    skips[following.address] = end
+                continue
+            else:
+                log(token, 'removed a branch that never runs')
+                del result[-2:]
+                if opener.operator is Operator.IF:
+                    if following.operator is Operator.ELIF:
+                        to_if.add(following.address)
+                    elif following.operator is Operator.ELSE:
+                        dropped.update({following.address, following.end})
+                    else:
+                        dropped.add(following.address)
+                address = following.address
+                continue
+
+        result.append(token)
+
+    return result
@@ -1,8 +1,6 @@
 """Type definitions."""
-from dataclasses import dataclass, fields
 from enum import Enum, auto
-from typing import Any, Type, Iterable
-from types import MethodType
+from typing import Any
 import re
 import global_state
 
@@ -14,7 +12,7 @@ class Operator(Enum):
     """
     Every operator Pyre knows.
 
-    Order matters because LexemeMatches uses the definition order that
+    Order matters because lexeme_matches uses the definition order that
     appears here.
     """
 
@@ -55,7 +53,16 @@ class Operator(Enum):
     STORE1                = 'store1'                # noqa e241
     LOAD                  = 'load'                  # noqa e241
     STORE                 = 'store'                 # noqa e241
+    MEMCPY                = 'memcpy'                # noqa e241
+    MEMSET                = 'memset'                # noqa e241
+    MEMCMP                = 'memcmp'                # noqa e241
+    MEMCHR                = 'memchr'                # noqa e241
+    STRLEN                = 'strlen'                # noqa e241
+    STRCMP                = 'strcmp'                # noqa e241
     MEMORY                = 'memory'                # noqa e241
+    ALLOC                 = 'alloc'                 # noqa e241
+    FREE                  = 'free'                  # noqa e241
+    REALLOC               = 'realloc'               # noqa e241
 
     # Control flow
     IF                    = 'if'                    # noqa e241
@@ -69,6 +76,7 @@ class Operator(Enum):
 
     # Other directives
     PROCEDURE             = 'procedure'             # noqa e241
+    INLINE                = 'inline'                # noqa e241
     IMPORT                = 'import'                # noqa e241
     SYSCALL               = re.compile('syscall.')  # noqa e241
     DEFINE                = 'define'                # noqa e241
@@ -138,29 +146,52 @@ def get_store_instruction(type_annotation):
     return type_to_store_instruction[type_annotation]
 
 
-def lexeme_matches(item) -> Operator:
-    def filter_operators(operators: Iterable, value_types: Iterable[Type]) -> Iterable:
-        """Filter out all the operators whose value isn't of type value_type."""
-        def does_value_match(operator):
-            return any(isinstance(operator.value, value_type) for value_type in value_types)
-        return filter(does_value_match, operators)
+def _build_lexeme_classifier():
+    """
+    Precompute the tables lexeme_matches uses to classify a lexeme.
+
+    The priority is the same one a linear scan over Operator would give:
+    keywords first, then procedure and macro names, then the regular
+    expressions in definition order.
+    """
+    keywords = {}
+    names = []
+    patterns = []
+    for operator in Operator:
+        if isinstance(operator.value, str):
+            keywords.setdefault(operator.value, operator)
+        elif isinstance(operator.value, (set, list, dict)):
+            # These are live, they grow as procedures and macros are defined
+            names.append(operator)
+        elif isinstance(operator.value, re.Pattern):
+            patterns.append(f'(?P<{operator.name}>{operator.value.pattern})')
+
+    # Alternatives are tried left to right so the first operator whose regex
+    # matches the whole lexeme wins
+    return keywords, tuple(names), re.compile('|'.join(patterns))
+
+
+_keyword_operators, _name_operators, _pattern_operators = _build_lexeme_classifier()
+
 
+def lexeme_matches(item) -> Operator:
     # If the item is equal to the value of one operator
     # That's because it's a keyword and we are done
-    for operator in filter_operators(Operator, [str]):
-        if item == operator.value:
-            return operator
+    operator = _keyword_operators.get(item)
+    if operator is not None:
+        return operator
 
     # If the item is exactly equal to one of the items in the value of one operator
     # That's because it's a label and we are done
-    for operator in filter_operators(Operator, [list, dict]):
+    for operator in _name_operators:
         if item in operator.value:
             return operator
 
     # No luck, we'll check with regular expressions
-    for operator in filter_operators(Operator, [re.Pattern]):
-        if operator.value.fullmatch(item) is not None:
-            return operator
+    # The outermost group is the last one to close so lastgroup names the operator
+    match = _pattern_operators.fullmatch(item)
+    if match is not None:
+        return Operator[match.lastgroup]
 
     raise ValueError(f'Lexeme {item} does not match any known operator')
 
@@ -187,7 +218,16 @@ stack_effect = {
     Operator.STORE1                     : -2,     # noqae 241
     Operator.LOAD                       :  0,     # noqae 241
     Operator.STORE                      : -2,     # noqae 241
+    Operator.MEMCPY                     : -3,     # noqae 241
+    Operator.MEMSET                     : -3,     # noqae 241
+    Operator.MEMCMP                     : -2,     # noqae 241
+    Operator.MEMCHR                     : -2,     # noqae 241
+    Operator.STRLEN                     :  0,     # noqae 241
+    Operator.STRCMP                     : -1,     # noqae 241
     Operator.MEMORY                     :  1,     # noqae 241
+    Operator.ALLOC                      :  0,     # noqae 241
+    Operator.FREE                       : -1,     # noqae 241
+    Operator.REALLOC                    : -1,     # noqae 241
 
     Operator.EQUAL                      : -1,     # noqae 241
     Operator.NOT_EQUAL                  : -1,     # noqae 241
@@ -196,6 +236,11 @@ stack_effect = {
     Operator.LESS_OR_EQUAL_THAN         : -1,     # noqae 241
     Operator.GREATER_OR_EQUAL_THAN      : -1,     # noqae 241
 
+    Operator.AND                        : -1,     # noqae 241
+    Operator.OR                         : -1,     # noqae 241
+    Operator.NOT                        :  0,     # noqae 241
+    Operator.BOOL                       :  0,     # noqae 241
+
     Operator.IF                         :  0,     # noqae 241
     Operator.ELIF                       :  0,     # noqae 241
     Operator.ELSE                       :  0,     # noqae 241
@@ -206,6 +251,7 @@ stack_effect = {
 
     Operator.PROCEDURE                  :  0,     # noqae 241
     Operator.PROCEDURE_CALL             :  0,     # noqae 241
+    Operator.INLINE                     :  0,     # noqae 241
 
     Operator.WHERE                      :  0,     # noqae 241
     Operator.IN                         :  0,     # noqae 241
@@ -229,58 +275,128 @@ stack_effect = {
 }
 
 
-@dataclass
+# How many items on top of the stack an operator takes, the ones missing here take none
+stack_inputs = {
+    Operator.ADD                        :  2,     # noqae 241
+    Operator.SUB                        :  2,     # noqae 241
+    Operator.MUL                        :  2,     # noqae 241
+    Operator.DIV                        :  2,     # noqae 241
+    Operator.MOD                        :  2,     # noqae 241
+
+    Operator.DROP                       :  1,     # noqae 241
+    Operator.ROT2                       :  2,     # noqae 241
+    Operator.SWAP                       :  2,     # noqae 241
+    Operator.DROT2                      :  4,     # noqae 241
+    Operator.ROT3                       :  3,     # noqae 241
+    Operator.DUP                        :  1,     # noqae 241
+    Operator.DUP2                       :  2,     # noqae 241
+    Operator.DUP3                       :  3,     # noqae 241
+
+    Operator.LOAD1                      :  1,     # noqae 241
+    Operator.STORE1                     :  2,     # noqae 241
+    Operator.LOAD                       :  1,     # noqae 241
+    Operator.STORE                      :  2,     # noqae 241
+    Operator.MEMCPY                     :  3,     # noqae 241
+    Operator.MEMSET                     :  3,     # noqae 241
+    Operator.MEMCMP                     :  3,     # noqae 241
+    Operator.MEMCHR                     :  3,     # noqae 241
+    Operator.STRLEN                     :  1,     # noqae 241
+    Operator.STRCMP                     :  2,     # noqae 241
+    Operator.ALLOC                      :  1,     # noqae 241
+    Operator.FREE                       :  1,     # noqae 241
+    Operator.REALLOC                    :  2,     # noqae 241
+
+    Operator.EQUAL                      :  2,     # noqae 241
+    Operator.NOT_EQUAL                  :  2,     # noqae 241
+    Operator.LESS_THAN                  :  2,     # noqae 241
+    Operator.GREATER_THAN               :  2,     # noqae 241
+    Operator.LESS_OR_EQUAL_THAN         :  2,     # noqae 241
+    Operator.GREATER_OR_EQUAL_THAN      :  2,     # noqae 241
+
+    Operator.AND                        :  2,     # noqae 241
+    Operator.OR                         :  2,     # noqae 241
+    Operator.NOT                        :  1,     # noqae 241
+    Operator.BOOL                       :  1,     # noqae 241
+
+    Operator.DO                         :  1,     # noqae 241
+    Operator.MUTATE                     :  1,     # noqae 241
+    Operator.DEREFERENCE                :  1,     # noqae 241
+}
+
+
+def token_stack_inputs(token) -> int:
+    """How many items on top of the stack a token takes."""
+    if token.operator is Operator.SYSCALL:
+        return token.value + 1
+    if token.operator is Operator.PROCEDURE_CALL:
+        input_variables, _ = global_state.procedure_to_variables[token.value[len(PROCEDURE_PREFIX):]]
+        return len(input_variables)
+    return stack_inputs.get(token.operator, 0)
+
+
+def token_stack_effect(token) -> int:
+    """Net amount of items a token leaves on the stack, None if unknown."""
+    if token.operator is Operator.SYSCALL:
+        return -token.value  # Takes the syscall number and its arguments, pushes the result
+    if token.operator is Operator.PROCEDURE_CALL:
+        input_variables, return_variables = global_state.procedure_to_variables[token.value[len(PROCEDURE_PREFIX):]]
+        return len(return_variables) - len(input_variables)
+    return stack_effect.get(token.operator)
+
+
 class Token:
-    """A token in the program."""
-
-    operator: Operator
-    # This ends up being a method, but you need to pass in a regular callable
-    implementation: MethodType = None
-    value: Any = None
-
-    # Useful when dealing with strings
-    length: int = None
-
-    # Useful when dealing with block operations
-    block: bool = None
-    address: int = None
-    label: str = None
-
-    start_token = None
-    end_token = None
-
-    def __new__(cls, *_, **__):
-        obj = super().__new__(cls)
-        obj.__init = cls.__init__
-
-        def __init__(self, *args, **kwargs):
-            obj.__init(self, *args, **kwargs)
-            self.bind_methods()
-
-        cls.__init__ = __init__
-
-        return obj
-
-    def bind_methods(self):
-        """
-        Bind fields that should be methods but aren't methods yet to this instance.
-
-        This method is called right after creating the object.
-        If that wasn't the case then we could accomplish the same doing:
-            token = Token(...)._bind_methods()
-        But luckily it is the case.
-        There's no need to call this method more than once.
-
-        I know, this is just evil.
-        """
-
-        for item in fields(self):
-            member = getattr(self, item.name)
-            if member is None:
-                continue
-            if item.type is MethodType:
-                if not isinstance(member, MethodType):
-                    setattr(self, item.name, MethodType(member, self))
-                elif member.__self__ is not self:
-                    setattr(self, item.name, MethodType(member.__func__, self))
-        return self
+    """
+    A token in the program.
+
+    Tokens refer to each other by their index in the program (their address)
+    so they stay small and cheap to copy.
+    """
+
+    __slots__ = (
+        'operator',
+        'value',
+        # Useful when dealing with strings
+        'length',
+        # Useful when dealing with block operations
+        'label',
+        'address',  # Index of this token in the program
+        'start',    # Index of the token opening the block this one closes
+        'end',      # Index of the token closing the block this one opens
+        # (file, line, column) of the lexeme the token comes from
+        'position',
+        # Where variables live once resolve_variables ran
+        'location',
+        # Depth of the stack before the token once analyze_stack ran
+        'depth',
+    )
+
+    def __init__(self, operator: Operator, value: Any = None, length: int = None,
+                 label: str = None, position: tuple = None):
+        self.operator = operator
+        self.value = value
+        self.length = length
+        self.label = label
+        self.address = None
+        self.start = None
+        self.end = None
+        self.position = position
+        self.location = None
+        self.depth = None
+
+    def __copy__(self):
+        token = Token(self.operator, self.value, self.length, self.label, self.position)
+        token.address = self.address
+        token.start = self.start
+        token.end = self.end
+        token.location = self.location
+        token.depth = self.depth
+        return token
+
+    def __repr__(self):
+        return f'Token({self.operator!r}, value={self.value!r}, address={self.address})'
+
+    def where(self) -> str:
+        """Describe where the token comes from for error messages."""
+        if self.position is None:
+            return 'unknown position'
+        return '{}:{}:{}'.format(*self.position)
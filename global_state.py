@@ -1,10 +1,33 @@
 """Some globals."""
 
-procedures = []
+procedures = set()
 macros = {}
-add_symbols = []
+add_symbols = {}  # Label -> string literal token
 string_literals = 0
 imports = []
-symbols = []
 
 procedure_to_variables = {}
+inline_procedures = set()  # Procedures marked inline
+
+use_token_cache = True
+
+memory_capacity = 1024 * 1024  # Bytes of the static memory, 0 leaves it out. 1 MiB I hope that's enough
+huge_pages = False  # Whether the allocator asks for huge pages
+
+instrument = None  # None, 'procedures' or 'loops'
+instrumented_procedures = {}  # Name -> index in the instrumentation tables
+instrumented_loops = {}  # Label of a while -> its index and where it is
+
+
+def reset():
+    """Forget the program compiled before, to compile another one in the same process."""
+    global string_literals
+    procedures.clear()
+    macros.clear()
+    add_symbols.clear()
+    string_literals = 0
+    imports.clear()
+    procedure_to_variables.clear()
+    inline_procedures.clear()
+    instrumented_procedures.clear()
+    instrumented_loops.clear()
@@ -1,72 +1,106 @@
 """Utils to help check each operation makes sense."""
-from definitions import Operator, stack_effect
-
-
-def _check_push_count_do_not_modify(token, program_iterator, stack_size) -> int:
-    starting_stack_size = stack_size
-    for child_token in program_iterator:
-        if child_token is token.end_token:
-            break
-        if child_token.operator is Operator.SYSCALL:
-            stack_size -= child_token.value + 1
+import global_state
+from definitions import Operator, token_stack_effect, token_stack_inputs
+
+
+_UNREACHABLE = object()  # Depth of code no jump or fall through gets to
+
+
+def _merge_depths(a, b):
+    if a is _UNREACHABLE:
+        return b
+    if b is _UNREACHABLE or a == b:
+        return a
+    return None  # The paths disagree, the depth isn't known anymore
+
+
+def _loop_end(program: list, loop) -> int:
+    return program[loop.end].end  # while -> do -> end
+
+
+def _forget_loop(program: list, loop, forgotten: set):
+    """
+    Make the depth of every token in a loop unknown.
+
+    Loops inside it that were already forgotten are skipped so no token is
+    visited twice.
+    """
+    address = loop.address
+    end = _loop_end(program, loop)
+    while address <= end:
+        token = program[address]
+        if address in forgotten:
+            address = _loop_end(program, token) + 1
+            continue
+        token.depth = None
+        address += 1
+    forgotten.add(loop.address)
+
+
+def analyze_stack(program: list) -> list:
+    """
+    Find the depth of the stack before every token of a referenced program.
+
+    Depths are counted from the start of the procedure the token is in, inputs
+    already on the stack. The depth of a block's end is the one after its
+    label, where every path into it meets. Depths that can't be known at
+    compile time, like the ones inside a loop that doesn't leave the stack as
+    it found it, are None. Every token gets its depth in token.depth.
+
+    The program is walked once, a loop found to be unbalanced at its end has
+    its tokens forgotten, so it runs in linear time however nested the blocks
+    are. Raises a RuntimeError when a token takes more from the stack than
+    there is.
+    """
+    jumps = {}        # Address of a label -> depth of the jumps to it
+    loop_depths = {}  # Address of a while -> depth when entering the loop
+    forgotten = set()  # Addresses of the loops whose depths aren't known
+    depth = 0
+    bottom = 0  # What the procedure can take, the inputs but not its frame under them
+
+    for token in program:
+        address = token.address
+        operator = token.operator
+
+        if operator is Operator.PROCEDURE:
+            input_variables, _ = global_state.procedure_to_variables[token.value]
+            depth = 0
+            bottom = -len(input_variables)
+        elif operator in {Operator.ELIF, Operator.ELSE}:
+            # Whatever falls through jumps to the end, the label comes after that
+            jumps[token.end] = _merge_depths(jumps.get(token.end, _UNREACHABLE), depth)
+            depth = jumps.pop(address, _UNREACHABLE)
+        elif operator is Operator.WHILE:
+            loop_depths[address] = depth
+        elif operator is Operator.END and program[token.start].operator in {Operator.DO, Operator.ELSE}:
+            start_token = program[token.start]
+            if start_token.operator is Operator.DO and program[start_token.start].operator is Operator.WHILE:
+                loop = program[start_token.start]
+                exit_depth = jumps.pop(address, _UNREACHABLE)
+                if depth is not _UNREACHABLE and depth != loop_depths[loop.address]:
+                    _forget_loop(program, loop, forgotten)
+                    exit_depth = None
+                depth = exit_depth
+            else:
+                depth = _merge_depths(depth, jumps.pop(address, _UNREACHABLE))
+
+        if not isinstance(depth, int):
+            token.depth = None
+            if operator is Operator.DO:
+                jumps[token.end] = _merge_depths(jumps.get(token.end, _UNREACHABLE), depth)
+            continue
+        token.depth = depth
+
+        inputs = token_stack_inputs(token)
+        if depth - inputs < bottom:
+            raise RuntimeError(f'Not enough values on the stack for {token.value} at {token.where()}, '
+                               f'it takes {inputs} and there are {depth - bottom}')
+
+        if operator is Operator.DO:
+            jumps[token.end] = _merge_depths(jumps.get(token.end, _UNREACHABLE), depth - 1)
+            depth -= 1
         else:
-            stack_size += stack_effect[child_token.operator]
-        _check_push_count(child_token, program_iterator, stack_size)
-
-    assert stack_size == starting_stack_size, f'Operator {token.operator} should not modify the stack'\
-        f'{stack_size=} {starting_stack_size=}'
-
-    return stack_size
-
-
-def _check_push_count_normal(token, program_iterator, stack_size) -> int:
-    for child_token in program_iterator:
-        if child_token is token.end_token:
-            break
-        if child_token.operator is Operator.SYSCALL:
-            stack_size -= child_token.value + 1
-        else:
-            stack_size += stack_effect[child_token.operator]
-        _check_push_count(child_token, program_iterator, stack_size)
-
-    return stack_size
-
-
-def _check_push_count(token, program_iterator, stack_size) -> int:
-    starting_stack_size = stack_size
-    if token.operator in {Operator.IF, Operator.ELSE, Operator.WHILE}:
-        if token.operator is Operator.IF and token.end_token.operator is Operator.END:
-            stack_size = _check_push_count_do_not_modify(token, program_iterator, stack_size)
-        elif token.operator is Operator.IF and token.end_token.operator is Operator.ELSE:
-            stack_if = _check_push_count_normal(token, program_iterator, stack_size)
-            stack_else = _check_push_count_normal(token.end_token, program_iterator, stack_size)
-            assert stack_if == stack_else, 'If and else effect on the stack should match.\n' \
-                f'{stack_if=} {stack_else=} {starting_stack_size=}'
-
-            stack_size = stack_if
-        # elif token.operator is Operator.WHILE:
-        #     stack_size = _check_push_count_do_not_modify(token, program_iterator, stack_size)
-    return stack_size
-
-
-def _check_push_procedure(token, program_iterator, stack_size=0) -> int:
-    for child_token in program_iterator:
-        if child_token is token.end_token:
-            break
-        if child_token.operator is Operator.SYSCALL:
-            stack_size -= child_token.value + 1
-        else:
-            stack_size += stack_effect[child_token.operator]
-        stack_size = _check_push_count(child_token, program_iterator, stack_size)
-
-    assert stack_size == 0, f'Procedures should clean the stack {stack_size=}'
-
-    return stack_size
-
+            effect = token_stack_effect(token)
+            depth = None if effect is None else depth + effect
 
-def check_push_count(program):
-    """Checks the push count in the program."""
-    program_iterator = iter(program)
-    for token in program_iterator:
-        assert token.operator is Operator.PROCEDURE, 'The only top level tokens are procedures.'
-        _check_push_procedure(token, program_iterator)
+    return program
@@ -2,26 +2,27 @@
 """Module with the assembly implementation for each operator."""
 import sys
 import global_state
+import instrumentation
 from definitions import Token, Operator, PROCEDURE_PREFIX
 from parsing_utils import string_to_db
 from definitions import PROCEDURE_PREFIX
 
 
-def _ADD(self):
+def _ADD(token, program):
     return [
         '    pop     rax',
         '    pop     rbx',
         '    add     rax, rbx',
         '    push    rax'
     ]
-def _SUB(self):
+def _SUB(token, program):
     return [
         '    pop     rax',
         '    pop     rbx',
         '    sub     rbx, rax',
         '    push    rbx'
     ]
-def _MOD(self):
+def _MOD(token, program):
     return [
         '    xor     rdx, rdx',  # Clear rdx
         '    pop     rbx',
@@ -29,14 +30,14 @@ def _MOD(self):
         '    idiv    rbx',
         '    push    rdx',
     ]
-def _MUL(self):
+def _MUL(token, program):
     return [
         '    pop     rax',
         '    pop     rbx',
         '    imul     rax, rbx',
         '    push    rax'
     ]
-def _DIV(self):
+def _DIV(token, program):
     return [
         '    xor     rdx, rdx',  # Clear rdx
         '    pop     rbx',
@@ -44,11 +45,11 @@ def _DIV(self):
         '    idiv    rbx',
         '    push    rax'
     ]
-def _DROP(self):
+def _DROP(token, program):
     return [
         '    pop     rdi'
     ]
-def _ROT2(self):
+def _ROT2(token, program):
     return [
         '    pop     rax',
         '    pop     rbx',
@@ -56,7 +57,7 @@ def _ROT2(self):
         '    push    rbx',
     ]
 _SWAP = _ROT2
-def _DROT2(self):
+def _DROT2(token, program):
     return [
         # a b c d
         # c d a b
@@ -69,7 +70,7 @@ def _DROT2(self):
         '    push    rax',
         '    push    rbx',
     ]
-def _ROT3(self):
+def _ROT3(token, program):
     return [
         '    pop     rax',
         '    pop     rbx',
@@ -78,13 +79,13 @@ def _ROT3(self):
         '    push    rax',
         '    push    rcx',
     ]
-def _DUP(self):
+def _DUP(token, program):
     return [
         '    pop     rax',
         '    push    rax',
         '    push    rax'
     ]
-def _DUP2(self):
+def _DUP2(token, program):
     return [
         '    pop     rbx',
         '    pop     rax',
@@ -93,7 +94,7 @@ def _DUP2(self):
         '    push    rax',
         '    push    rbx'
     ]
-def _DUP3(self):
+def _DUP3(token, program):
     return [
         '    pop     rcx',
         '    pop     rbx',
@@ -105,74 +106,131 @@ def _DUP3(self):
         '    push    rbx',
         '    push    rcx',
     ]
-def _LOAD1(self):
+def _LOAD1(token, program):
     return [
         '    pop     rax',
         '    mov     rbx, 0',  # Clear rbx
         '    mov     bl, [rax]',  # Read one byte into rbx
         '    push    rbx',
     ]
-def _STORE1(self):
+def _STORE1(token, program):
     return [
         '    pop     rax',
         '    pop     rbx',
         '    mov     [rax], bl',  # Write one byte from rbx
     ]
-def _LOAD(self):
+def _LOAD(token, program):
     return [
         '    pop     rax',
         '    mov     rbx, 0',  # Clear rbx
         '    mov     rbx, [rax]',  # Read into rbx
         '    push    rbx',
     ]
-def _STORE(self):
+def _STORE(token, program):
     return [
         '    pop    rax',
         '    pop    rbx',
         '    mov    [rax], rbx',  # Write from rbx
     ]
-def _WHERE(self):
-    # TODO this can be way more efficient
-    global_state.symbols.extend(self.value)
-    inst = [f'    ;; {global_state.symbols}']
-    variables = self.value
-    for i, item in enumerate(variables):
-        length = len(variables) - 1
-        stack_location = (length - i) * 8
-        inst.extend([
-           f'    ;; Bind {item} {stack_location}',
-            '    mov     rax, rsp',
-           f'    add     rax, {stack_location}',  # rax has the address of the variable
-            '    mov     rcx, [symbols]',         # rcx points to the last free slot
-            '    mov     [rcx], rax',
-            '    add rcx, 8',                     # update symbols so it points
-            '    mov [symbols], rcx'              # to a free slot
-        ])
-    # print()
+def _MEMCPY(token, program):
+    # destination source length
+    return [
+        '    pop     rcx',
+        '    pop     rsi',
+        '    pop     rdi',
+        '    rep     movsb',
+    ]
+def _MEMSET(token, program):
+    # address byte length
+    return [
+        '    pop     rcx',
+        '    pop     rax',
+        '    pop     rdi',
+        '    rep     stosb',
+    ]
+def _MEMCMP(token, program):
+    # a b length -> 0 if they're equal, 1 if a is greater and -1 if it's smaller
+    return [
+        '    pop     rdx',
+        '    pop     rsi',
+        '    pop     rdi',
+        '    call    string_memcmp',
+        '    push    rax',
+    ]
+def _MEMCHR(token, program):
+    # address byte length -> address of the first byte, 0 if there's none
+    return [
+        '    pop     rdx',
+        '    pop     rsi',
+        '    pop     rdi',
+        '    call    string_memchr',
+        '    push    rax',
+    ]
+def _STRLEN(token, program):
+    # address -> bytes before the first 0
+    return [
+        '    pop     rdi',
+        '    call    string_strlen',
+        '    push    rax',
+    ]
+def _STRCMP(token, program):
+    # a b -> like memcmp, up to the first 0
+    return [
+        '    pop     rsi',
+        '    pop     rdi',
+        '    call    string_strcmp',
+        '    push    rax',
+    ]
+def _ALLOC(token, program):
+    # size -> address
+    return [
+        '    pop     rdi',
+        '    call    heap_alloc',
+        '    push    rax',
+    ]
+def _FREE(token, program):
+    return [
+        '    pop     rdi',
+        '    call    heap_free',
+    ]
+def _REALLOC(token, program):
+    # address size -> address
+    return [
+        '    pop     rsi',
+        '    pop     rdi',
+        '    call    heap_realloc',
+        '    push    rax',
+    ]
+def memory_address(token):
+    """The address a memory token pushes, constants added to it get folded in."""
+    if not global_state.memory_capacity:
+        raise RuntimeError(f'There is no static memory with --memory 0, but it is used at {token.where()}')
+    offset = token.value if isinstance(token.value, int) else 0
+    return f'memory + {offset}' if offset else 'memory'
+def variable_operand(token):
+    """Instructions to get to a resolved variable and the operand to access it."""
+    slot, offset = token.location
+    if slot is None:
+        return [], f'[rbp {offset:+}]'
+    # The variable was bound when the depth of the stack wasn't known
+    return [f'    mov     rcx, [rbp {slot:+}]'], f'[rcx {offset:+}]'
+def _WHERE(token, program):
+    inst = [f'    ;; Bind {" ".join(token.value)}']
+    if token.location is not None:
+        inst.append(f'    mov     [rbp {token.location:+}], rsp')
     return inst
-def _RETRIEVE(self):
-    i = global_state.symbols[::-1].index(self.value)
-    location = i * 8 + 8
-    return [
-       f'    ;; {global_state.symbols}',
-        '    mov     rcx, [symbols]',   # rcx points to the last free slot
-       f'    sub     rcx, {location}',  # rcx points to the variable
-        '    mov     rcx, [rcx]',
-        '    mov     rax, [rcx]',
-       f'    push    rax  ;; Push {self.value} onto the stack',
-    ]
-def _MUTATE(self):
-    i = global_state.symbols[::-1].index(self.value)
-    location = i * 8 + 8
-    return [
-         '    mov     rcx, [symbols]',
-        f'    sub     rcx, {location}',
-        f'    mov     rbx, [rcx]',
-         '    pop     rax',
-        f'    mov     [rbx], rax',
-         '    xor     rax, rax',
-    ]
-def _HARDPEEK(self):
+def _RETRIEVE(token, program):
+    inst, operand = variable_operand(token)
+    return inst + [
+       f'    mov     rax, {operand}',
+       f'    push    rax  ;; Push {token.value} onto the stack',
+    ]
+def _MUTATE(token, program):
+    inst, operand = variable_operand(token)
+    return ['    pop     rax'] + inst + [
+       f'    mov     {operand}, rax  ;; Store into {token.value}',
+    ]
+def _HARDPEEK(token, program):
     return [
         '    mov     rdi, [rsp]',
         '    call    peek',
@@ -183,17 +241,17 @@ def _HARDPEEK(self):
         '    mov     rdi, [rsp + 24]',
         '    call    peek',
     ]
-def _DEREFERENCE(self):
+def _DEREFERENCE(token, program):
     return [
         '   pop     rax',
         '   mov     rbx, [rax]',
         '   push    rbx',
     ]
-def _MEMORY(self):
+def _MEMORY(token, program):
     return [
-        '    push    memory',
+        f'    push    {memory_address(token)}',
     ]
-def _EQUAL(self):
+def _EQUAL(token, program):
     return [
         '    mov     rcx, FALSE',
         '    mov     rdx, TRUE',
@@ -203,7 +261,7 @@ def _EQUAL(self):
         '    cmove   rcx, rdx',
         '    push    rcx'
     ]
-def _NOT_EQUAL(self):
+def _NOT_EQUAL(token, program):
     return [
         '    mov     rcx, FALSE',
         '    mov     rdx, TRUE',
@@ -213,7 +271,7 @@ def _NOT_EQUAL(self):
         '    cmovne  rcx, rdx',
         '    push    rcx'
     ]
-def _LESS_THAN(self):
+def _LESS_THAN(token, program):
     return [
         '    mov     rcx, FALSE',
         '    mov     rdx, TRUE',
@@ -223,7 +281,7 @@ def _LESS_THAN(self):
         '    cmovl   rcx, rdx',
         '    push    rcx'
     ]
-def _GREATER_THAN(self):
+def _GREATER_THAN(token, program):
     return [
         '    mov     rcx, FALSE',
         '    mov     rdx, TRUE',
@@ -233,7 +291,7 @@ def _GREATER_THAN(self):
         '    cmovg   rcx, rdx',
         '    push    rcx'
     ]
-def _LESS_OR_EQUAL_THAN(self):
+def _LESS_OR_EQUAL_THAN(token, program):
     return [
         '    mov     rcx, FALSE',
         '    mov     rdx, TRUE',
@@ -243,7 +301,7 @@ def _LESS_OR_EQUAL_THAN(self):
         '    cmovle  rcx, rdx',
         '    push    rcx'
     ]
-def _GREATER_OR_EQUAL_THAN(self):
+def _GREATER_OR_EQUAL_THAN(token, program):
     return [
         '    mov     rcx, FALSE',
         '    mov     rdx, TRUE',
@@ -253,21 +311,21 @@ def _GREATER_OR_EQUAL_THAN(self):
         '    cmovge  rcx, rdx',
         '    push    rcx'
     ]
-def _AND(self):
+def _AND(token, program):
     return [
         '    pop     rax',
         '    pop     rbx',
         '    and     rax, rbx',
         '    push    rax'
     ]
-def _OR(self):
+def _OR(token, program):
     return [
         '    pop     rax',
         '    pop     rbx',
         '    or      rax, rbx',
         '    push    rax'
     ]
-def _NOT(self):
+def _NOT(token, program):
     return [
         '    mov     rbx, TRUE',
         '    pop     rax',
@@ -275,7 +333,7 @@ def _NOT(self):
         '    and     rax, rbx',
         '    push    rax'
     ]
-def _BOOL(self):
+def _BOOL(token, program):
     return [
         '    mov     rbx, FALSE',
         '    mov     rcx, TRUE',
@@ -284,214 +342,243 @@ def _BOOL(self):
         '    cmove   rcx, rbx',
         '    push    rcx'
     ]
-def _IF(self):
+# Condition codes for cmp a, b of the comparisons, and their opposites
+_CONDITIONS = {
+    Operator.EQUAL                : 'e',                                    # noqa e241
+    Operator.NOT_EQUAL            : 'ne',                                   # noqa e241
+    Operator.LESS_THAN            : 'l',                                    # noqa e241
+    Operator.GREATER_THAN         : 'g',                                    # noqa e241
+    Operator.LESS_OR_EQUAL_THAN   : 'le',                                   # noqa e241
+    Operator.GREATER_OR_EQUAL_THAN: 'ge',                                   # noqa e241
+}
+_NEGATED_CONDITIONS = {'e': 'ne', 'ne': 'e', 'l': 'ge', 'ge': 'l', 'g': 'le', 'le': 'g'}
+_BOOLEAN_CHAIN = {Operator.NOT, Operator.BOOL}
+def fused_condition(token, program):
+    """
+    Where the condition of a do starts and the condition code of it being TRUE.
+
+    A comparison followed by nots and bools, or just nots and bools, right
+    before a do are fused into it and compiled to a single branch. None when
+    there's nothing to fuse.
+    """
+    address = token.address
+    while address > 0 and program[address - 1].operator in _BOOLEAN_CHAIN:
+        address -= 1
+    if address > 0 and program[address - 1].operator in _CONDITIONS:
+        start = address - 1
+        condition = _CONDITIONS[program[start].operator]
+    elif address < token.address:
+        start = address
+        # bool is TRUE when the value isn't zero, not when its lowest bit is
+        condition = 'ne' if program[start].operator is Operator.BOOL else 'e'
+        address += 1
+    else:
+        return None
+
+    for chained in program[address:token.address]:
+        if chained.operator is Operator.NOT:
+            condition = _NEGATED_CONDITIONS[condition]
+    return start, condition
+def fused_into_do(token, program):
+    """Whether the code for the token is generated by a do after it."""
+    if token.operator not in _CONDITIONS and token.operator not in _BOOLEAN_CHAIN:
+        return False
+    address = token.address + 1
+    while address < len(program) and program[address].operator in _BOOLEAN_CHAIN:
+        address += 1
+    if address == len(program) or program[address].operator is not Operator.DO:
+        return False
+    return fused_condition(program[address], program)[0] <= token.address
+def branch_unless(condition, label):
+    """Jump to label when the condition code isn't met."""
+    return f'{"j" + _NEGATED_CONDITIONS[condition]:<8}{label}'
+def _IF(token, program):
     return [
         '',
         # '    pop     rax',
         # '    cmp     rax, TRUE',
-        # f'    jne     {self.end_token.label}'
+        # f'    jne     {program[token.end].label}'
     ]
-def _ELIF(self):
+def _ELIF(token, program):
     return [
-        f'    jmp     {self.end_token.label}',
-        f'{self.label}:'
+        f'    jmp     {program[token.end].label}',
+        f'{token.label}:'
     ]
-def _ELSE(self):
+def _ELSE(token, program):
     return [
-        f'    jmp     {self.end_token.label}',
-        f'{self.label}:'
+        f'    jmp     {program[token.end].label}',
+        f'{token.label}:'
     ]
-def _END(self):
-    start_token = self.start_token
-    assert start_token is not None
+def _END(token, program):
+    assert token.start is not None
+    start_token = program[token.start]
 
     if start_token.operator is Operator.IF or start_token.operator is Operator.ELSE:
         return [
-            f'{self.label}:'
+            f'{token.label}:'
         ]
-    elif start_token.operator is Operator.DO and start_token.start_token.operator is Operator.WHILE:
-        while_token = start_token.start_token
+    elif start_token.operator is Operator.DO and program[start_token.start].operator is Operator.WHILE:
+        while_token = program[start_token.start]
         assert while_token.operator is Operator.WHILE
-        return [
+        inst = instrumentation.loop_iteration(while_token) if global_state.instrument else []
+        return inst + [
             f'    jmp     {while_token.label}',
-            f'{self.label}:'
+            f'{token.label}:'
         ]
     elif start_token.operator is Operator.DO:
         return [
-            f'{self.label}:'
+            f'{token.label}:'
         ]
     elif start_token.operator is Operator.WHERE:
-        to_remove = len(start_token.value) * 8
-        for variable in start_token.value:
-            global_state.symbols.pop()
         return [
-            '    ;; Remove variables from the symbols table',
-            '    mov     rcx, [symbols]',
-           f'    sub     rcx, {to_remove}',
-            '    mov     [symbols], rcx'
-
+           f'    ;; Unbind {" ".join(start_token.value)}'
         ]
     elif start_token.operator is Operator.PROCEDURE:
+        inst = instrumentation.leave(start_token.value) if global_state.instrument else []
         if start_token.value == 'main':
-            return [
+            return inst + [
+                '    call    stdout_flush',
                 '    mov     rdi, 0   ;; EXIT',  # Set exit code to 0
                 '    mov     rax, SYS_EXIT',
                 '    syscall'
             ]
         else:
-            input_variables, return_variables = global_state.procedure_to_variables[start_token.value]
-            all_variables = return_variables + ['__return_address'] + input_variables
-            to_remove = len(all_variables)
-            for variable in all_variables:
-                global_state.symbols.pop()
-            return [
-                '    ;; Remove variables from the symbols table',
-                '    mov     rcx, [symbols]',
-               f'    sub     rcx, {to_remove * 8}',
-                '    mov     [symbols], rcx',
-                '    ;; Remove variables from the stack',
-               f'    add     rsp, {8 * len(input_variables)}',
+            return inst + [
+                '    leave   ;; Remove the input variables and the frame from the stack',
                 '    ret',
             ]
     else:
         raise RuntimeError('Could not process end token')
-def _WHILE(self):
-    return [
-        f'{self.label}:'
-    ]
-def _DO(self):
+def _WHILE(token, program):
+    return [
+        f'{token.label}:'
+    ]
+def _DO(token, program):
+    fused = fused_condition(token, program)
+    if fused is not None:
+        start, condition = fused
+        if program[start].operator in _CONDITIONS:
+            test = [
+                '    pop     rax',
+                '    pop     rbx',
+                '    cmp     rbx, rax',
+            ]
+        else:
+            test = [
+                '    pop     rax',
+               f'    test    rax, {"rax" if program[start].operator is Operator.BOOL else 1}',
+            ]
+        return test + [f'    {branch_unless(condition, program[token.end].label)}']
     return [
         '    mov     rcx, TRUE',
         '    pop     rax',
         '    cmp     rax, TRUE',
-       f'    jne     {self.end_token.label}'
+       f'    jne     {program[token.end].label}'
     ]
-def _STACK_REFERENCE(self):
+def _STACK_REFERENCE(token, program):
     return [
         '    push    rsp',
     ]
 
-#            [symbols]
 # STACK [var1, var2, addr]
-# STACK [ret1, ret2, ret3, addr, var1, var2]
-
-
-[]
-def _PROCEDURE(self):
-    input_variables, return_variables = global_state.procedure_to_variables[self.value]
-    original_variables = input_variables + ['__return_address']
-    input_variables = ['__return_address'] + input_variables
-    all_variables = return_variables + input_variables
-    global_state.symbols.extend(all_variables)
-    inst = [f'{self.label}:', f'    ;; {global_state.symbols}']
-    if self.value == 'main':
-        inst.extend([
-            '    ;; Setup the symbols table',
-            '    mov     rcx, symbols',
-            '    add     rcx, 8',
-            '    mov     [symbols], rcx'
-        ])
-    if self.value != 'main':
-        inst.extend(['    ;; Shift everything to make space for the address and return variables'])
-        inst.extend([
-           f'    ;; {self.value}',
-        ])
-        shift_amount = (len(return_variables) + 1) * 8
-        shift_back_amount = len(input_variables) * 8 - shift_amount
-        if len(input_variables) > 1:
-            for i, variable in enumerate(original_variables[::-1]):
-                inst.extend([
-                    f'    mov     rcx, [rsp {i * 8:+}]',
-                    f'    mov     [rsp {i * 8 - shift_amount:+}], rcx  ;; Move {variable} ahead',
-                ])
-            inst.extend([
-                   f'    mov     rcx, [rsp {-shift_amount:+}]',
-                   f'    mov     [rsp {shift_back_amount:+}], rcx  ;; Move return address back'
-            ])
-        else:
-            inst.extend([
-                '    mov     rcx, [rsp]  ;; Take the return address',  # Take the return address
-               f'    mov     [rsp {-len(return_variables) * 8:+}], rcx  ;; Move it forward making space for the return variables'
-            ])
-        inst.extend([
-               f'    sub     rsp, {shift_amount - 8}  ;; Resize the stack accordingly',
-        ])
-
+# STACK [ret1, ret2, ret3, addr, rbp, slot1, var1, var2]
 
 
-        for i, item in enumerate(all_variables):
-            length = len(all_variables) - 1
-            stack_location = (length - i) * 8
-            inst.extend([
-               f'    ;; Bind {item} {stack_location}',
-                '    mov     rax, rsp',
-               f'    add     rax, {stack_location}',  # rax has the address of the variable
-                '    mov     rcx, [symbols]',         # rcx points to the last free slot
-                '    mov     [rcx], rax',
-                # TODO Do this once after the whole for loop is finished
-                '    add     rcx, 8',                 # update symbols so it points
-                '    mov     [symbols], rcx'          # to a free slot
-            ])
+def _PROCEDURE(token, program):
+    inst = [f'{token.label}:']
+    if global_state.instrument:
+        inst.extend(instrumentation.enter(token.value))
+    if token.value == 'main':
         inst.extend([
-           f'    ;; {self.value}'
+            '    call    stdout_init',
+            '    mov     rbp, rsp',
         ])
+        if token.location:
+            inst.append(f'    sub     rsp, {token.location}  ;; Make space for the frame')
+        return inst
+
+    input_variables, return_variables = global_state.procedure_to_variables[token.value]
+    # Everything between the input and the return variables is the frame
+    shift_amount = len(return_variables) * 8 + token.location + 16
+    return_address = (len(input_variables) - len(return_variables) - 1) * 8
+    inst.extend([
+       f'    ;; {token.value}',
+        '    pop     rax  ;; Take the return address',
+    ])
+    for i, variable in enumerate(input_variables[::-1]):
+        inst.extend([
+            f'    mov     rcx, [rsp {i * 8:+}]',
+            f'    mov     [rsp {i * 8 - shift_amount:+}], rcx  ;; Move {variable} ahead',
+        ])
+    inst.extend([
+       f'    mov     [rsp {return_address:+}], rax  ;; Put the return address back',
+       f'    mov     [rsp {return_address - 8:+}], rbp',
+       f'    lea     rbp, [rsp {return_address - 8:+}]',
+       f'    sub     rsp, {shift_amount}  ;; Resize the stack accordingly',
+    ])
     return inst
-def _PROCEDURE_CALL(self):
+def _PROCEDURE_CALL(token, program):
     return [
-       f'    ;; {global_state.symbols}',
         '    xor     rax, rax',
-       f'    call    {self.value}',
+       f'    call    {token.value}',
     ]
-def _SYSCALL(self):
-    assert 0 <= self.value <= 5
+def _SYSCALL(token, program):
+    assert 0 <= token.value <= 5
     syscall_args = ['rdi', 'rsi', 'rdx', 'r10', 'r8', 'r9']
-    arguments = syscall_args[:self.value]
+    arguments = syscall_args[:token.value]
     start = [
         '',
         '    pop     rax',
     ]
     middle = [f'    pop     {arg}' for arg in arguments]
     end = [
-        '    syscall',
+        '    call    stdout_syscall',  # Writes to stdout are buffered
         '    push    rax'
     ]
     return start + middle + end
-def _PUSH_UINT(self):
+def _PUSH_UINT(token, program):
     return [
-        f'    push    {self.value}'
+        f'    push    {token.value}'
     ]
-def _PUSH_CHAR(self):
+def _PUSH_CHAR(token, program):
     return [
-        f'    push    {self.value}'
+        f'    push    {token.value}'
     ]
-def _PUSH_STRING(self):
-    if self not in global_state.add_symbols:
-        global_state.add_symbols.append(self)
+def _PUSH_STRING(token, program):
+    global_state.add_symbols.setdefault(token.label, token)  # Copies of a token share the label
     return [
-        f'    push    {self.length}',
-        f'    push    {self.label}'
+        f'    push    {token.length}',
+        f'    push    {token.label}'
     ]
 
 
 # TODO make this a bit more automatic
-def _MACRO(self):
+def _MACRO(token, program):
     raise RuntimeError('Macro operator reached assembly code')
-def _MACRO_EXPANSION(self):
+def _MACRO_EXPANSION(token, program):
     raise RuntimeError('Macro expansion operator reached assembly code')
-def _IMPORT(self):
+def _IMPORT(token, program):
     raise RuntimeError('Import operator reached assembly code')
-def _DEFINE(self):
+def _DEFINE(token, program):
     raise RuntimeError('Define operator reached assembly code')
+def _INLINE(token, program):
+    raise RuntimeError('Inline operator reached assembly code')
 
 
 def operator_to_implementation(operator):
-    this_module = sys.modules[__name__]
-    return getattr(this_module, '_' + operator.name)
+    return get_implementation(operator)
 
 
 def get_implementation(operator):
-    this_module = sys.modules[__name__]
-    return getattr(this_module, '_' + operator.name)
+    if operator not in _implementations:
+        raise RuntimeError(f'Operator {operator.name} has no implementation')
+    return _implementations[operator]
+
+
+# Every operator dispatches to the function named after it
+_implementations = {operator: getattr(sys.modules[__name__], '_' + operator.name)
+                    for operator in Operator
+                    if hasattr(sys.modules[__name__], '_' + operator.name)}
 
 
 def lexeme_to_operator(lexeme):
@@ -499,52 +586,52 @@ def lexeme_to_operator(lexeme):
     return lexeme_to_operator_dict[lexeme]
 
 
-def create_token_basic(operator, value, code_iterator, implementation):
-    token = Token(operator, value=value, implementation=implementation)
+def create_token_basic(operator, value, code_iterator):
+    token = Token(operator, value=value)
     return token
 
 
-def create_token_SWAP(operator, value, code_iterator, implementation):
-    return operator_to_token(Operator.ROT2, value, code_iterator, implementation)
+def create_token_SWAP(operator, value, code_iterator):
+    return operator_to_token(Operator.ROT2, value, code_iterator)
 
 
-def create_token_PUSH_STRING(operator, value, code_iterator, implementation):
+def create_token_PUSH_STRING(operator, value, code_iterator):
     value = value[1:-1]
     value, length = string_to_db(value)
     token = Token(Operator.PUSH_STRING,
                   value=value,
                   length=length,
-                  label=f'string_literal{global_state.string_literals}',
-                  implementation=implementation)
+                  label=f'string_literal{global_state.string_literals}')
     global_state.string_literals += 1
     return token
 
 
-def create_token_PUSH_CHAR(operator, value, code_iterator, implementation):
+def create_token_PUSH_CHAR(operator, value, code_iterator):
     value = bytes(value, 'ascii').decode('unicode_escape')
-    assert len(value) == 3, 'Expected item enclosed by single quotes to be a single character.'
+    if len(value) != 3:
+        raise RuntimeError('Expected item enclosed by single quotes to be a single character.')
     value = ord(value[1])
-    token = Token(operator, value=value, implementation=implementation)
+    token = Token(operator, value=value)
     return token
 
 
-def create_token_PUSH_UINT(operator, value, code_iterator, implementation):
+def create_token_PUSH_UINT(operator, value, code_iterator):
     value = int(value)
-    token = Token(operator, value=value, implementation=implementation)
+    token = Token(operator, value=value)
     return token
 
 
-def create_token_MUTATE(operator, value, code_iterator, implementation):
+def create_token_MUTATE(operator, value, code_iterator):
     value = value[1:]
-    token = Token(operator, value=value, implementation=implementation)
+    token = Token(operator, value=value)
     return token
 
 
-def create_token_PROCEDURE(operator, value, code_iterator, implementation):
+def create_token_PROCEDURE(operator, value, code_iterator):
     name = next(code_iterator)
     if name in global_state.procedures:
         raise RuntimeError(f'The procedure {name} was previously defined')
-    global_state.procedures.append(name)
+    global_state.procedures.add(name)
 
     variables = []
     return_variables = []
@@ -560,56 +647,58 @@ def create_token_PROCEDURE(operator, value, code_iterator, implementation):
         return_variables.append(variable)
 
     global_state.procedure_to_variables[name] = variables, return_variables
-    token = Token(Operator.PROCEDURE, value=name, implementation=implementation)
+    token = Token(Operator.PROCEDURE, value=name)
 
     return token
 
 
-def create_token_PROCEDURE_CALL(operator, value, code_iterator, implementation):
-    procedure_name = value
+def create_token_PROCEDURE_CALL(operator, value, code_iterator):
     value = f'{PROCEDURE_PREFIX}{value}'
-    token = Token(operator, value=value, implementation=implementation)
-    token.name = procedure_name
+    token = Token(operator, value=value)
     return token
 
 
-def create_token_IMPORT(operator, value, code_iterator, implementation):
+def create_token_IMPORT(operator, value, code_iterator):
     filename = next(code_iterator)
     global_state.imports[filename] = list()
     token = Token(Operator.MACRO, value=filename)
     return token
 
 
-def create_token_MACRO(operator, value, code_iterator, implementation):
+def create_token_MACRO(operator, value, code_iterator):
     value = next(code_iterator)
     global_state.macros[value] = list()
     token = Token(Operator.MACRO, value=value)
     return token
 
 
-def create_token_MACRO_EXPANSION(operator, value, code_iterator, implementation):
+def create_token_MACRO_EXPANSION(operator, value, code_iterator):
     assert value in global_state.macros, f'Unrecognized macro {value}'
     token = Token(Operator.MACRO_EXPANSION, value=value)
     return token
 
 
-def create_token_SYSCALL(operator, value, code_iterator, implementation):
+def create_token_SYSCALL(operator, value, code_iterator):
     value = int(value[-1])
-    token = Token(Operator.SYSCALL, value=value, implementation=implementation)
+    token = Token(Operator.SYSCALL, value=value)
     return token
 
 
-def create_token_WHERE(operator, value, code_iterator, implementation):
+def create_token_WHERE(operator, value, code_iterator):
     variables = []
     for variable in code_iterator:
         if variable == 'in':
             break
         variables.append(variable)
 
-    return Token(operator, value=variables, implementation=implementation)
+    return Token(operator, value=variables)
+
+
+# Operators without a create_token_<OPERATOR> function use create_token_basic
+_token_creators = {operator: getattr(sys.modules[__name__], 'create_token_' + operator.name, create_token_basic)
+                   for operator in Operator}
+
 
-def operator_to_token(operator, value, code_iterator, implementation):
-    this_module = sys.modules[__name__]
-    create_token = getattr(this_module, 'create_token_' + operator.name, create_token_basic)
-    return create_token(operator, value, code_iterator, implementation)
+def operator_to_token(operator, value, code_iterator):
+    return _token_creators[operator](operator, value, code_iterator)
 
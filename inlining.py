@@ -0,0 +1,139 @@
+"""
+Inlining of small procedures.
+
+Calls to procedures whose body is small enough, or that are marked inline, are
+replaced by that body. The inputs are bound with a where, the return variables
+get a slot each on top of them:
+
+    procedure name a b -- r in <body> end
+
+    name  ->  0 where a b r in <body> drop... r !a drop drop end
+
+What the body leaves on the stack is dropped and the return values are moved
+down to where the inputs were, the same thing the end of the procedure does.
+Recursive procedures and main are never inlined.
+
+It works on a referenced program and gives back the tokens without
+references, create_references has to run on them again.
+"""
+from copy import copy
+import global_state
+from definitions import Token, Operator, PROCEDURE_PREFIX, token_stack_inputs
+from grammar_checking import analyze_stack
+from call_graph import call_graph, reachable_procedures
+
+
+INLINE_THRESHOLD = 16  # Tokens in the body of a procedure that gets inlined without being marked
+
+
+def _recursive_procedures(graph: dict) -> set:
+    return {name for name, callees in graph.items()
+            if any(name in reachable_procedures(graph, callee) for callee in callees)}
+
+
+def _why_not_inline(program: list, procedure: Token, recursive: set):
+    """Reason the procedure can't be inlined, None if it can."""
+    if procedure.value == 'main':
+        return 'it is the main procedure'
+    if procedure.value in recursive:
+        return 'it is recursive'
+
+    body = program[procedure.address + 1:procedure.end]
+    _, return_variables = global_state.procedure_to_variables[procedure.value]
+    if return_variables and any(token.operator is Operator.STACK_REFERENCE for token in body):
+        return 'it looks at the stack with @ and has return variables on top of it'
+    if any(token.operator in {Operator.RETRIEVE, Operator.MUTATE} and token.value == '__return_address'
+           for token in body):
+        return 'it uses its return address'
+
+    # Inlined bodies can't see anything below their inputs and have to leave a known amount on the stack
+    if program[procedure.end].depth is None:
+        return 'what it leaves on the stack is not known at compile time'
+    if any(token.depth is not None and token.depth < token_stack_inputs(token) for token in body):
+        return 'it takes more from the stack than its inputs'
+    return None
+
+
+def _inlined_call(call: Token, procedure: Token, body: list, leftover: int) -> list:
+    """The tokens that replace a call to procedure."""
+    input_variables, return_variables = global_state.procedure_to_variables[procedure.value]
+    variables = input_variables + return_variables
+
+    def create(operator, value):
+        return Token(operator, value=value, position=call.position)
+
+    tokens = [create(Operator.PUSH_UINT, 0) for _ in return_variables]
+    if variables:
+        tokens.append(create(Operator.WHERE, variables))
+    tokens.extend(copy(token) for token in body)  # Blocks get linked through the tokens
+    tokens.extend(create(Operator.DROP, 'drop') for _ in range(leftover))
+    if variables:
+        # Moving them from the bottom up never overwrites one that wasn't moved yet
+        for variable, return_variable in zip(variables, return_variables):
+            if variable != return_variable:
+                tokens.extend([create(Operator.RETRIEVE, return_variable), create(Operator.MUTATE, variable)])
+        tokens.extend(create(Operator.DROP, 'drop') for _ in input_variables)
+        tokens.append(create(Operator.END, 'end'))
+    return tokens
+
+
+def inline_procedures(program: list, threshold: int = INLINE_THRESHOLD, verbose: bool = False) -> list:
+    """
+    Inline the calls to small procedures in a referenced program.
+
+    Procedures with at most threshold tokens in their body, once the calls in
+    it are inlined, are inlined everywhere. Procedures marked inline always are.
+    """
+    analyze_stack(program)
+    procedures = {token.value: token for token in program if token.operator is Operator.PROCEDURE}
+    recursive = _recursive_procedures(call_graph(program))
+    bodies = {}     # Name -> body with the calls in it inlined
+    inlinable = {}  # Name -> whether calls to it are inlined
+    inlined = {}    # Name -> calls to it that were inlined
+
+    def body(name: str) -> list:
+        if name not in bodies:
+            procedure = procedures[name]
+            bodies[name] = expand(program[procedure.address + 1:procedure.end])
+        return bodies[name]
+
+    def is_inlinable(name: str) -> bool:
+        if name not in inlinable:
+            reason = _why_not_inline(program, procedures[name], recursive)
+            if name in global_state.inline_procedures:
+                if reason is not None:
+                    raise RuntimeError(f'The procedure {name} is marked inline but {reason} '
+                                       f'at {procedures[name].where()}')
+                inlinable[name] = True
+            else:
+                inlinable[name] = reason is None and len(body(name)) <= threshold
+        return inlinable[name]
+
+    def expand(tokens: list) -> list:
+        expanded = []
+        for token in tokens:
+            name = token.value[len(PROCEDURE_PREFIX):] if token.operator is Operator.PROCEDURE_CALL else None
+            if name is None or not is_inlinable(name):
+                expanded.append(token)
+                continue
+            procedure = procedures[name]
+            expanded.extend(_inlined_call(token, procedure, body(name), program[procedure.end].depth))
+            inlined[name] = inlined.get(name, 0) + 1
+            if verbose:
+                print(f'{token.where()}: inlined {name}')
+        return expanded
+
+    result = []
+    address = 0
+    while address < len(program):
+        token = program[address]
+        if token.operator is Operator.PROCEDURE:
+            result.append(token)
+            result.extend(body(token.value))
+            address = token.end
+        result.append(program[address])
+        address += 1
+
+    if verbose:
+        print(f'inlined {sum(inlined.values())} calls to {len(inlined)} procedures')
+    return result
@@ -0,0 +1,168 @@
+"""
+Instrumented builds, for --instrument.
+
+Every procedure counts its calls and the cycles spent in it, read with rdtsc,
+in tables in .bss. Inclusive cycles include the procedures it calls, exclusive
+ones don't; a procedure that's already running when it gets called again, a
+recursive one, is counted once per call. With --instrument-loops every while
+also counts how many times its body ran.
+
+Before exiting, main writes the tables to stderr, one tab separated line per
+procedure and per loop. Programs that exit with a syscall of their own don't
+get the report.
+
+Inlined procedures are part of their callers, --inline-threshold 0 keeps the
+ones not marked inline as procedures of their own.
+"""
+import global_state
+
+
+STACK_CAPACITY = 8 * 1024 * 1024  # Bytes of the stack of running procedures, as big as the default stack
+
+
+def procedure_index(name: str) -> int:
+    return global_state.instrumented_procedures.setdefault(name, len(global_state.instrumented_procedures))
+
+
+def enter(name: str) -> list:
+    """Instructions at the start of a procedure, before it touches the stack."""
+    return [
+       f'    mov     rax, {procedure_index(name)}  ;; Instrument {name}',
+        '    call    instrument_enter',
+    ]
+
+
+def leave(name: str) -> list:
+    """Instructions at the end of a procedure, once the stack holds what it returns."""
+    inst = [
+       f'    mov     rax, {procedure_index(name)}  ;; Instrument {name}',
+        '    call    instrument_exit',
+    ]
+    if name == 'main':
+        inst.append('    call    instrument_report')
+    return inst
+
+
+def loop_iteration(token) -> list:
+    """Instructions at the end of the body of a while."""
+    if global_state.instrument != 'loops':
+        return []
+    index = global_state.instrumented_loops.setdefault(token.label, (len(global_state.instrumented_loops),
+                                                                     token.where()))[0]
+    return [f'    add     QWORD [instrument_loops + {index * 8}], 1']
+
+
+def _db(text: str) -> str:
+    return ', '.join(str(byte) for byte in text.encode())
+
+
+def _report_line(label: str, text: str, values: list) -> list:
+    """Write text and the values at the addresses in values, each one after a tab."""
+    inst = [
+       f'    mov     rsi, {label}',
+       f'    mov     rdx, {len(text.encode())}',
+        '    call    instrument_write',
+    ]
+    for i, value in enumerate(values):
+        inst.extend([
+           f'    mov     rdi, [{value}]',
+           f'    mov     rsi, {10 if i == len(values) - 1 else 9}',
+            '    call    instrument_write_uint',
+        ])
+    return inst
+
+
+def generate_runtime() -> list:
+    """The tables and routines of the instrumented procedures and loops, after their code was generated."""
+    procedures = global_state.instrumented_procedures
+    loops = sorted(global_state.instrumented_loops.values())
+
+    report = []
+    strings = []
+    lines = [('procedure\tcalls\tinclusive cycles\texclusive cycles\n', [])]
+    lines.extend((f'{name}\t', [f'instrument_calls + {index * 8}',
+                                f'instrument_inclusive + {index * 8}',
+                                f'instrument_exclusive + {index * 8}'])
+                 for name, index in procedures.items())
+    if global_state.instrument == 'loops':
+        lines.append(('loop\titerations\n', []))
+        lines.extend((f'{where}\t', [f'instrument_loops + {index * 8}']) for index, where in loops)
+    for i, (text, values) in enumerate(lines):
+        report.extend(_report_line(f'instrument_string{i}', text, values))
+        strings.extend(['', f'instrument_string{i}:', f'    db    {_db(text)}'])
+
+    return [
+        'segment .bss',
+        f'instrument_calls:     resb {8 * len(procedures)}',
+        f'instrument_inclusive: resb {8 * len(procedures)}',
+        f'instrument_exclusive: resb {8 * len(procedures)}',
+        f'instrument_loops:     resb {8 * len(loops)}',
+        # Start and cycles of the callees of every running procedure, after one for what called main
+        f'instrument_stack:     resb {16 + STACK_CAPACITY}',
+        'instrument_depth:     resb 8',
+        'segment .text',
+        '',
+        'instrument_enter:  ;; rax is the index of the procedure',
+        '    add     QWORD [instrument_calls + rax*8], 1',
+        '    rdtsc',
+        '    shl     rdx, 32',
+        '    or      rax, rdx',
+        '    mov     rcx, [instrument_depth]',
+        '    mov     [instrument_stack + rcx + 16], rax',
+        '    mov     QWORD [instrument_stack + rcx + 24], 0',
+        '    add     rcx, 16',
+        '    mov     [instrument_depth], rcx',
+        '    ret',
+        '',
+        'instrument_exit:  ;; rax is the index of the procedure',
+        '    mov     rsi, rax',
+        '    rdtsc',
+        '    shl     rdx, 32',
+        '    or      rax, rdx',
+        '    mov     rcx, [instrument_depth]',
+        '    sub     rcx, 16',
+        '    mov     [instrument_depth], rcx',
+        '    sub     rax, [instrument_stack + rcx + 16]',
+        '    add     [instrument_inclusive + rsi*8], rax',
+        '    add     [instrument_stack + rcx + 8], rax  ;; Part of what the caller calls',
+        '    sub     rax, [instrument_stack + rcx + 24]',
+        '    add     [instrument_exclusive + rsi*8], rax',
+        '    ret',
+        '',
+        'instrument_write:  ;; rsi is the address and rdx the length',
+        '    mov     rdi, 2',
+        '    mov     rax, SYS_WRITE',
+        '    syscall',
+        '    ret',
+        '',
+        'instrument_write_uint:  ;; rdi is the number and rsi the character after it',
+        '    mov     r9, -3689348814741910323',
+        '    sub     rsp, 40',
+        '    mov     [rsp+31], sil',
+        '    lea     rcx, [rsp+30]',
+        '.digit:',
+        '    mov     rax, rdi',
+        '    mul     r9',
+        '    shr     rdx, 3',
+        '    lea     rsi, [rdx+rdx*4]',
+        '    add     rsi, rsi',
+        '    mov     rax, rdi',
+        '    sub     rax, rsi',
+        '    add     eax, 48',
+        '    mov     BYTE [rcx], al',
+        '    sub     rcx, 1',
+        '    mov     rdi, rdx',
+        '    test    rdi, rdi',
+        '    jne     .digit',
+        '    lea     rsi, [rcx+1]',
+        '    lea     rdx, [rsp+32]',
+        '    sub     rdx, rsi',
+        '    call    instrument_write',
+        '    add     rsp, 40',
+        '    ret',
+        '',
+        'instrument_report:',
+        *report,
+        '    ret',
+        *strings,
+    ]
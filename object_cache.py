@@ -0,0 +1,47 @@
+"""
+On-disk cache of the objects of separately compiled files.
+
+With --separate every imported file is assembled to its own object, which
+lives in the .pyre_cache directory next to the file. Objects are named after a
+hash of their assembly, so nasm only runs again for a file when the code
+generated for it changed: the file itself, the macros it expands, the
+procedures of it the program uses, the compiler or its flags.
+"""
+from hashlib import sha256
+from pathlib import Path
+import os
+import subprocess
+from token_cache import CACHE_DIRECTORY
+
+
+def object_path(filename: str, assembly: str) -> Path:
+    """Where the object for the assembly generated for filename lives."""
+    path = Path(filename)
+    digest = sha256(assembly.encode()).hexdigest()[:16]
+    return path.parent / CACHE_DIRECTORY / f'{path.name}.{digest}.o'
+
+
+def assemble(filename: str, assembly: str) -> tuple:
+    """
+    Get the object for the assembly generated for filename.
+
+    Returns its path and whether nasm had to run.
+    """
+    object_file = object_path(filename, assembly)
+    if object_file.exists():
+        return object_file, False
+
+    object_file.parent.mkdir(exist_ok=True)
+    # Other builds may be assembling the same file, only finished objects get the final name
+    assembly_file = object_file.with_suffix(f'.{os.getpid()}.asm')
+    temporary_object = object_file.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        assembly_file.write_text(assembly)
+        res = subprocess.run(['nasm', '-felf64', assembly_file.as_posix(), '-o', temporary_object.as_posix()])
+        if res.returncode:
+            raise RuntimeError(f'Could not generate the object file for {filename}')
+        os.replace(temporary_object, object_file)
+    finally:
+        assembly_file.unlink(missing_ok=True)
+        temporary_object.unlink(missing_ok=True)
+    return object_file, True
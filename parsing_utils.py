@@ -1,4 +1,9 @@
 """Some utils to make parsing easier."""
+from contextlib import contextmanager
+from typing import Iterator
+import mmap
+import os
+import re
 
 
 def _string_to_db(stream: str) -> list:
@@ -35,50 +40,89 @@ def string_to_db(stream: str) -> str:
     return ','.join(vals_quoted) + ', 0', length + 1
 
 
-def read_until_sentinel(iterator, sentinel: str) -> str:
-    acc = ''
-    for item in iterator:
-        acc += item
-        if item == sentinel:
-            break
-    return acc
+class Lexeme(str):
+    """A lexeme that remembers where it came from."""
 
+    def __new__(cls, value: str, file: str, line: int, column: int):
+        obj = super().__new__(cls, value)
+        obj.file = file
+        obj.line = line
+        obj.column = column
+        return obj
 
-def remove_comments(stream: str) -> str:
-    """
-    Remove comments from a stream of code.
+    @property
+    def position(self) -> tuple:
+        return self.file, self.line, self.column
+
+    def __reduce__(self):
+        return Lexeme, (str(self), self.file, self.line, self.column)
 
-    Not the prettiest of solutions but it'll do
-    """
 
-    def remove_comment_from_line(line):
-        return line.split('#', maxsplit=1)[0]
+# A lexeme may start with a string or a char but can't have one in the middle.
+# [...] is part of the lexeme surrounding it and may contain spaces
+# (memory:uint8[cell 1 +]).
+# A lexeme ends on a space, a comment or the end of the source. Anything else
+# isn't a lexeme and falls through to the error group.
+_LEXEME_PIECE = rb"""\[[^\]]*\]|[^\s\["'#]"""
+_SCANNER = re.compile(
+    rb'(?P<newline>\n)'
+    rb'|(?P<comment>#[^\n]*)'
+    rb"""|(?P<lexeme>(?:"[^"]*"|'[^']*'|""" + _LEXEME_PIECE + rb')(?:' + _LEXEME_PIECE + rb')*(?=[\s#]|\Z))'
+    rb'|(?P<error>\S)'
+)
 
-    uncommented_lines = map(remove_comment_from_line, stream.split('\n'))
-    uncommented_code = '\n'.join(uncommented_lines)
-    return uncommented_code
 
+def scan(source, filename: str = '<string>', line: int = 1, column: int = 1) -> Iterator[Lexeme]:
+    """
+    Get the lexemes from a stream of code in a single pass.
 
-def pyre_split(stream: str) -> list:
+    The source can be anything bytes-like, including a memory map, so it is
+    never copied as a whole.
+    line and column are the position the source starts at.
+    """
+    if isinstance(source, str):
+        source = source.encode()
+
+    line_start = 1 - column
+    for match in _SCANNER.finditer(source):
+        kind = match.lastgroup
+        if kind == 'newline':
+            line += 1
+            line_start = match.end()
+        elif kind == 'lexeme':
+            start = match.start()
+            text = match.group()
+            yield Lexeme(text.decode(), filename, line, start - line_start + 1)
+
+            # Strings and [...] may span several lines
+            newlines = text.count(b'\n')
+            if newlines:
+                line += newlines
+                line_start = start + text.rindex(b'\n') + 1
+        elif kind == 'error':
+            start = match.start()
+            end = source.find(b'\n', start)
+            rest = bytes(source[start:end if end != -1 else len(source)]).decode()
+            raise ValueError(f'{filename}:{line}:{start - line_start + 1}: Could not scan {rest!r}')
+
+
+@contextmanager
+def open_source(filename: str):
+    """Memory map a source file."""
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:  # Empty files can't be mapped
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            yield source
+
+
+def scan_file(filename: str) -> Iterator[Lexeme]:
+    """Get the lexemes of a source file without reading it all into memory."""
+    with open_source(filename) as source:
+        yield from scan(source, filename)
+
+
+def pyre_split(stream: str, filename: str = '<string>') -> list:
     """Get a list of lexemes from a stream of code."""
-    # We add a space at the end to force the last item to be added
-    # Modern problems require modern solutions
-    stream = stream.strip() + ' '
-
-    items = []
-    acc = ''
-    stream_iterator = iter(stream)
-    for c in stream_iterator:
-        if c == '"' or c == "'":
-            assert acc == ''
-            acc = c + read_until_sentinel(stream_iterator, sentinel=c)
-        elif c == '[':
-            acc += c + read_until_sentinel(stream_iterator, sentinel=']')
-        elif c.isspace():
-            if acc != '':
-                items.append(acc)
-                acc = ''
-            continue
-        else:
-            acc += c
-    return items
+    return list(scan(stream, filename))
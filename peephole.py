@@ -0,0 +1,259 @@
+"""
+Peephole optimizer for the generated assembly.
+
+Every operator has a fixed template, so the code around the seams between
+templates is full of values pushed only to be popped right away. The assembly
+is parsed into a list of instructions and these rules are applied until none
+of them changes anything:
+
+push-pop
+    push X ... pop Y  ->  ... mov Y, X
+    Nothing at all when X is Y. The instructions in between can't touch the
+    stack, memory or the registers X is made of.
+dead-mov
+    mov R, A / mov R, B  ->  mov R, B
+    When B doesn't read R.
+jump-to-next
+    jmp L / L:  ->  L:
+    A jump to the label right after it.
+
+Labels stop every rule, nothing is moved across them.
+"""
+import re
+
+
+_REGISTER_FAMILIES = {
+    'rax': ('rax', 'eax', 'ax', 'ah', 'al'),
+    'rbx': ('rbx', 'ebx', 'bx', 'bh', 'bl'),
+    'rcx': ('rcx', 'ecx', 'cx', 'ch', 'cl'),
+    'rdx': ('rdx', 'edx', 'dx', 'dh', 'dl'),
+    'rsi': ('rsi', 'esi', 'si', 'sil'),
+    'rdi': ('rdi', 'edi', 'di', 'dil'),
+    'rbp': ('rbp', 'ebp', 'bp', 'bpl'),
+    'rsp': ('rsp', 'esp', 'sp', 'spl'),
+    **{f'r{i}': (f'r{i}', f'r{i}d', f'r{i}w', f'r{i}b') for i in range(8, 16)},
+}
+_REGISTERS = {name: family for family, names in _REGISTER_FAMILIES.items() for name in names}
+_REGISTER_PATTERN = re.compile(r'\b(' + '|'.join(sorted(_REGISTERS, key=len, reverse=True)) + r')\b')
+
+# Instructions that only write their first operand (and the flags)
+_SIMPLE_MNEMONICS = {'mov', 'movzx', 'xor', 'add', 'sub', 'and', 'or', 'imul', 'lea', 'cmp', 'test'}
+_COMPARISONS = {'cmp', 'test'}
+_PUSH_POP_WINDOW = 8  # Instructions looked at between a push and its pop
+
+_LABEL = re.compile(r'([A-Za-z_.$][\w.$]*):\s*(;.*)?')
+
+
+class Instruction:
+    """A line of assembly, a label or something the optimizer doesn't look into."""
+
+    __slots__ = ('label', 'mnemonic', 'operands', 'comment', 'text')
+
+    def __init__(self, mnemonic: str = None, operands: tuple = (), comment: str = '',
+                 label: str = None, text: str = None):
+        self.label = label
+        self.mnemonic = mnemonic
+        self.operands = operands
+        self.comment = comment
+        self.text = text  # The original line, None once the instruction was changed
+
+    def __repr__(self):
+        return f'Instruction({self.render()!r})'
+
+    def render(self) -> str:
+        if self.text is not None:
+            return self.text
+        line = f'    {self.mnemonic:<8}{", ".join(self.operands)}'
+        if self.comment:
+            line += f'  {self.comment}'
+        return line
+
+
+def _split_operands(operands: str) -> tuple:
+    result = []
+    depth = 0
+    quote = None
+    current = ''
+    for char in operands:
+        if quote:
+            quote = None if char == quote else quote
+        elif char in '\'"`':
+            quote = char
+        elif char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            result.append(current.strip())
+            current = ''
+            continue
+        current += char
+    if current.strip():
+        result.append(current.strip())
+    return tuple(result)
+
+
+def _split_comment(line: str) -> tuple:
+    quote = None
+    for i, char in enumerate(line):
+        if quote:
+            quote = None if char == quote else quote
+        elif char in '\'"`':
+            quote = char
+        elif char == ';':
+            return line[:i], line[i:]
+    return line, ''
+
+
+def parse(assembly: str) -> list:
+    """Split assembly into a list of instructions."""
+    instructions = []
+    for line in assembly.split('\n'):
+        stripped = line.strip()
+        label = _LABEL.fullmatch(stripped)
+        if label is not None:
+            instructions.append(Instruction(label=label.group(1), text=line))
+        elif not stripped or stripped.startswith(';') or not line[0].isspace():
+            instructions.append(Instruction(text=line))  # Directives and comments
+        else:
+            code, comment = _split_comment(line)
+            mnemonic, _, operands = code.strip().partition(' ')
+            instructions.append(Instruction(mnemonic.lower(), _split_operands(operands), comment.strip(), text=line))
+    return instructions
+
+
+def render(instructions: list) -> str:
+    return '\n'.join(instruction.render() for instruction in instructions)
+
+
+def count_instructions(instructions: list) -> int:
+    return sum(1 for instruction in instructions if instruction.mnemonic is not None)
+
+
+def _registers(operand: str) -> set:
+    return {_REGISTERS[name] for name in _REGISTER_PATTERN.findall(operand)}
+
+
+def _is_register(operand: str) -> bool:
+    return operand in _REGISTERS
+
+
+def _next_instruction(instructions: list, i: int) -> int:
+    """Index of the first instruction or label after i, len(instructions) if none."""
+    i += 1
+    while i < len(instructions) and instructions[i].mnemonic is None and instructions[i].label is None:
+        i += 1
+    return i
+
+
+def _is_simple(instruction: Instruction, protected: set) -> bool:
+    """Whether instruction leaves the stack, memory and the protected registers alone."""
+    mnemonic = instruction.mnemonic
+    if mnemonic is None or not (mnemonic in _SIMPLE_MNEMONICS or mnemonic.startswith('cmov')):
+        return False
+    if any('[' in operand for operand in instruction.operands) and mnemonic != 'lea':
+        return False
+    used = set().union(*(_registers(operand) for operand in instruction.operands))
+    if 'rsp' in used:
+        return False
+    if mnemonic in _COMPARISONS:
+        return True
+    return bool(instruction.operands) and not (_registers(instruction.operands[0]) & protected)
+
+
+def push_pop(instructions: list) -> tuple:
+    """push X ... pop Y -> ... mov Y, X"""
+    removed = 0
+    deleted = set()
+    for i, push in enumerate(instructions):
+        if push.mnemonic != 'push' or i in deleted:
+            continue
+        source = push.operands[0]
+        protected = _registers(source)
+
+        j = _next_instruction(instructions, i)
+        for _ in range(_PUSH_POP_WINDOW):
+            if j >= len(instructions) or j in deleted:
+                break
+            candidate = instructions[j]
+            if candidate.mnemonic == 'pop':
+                destination = candidate.operands[0]
+                if not _is_register(destination):
+                    break
+                deleted.add(i)
+                if destination == source:
+                    deleted.add(j)
+                    removed += 2
+                else:
+                    instructions[j] = Instruction('mov', (destination, source), candidate.comment or push.comment)
+                    removed += 1
+                break
+            if not _is_simple(candidate, protected):
+                break
+            j = _next_instruction(instructions, j)
+
+    return [instruction for i, instruction in enumerate(instructions) if i not in deleted], removed
+
+
+def dead_mov(instructions: list) -> tuple:
+    """mov R, A / mov R, B -> mov R, B"""
+    deleted = set()
+    for i, first in enumerate(instructions):
+        if first.mnemonic != 'mov' or first.operands[0] not in _REGISTER_FAMILIES:
+            continue
+        j = _next_instruction(instructions, i)
+        if j >= len(instructions):
+            continue
+        second = instructions[j]
+        if (second.mnemonic == 'mov' and second.operands[0] == first.operands[0]
+                and first.operands[0] not in _registers(second.operands[1])):
+            deleted.add(i)
+
+    return [instruction for i, instruction in enumerate(instructions) if i not in deleted], len(deleted)
+
+
+def jump_to_next(instructions: list) -> tuple:
+    """jmp L / L: -> L:"""
+    deleted = set()
+    for i, jump in enumerate(instructions):
+        if jump.mnemonic != 'jmp':
+            continue
+        j = _next_instruction(instructions, i)
+        while j < len(instructions) and instructions[j].label is not None:
+            if instructions[j].label == jump.operands[0]:
+                deleted.add(i)
+                break
+            j = _next_instruction(instructions, j)
+
+    return [instruction for i, instruction in enumerate(instructions) if i not in deleted], len(deleted)
+
+
+RULES = {
+    'push-pop': push_pop,
+    'dead-mov': dead_mov,
+    'jump-to-next': jump_to_next,
+}
+
+
+def optimize(instructions: list) -> tuple:
+    """
+    Apply the rules until none of them changes anything.
+
+    Returns the optimized instructions and how many instructions every rule
+    removed.
+    """
+    removed = {name: 0 for name in RULES}
+    changed = True
+    while changed:
+        changed = False
+        for name, rule in RULES.items():
+            instructions, count = rule(instructions)
+            removed[name] += count
+            changed = changed or count > 0
+    return instructions, removed
+
+
+def optimize_assembly(assembly: str) -> tuple:
+    """Like optimize but on assembly source."""
+    instructions, removed = optimize(parse(assembly))
+    return render(instructions), removed
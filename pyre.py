@@ -2,107 +2,191 @@
 """Pyre compiler."""
 import argparse
 from pathlib import Path
+from functools import partial
+from contextlib import redirect_stdout
+import io
+import multiprocessing
+import os
 import subprocess
+import sys
+import traceback
 from copy import copy
 from definitions import Token, Operator, lexeme_matches, get_type_size, PROCEDURE_PREFIX
 from definitions import get_load_instruction, get_store_instruction
-from implementations import operator_to_token, get_implementation
-from parsing_utils import pyre_split, remove_comments
-from grammar_checking import check_push_count
-from pprint import pprint
+from implementations import operator_to_token, get_implementation, fused_into_do
+from parsing_utils import Lexeme, scan, scan_file
+from grammar_checking import analyze_stack
 import global_state
-
-
-MEM_CAPACITY = 1024 * 1024  # 1 MiB I hope that's enough
-SYMBOLS_TABLE_SIZE = 512  # 64 symbols of 8 bytes each
+import token_cache
+import object_cache
+import assembler
+import watch
+import instrumentation
+import allocator
+import strings
+import peephole
+import register_stack
+from constant_folding import fold_constants
+from call_graph import remove_dead_procedures
+from inlining import inline_procedures, INLINE_THRESHOLD
+from register_stack import RegisterStack
+from timings import Timings
+
+
+STDOUT_CAPACITY = 64 * 1024  # Bytes written to stdout that are kept until a flush
 
 # TODO make sure I don't redefine constants
 
 # TODO tag macro expansions so we know where they start and end
 
 
-def tokenize(program: str) -> list:
-    """Convert the program into a stream of tokens."""
-    program = remove_comments(program)
+def tokenize_file(filename: str) -> list:
+    """Convert a source file into a stream of tokens."""
+    return tokenize(scan_file(filename))
+
+
+def import_file(filename: str) -> list:
+    """Get the tokens of an imported file, nothing if it was already imported."""
+    if filename in global_state.imports:  # Nothing should be imported more than once
+        return []
+
+    if not global_state.use_token_cache:
+        tokens = tokenize_file(filename)
+        global_state.imports.append(filename)
+        return tokens
+
+    # The entry depends on what is known before tokenizing the file
+    entry_path = token_cache.entry_path(filename)
+    entry = token_cache.load(entry_path, filename)
+    if entry is not None:
+        tokens = []
+        for item in token_cache.replay(entry):
+            if isinstance(item, Token):
+                tokens.append(item)
+            else:
+                tokens.extend(import_file(item))
+    else:
+        already_imported = len(global_state.imports)
+        imports = []
+        tokens = tokenize(scan_file(filename), imports=imports)
+        token_cache.store(entry_path, filename, tokens, imports, global_state.imports[already_imported:])
+
+    global_state.imports.append(filename)
+    return tokens
+
+
+def tokenize(program, filename: str = '<string>', imports: list = None) -> list:
+    """
+    Convert the program into a stream of tokens.
+
+    The program is either source code or the lexemes of it.
+    If imports is given a (start, end, filename) item is appended to it for
+    every import, tokens[start:end] being the imported tokens.
+    """
     tokens = []
 
-    code_iterator = iter(pyre_split(program))
+    if isinstance(program, (str, bytes)):
+        program = scan(program, filename)
+    code_iterator = iter(program)
     for item in code_iterator:
-        # TODO add support for floats
-
-        value = item
-        operator = lexeme_matches(item)
-
-        # Here we handle tokens that are instructions to the lexer and not the
-        # program
-        if operator is Operator.IMPORT:
-            # This is special we don't want a lexeme
-            # We want to execute something right away
-            # Now this is the funny part
-            # We can edit the iterator, getting the operators this function
-            filename = next(code_iterator)
-            assert filename.startswith('"')
-            assert filename.endswith('"')
-            filename = filename[1:-1] + '.pyre'
-            if filename not in global_state.imports:  # Nothing should be imported more than once
-                with open(filename, 'r') as imported_library:
-                    imported_code = imported_library.read()
-                tokens.extend(tokenize(imported_code))
-                global_state.imports.append(filename)
-            continue
-        elif operator is Operator.DEFINE:
-            name = next(code_iterator)
-            value = next(code_iterator)
-            macro_code = f'macro {name} {value} end'
-            tokens.extend(tokenize(macro_code))
-            continue
-        elif operator is Operator.AUTOINCREMENT:
-            value = item[:-2]
-            tokens.extend(tokenize(f'{value} 1 + !{value}'))
-            continue
-        elif operator is Operator.AUTODECREMENT:
-            value = item[:-2]
-            tokens.extend(tokenize(f'{value} 1 - !{value}'))
-            continue
-        elif operator is Operator.WRITE_TO:
-            match = operator.value.fullmatch(item)
-
-            address, type_annotation, value = match.groups()
-
-            type_annotation = type_annotation if type_annotation is not None else '1'
-            value = value if value != '' else 0
-            value *= get_type_size(type_annotation)
-
-            store_instruction = get_store_instruction(type_annotation)
-
-            tokens.extend(tokenize(f'{address} {value} + {store_instruction}'))
-            continue
-        elif operator is Operator.DEREFERENCE:
-            match = operator.value.fullmatch(item)
-
-            address, type_annotation, value = match.groups()
-
-            type_annotation = type_annotation if type_annotation is not None else '1'
-            value = value if value != '' else 0
-            value *= get_type_size(type_annotation)
-            load_instruction = get_load_instruction(type_annotation)
-
-            tokens.extend(tokenize(f'{address} {value} + {load_instruction}'))
-
-            continue
-
-        implementation = get_implementation(operator)
-        token = operator_to_token(operator, value, code_iterator, implementation)
-        assert Token is not None
+        lower_lexeme(item, code_iterator, tokens, imports)
 
-        tokens.append(token)
+    return tokens
 
-    # Inject the address in each token
-    # Now this is not needed anymore
-    for i, token in enumerate(tokens):
-        token.address = i
 
-    return tokens
+def create_token(operator: Operator, lexeme: Lexeme, code_iterator=None) -> Token:
+    """Create the token for a lexeme of a known operator."""
+    if code_iterator is None:
+        code_iterator = iter(())
+    token = operator_to_token(operator, lexeme, code_iterator)
+    token.position = lexeme.position
+    return token
+
+
+def lower_lexeme(item: Lexeme, code_iterator, tokens: list, imports: list = None):
+    """
+    Append the tokens for a lexeme to tokens.
+
+    Whatever the lexeme needs after it (names, variables, ...) is taken from
+    code_iterator.
+    Syntactic sugar is lowered straight into the tokens it stands for.
+    """
+    # TODO add support for floats
+
+    def sublexeme(value: str) -> Lexeme:
+        return Lexeme(value, *item.position)
+
+    operator = lexeme_matches(item)
+
+    # Here we handle tokens that are instructions to the lexer and not the
+    # program
+    if operator is Operator.IMPORT:
+        # This is special we don't want a lexeme
+        # We want to execute something right away
+        # Now this is the funny part
+        # We can edit the iterator, getting the operators this function
+        filename = next(code_iterator)
+        assert filename.startswith('"')
+        assert filename.endswith('"')
+        filename = filename[1:-1] + '.pyre'
+        start = len(tokens)
+        tokens.extend(import_file(filename))
+        if imports is not None:
+            imports.append((start, len(tokens), filename))
+    elif operator is Operator.INLINE:
+        # inline procedure <name> ... in
+        keyword = next(code_iterator)
+        if keyword != Operator.PROCEDURE.value:
+            raise RuntimeError('Expected a procedure after inline at {}:{}:{}'.format(*item.position))
+        token = create_token(Operator.PROCEDURE, keyword, code_iterator)
+        global_state.inline_procedures.add(token.value)
+        tokens.append(token)
+    elif operator is Operator.DEFINE:
+        # macro <name> <value> end
+        name = next(code_iterator)
+        value = next(code_iterator)
+        tokens.append(create_token(Operator.MACRO, sublexeme('macro'), iter([name])))
+        lower_lexeme(value, iter(()), tokens, imports)
+        tokens.append(create_token(Operator.END, sublexeme('end')))
+    elif operator in {Operator.AUTOINCREMENT, Operator.AUTODECREMENT}:
+        # <variable> 1 +|- !<variable>
+        variable = item[:-2]
+        lower_lexeme(sublexeme(variable), iter(()), tokens, imports)
+        tokens.append(create_token(Operator.PUSH_UINT, sublexeme('1')))
+        if operator is Operator.AUTOINCREMENT:
+            tokens.append(create_token(Operator.ADD, sublexeme('+')))
+        else:
+            tokens.append(create_token(Operator.SUB, sublexeme('-')))
+        lower_lexeme(sublexeme(f'!{variable}'), iter(()), tokens, imports)
+    elif operator in {Operator.WRITE_TO, Operator.DEREFERENCE}:
+        # <address> <index> <size> * + store|load
+        match = operator.value.fullmatch(item)
+
+        address, type_annotation, index = match.groups()
+
+        type_annotation = type_annotation if type_annotation is not None else '1'
+        size = get_type_size(type_annotation)
+        if operator is Operator.WRITE_TO:
+            instruction = get_store_instruction(type_annotation)
+        else:
+            instruction = get_load_instruction(type_annotation)
+
+        lower_lexeme(sublexeme(address), iter(()), tokens, imports)
+        if index == '' or index.isdigit():
+            offset = int(index or 0) * size
+            tokens.append(create_token(Operator.PUSH_UINT, sublexeme(str(offset))))
+        else:
+            # The index is an expression that hasn't been lexed yet
+            index_lexemes = scan(index, item.file, item.line, item.column + match.start(3))
+            for index_item in index_lexemes:
+                lower_lexeme(index_item, index_lexemes, tokens, imports)
+            if size != 1:
+                tokens.append(create_token(Operator.PUSH_UINT, sublexeme(str(size))))
+                tokens.append(create_token(Operator.MUL, sublexeme('*')))
+        tokens.append(create_token(Operator.ADD, sublexeme('+')))
+        tokens.append(create_token(Operator(instruction), sublexeme(instruction)))
+    else:
+        tokens.append(create_token(operator, item, code_iterator))
 
 
 def load_macros(program: list) -> list:
@@ -152,7 +236,8 @@ def load_macros(program: list) -> list:
             if start_token.operator is Operator.MACRO:
                 in_macro_end = True
         elif token.operator is Operator.MACRO:
-            assert not in_macro, f'Cannot nest macros: {token.value} inside {current_macro}'
+            if in_macro:
+                raise RuntimeError(f'Cannot nest macros: {token.value} inside {current_macro} at {token.where()}')
             current_macro = token.value
             in_macro = True
 
@@ -172,21 +257,53 @@ def load_macros(program: list) -> list:
     return resulting_program
 
 
-def expand_macros(program: list) -> list:
-    """Expand the macros in the program."""
-    expanded_program = []
+def expand_macros(program: list, timings: Timings = None) -> list:
+    """
+    Expand the macros in the program.
+
+    Every macro is expanded once, each use gets its own copy of that expansion.
+    If timings is given the expansions, the ones nested in macros included, are
+    counted in it.
+    """
+    expansions = {}
+    nested = {}  # Name -> expansions inside the expansion of the macro
+    count = 0
+
+    def expansion(name: str) -> list:
+        """Get the fully expanded body of a macro, nested macros included."""
+        if name not in expansions:
+            expansions[name] = None  # Being expanded
+            expansions[name], nested[name] = expand(global_state.macros[name])
+        elif expansions[name] is None:
+            raise RuntimeError(f'The macro {name} expands to itself')
+        return expansions[name]
+
+    def expand(tokens: list) -> tuple:
+        expanded_tokens = []
+        count = 0
+        for token in tokens:
+            if token.operator is Operator.MACRO_EXPANSION:
+                expanded_tokens.extend(expansion(token.value))
+                count += 1 + nested[token.value]
+            elif token.operator is Operator.MACRO:
+                raise RuntimeError('The program should not have any remaining macro definitions.')
+            else:
+                expanded_tokens.append(token)
+        return expanded_tokens, count
 
+    expanded_program = []
     for token in program:
-        value = token.value
-
         if token.operator is Operator.MACRO_EXPANSION:
-            expanded_macro = expand_macros(global_state.macros[value])
-            expanded_program.extend([copy(token).bind_methods() for token in expanded_macro])
+            # Blocks get linked through the tokens so each use needs its own
+            expanded_program.extend([copy(token) for token in expansion(token.value)])
+            count += 1 + nested[token.value]
         elif token.operator is Operator.MACRO:
             raise RuntimeError('The program should not have any remaining macro definitions.')
         else:
             expanded_program.append(token)
 
+    if timings is not None:
+        timings.count('macro_expansions', count)
     return expanded_program
 
 
@@ -198,11 +315,13 @@ def create_references(program: list) -> list:
 
     variables = []
 
-    for token in program:
+    for address, token in enumerate(program):
+        token.address = address
         value = token.value
 
         if token.operator is Operator.RETRIEVE:
-            assert token.value in variables, f'Unexpeted variable {token.value}'
+            if token.value not in variables:
+                raise RuntimeError(f'Unexpeted variable {token.value} at {token.where()}')
 
         assert token.operator not in {Operator.MACRO, Operator.MACRO_EXPANSION}
 
@@ -212,7 +331,6 @@ def create_references(program: list) -> list:
                 token.label = '_start'
             else:
                 token.label = f'{PROCEDURE_PREFIX}{value}'
-            token.block = block
             block += 1
 
             input_variables, return_variables = global_state.procedure_to_variables[token.value]
@@ -230,34 +348,37 @@ def create_references(program: list) -> list:
             token.label = f'elif{block}'
             block += 1
 
-            start_token = stack.pop()
-            assert start_token.operator is Operator.DO
+            start_token = stack.pop() if stack else None
+            if start_token is None or start_token.operator is not Operator.DO:
+                raise RuntimeError(f'Unexpected {token.operator.name.lower()} at {token.where()}')
 
-            token.start_token = start_token
-            start_token.end_token = token
+            token.start = start_token.address
+            start_token.end = token.address
 
             stack.append(token)  # Needs a do
         elif token.operator is Operator.ELSE:
             token.label = f'else{block}'
             block += 1
 
-            start_token = stack.pop()
-            assert start_token.operator is Operator.DO
+            start_token = stack.pop() if stack else None
+            if start_token is None or start_token.operator is not Operator.DO:
+                raise RuntimeError(f'Unexpected {token.operator.name.lower()} at {token.where()}')
 
-            token.start_token = start_token
-            start_token.end_token = token
+            token.start = start_token.address
+            start_token.end = token.address
 
             stack.append(token)  # Needs an end
         elif token.operator is Operator.DO:
-            start_token = stack.pop()
-            assert start_token.operator in {Operator.WHILE,
-                                            Operator.IF,
-                                            Operator.ELIF}
+            start_token = stack.pop() if stack else None
+            if start_token is None or start_token.operator not in {Operator.WHILE,
+                                                                   Operator.IF,
+                                                                   Operator.ELIF}:
+                raise RuntimeError(f'Unexpected do at {token.where()}')
 
-            start_token.end_token = token
+            start_token.end = token.address
 
             # We'll propagate this to the end
-            token.start_token = start_token
+            token.start = start_token.address
 
             stack.append(token)  # Needs an end an elif or an else
         elif token.operator is Operator.WHERE:
@@ -268,16 +389,17 @@ def create_references(program: list) -> list:
             token.label = f'end{block}'
             block += 1
 
-            start_token = stack.pop()
-            assert start_token.operator in {Operator.ELSE,
-                                            Operator.DO,
-                                            Operator.PROCEDURE,
-                                            Operator.WHERE}
+            start_token = stack.pop() if stack else None
+            if start_token is None or start_token.operator not in {Operator.ELSE,
+                                                                   Operator.DO,
+                                                                   Operator.PROCEDURE,
+                                                                   Operator.WHERE}:
+                raise RuntimeError(f'Unexpected end at {token.where()}')
 
             # FIXME: This is really ugly.
             #        I think it's better to keep track of the block type inside
             #        the token itself
-            if_block = start_token.operator is Operator.DO and start_token.start_token.operator in {Operator.IF, Operator.ELIF}
+            if_block = start_token.operator is Operator.DO and program[start_token.start].operator in {Operator.IF, Operator.ELIF}
             if_block = if_block or start_token.operator is Operator.ELSE
 
             if start_token.operator is Operator.WHERE:
@@ -297,39 +419,137 @@ def create_references(program: list) -> list:
                                            Operator.DO,
                                            Operator.ELSE}
                     if st.operator in {Operator.ELIF, Operator.ELSE}:
-                        st.end_token = token
+                        st.end = token.address
                     if st.operator is Operator.IF:
                         break
-                    st = st.start_token
+                    st = program[st.start]
 
-            token.start_token = start_token
-            start_token.end_token = token
+            token.start = start_token.address
+            start_token.end = token.address
 
         referenced_program.append(token)
 
+    for token in stack:
+        if token.operator is Operator.PROCEDURE:
+            raise RuntimeError(f'The procedure {token.value} has no matching in or end at {token.where()}')
+        raise RuntimeError(f'Missing end for {token.operator.name.lower()} at {token.where()}')
+
     return referenced_program
 
 
-def generate_instruction(token: Token):
+def _resolve_procedure(program: list, procedure: Token):
+    start, end = procedure.address + 1, procedure.end
+
+    # Bindings made where the depth isn't known save rsp in a slot under rbp
+    slots = sum(1 for address in range(start, end)
+                if program[address].operator is Operator.WHERE and program[address].depth is None)
+    procedure.location = slots * 8
+
+    scope = {}
+
+    def bind(variable, location):
+        scope.setdefault(variable, []).append(location)
+
+    # STACK [ret1, ret2, addr, rbp, slot1, slot2, var1, var2]
+    input_variables, return_variables = global_state.procedure_to_variables[procedure.value]
+    if procedure.value == 'main':
+        if input_variables or return_variables:
+            raise RuntimeError(f'The main procedure can not take or return values at {procedure.where()}')
+    else:
+        bind('__return_address', (None, 8))
+        for i, variable in enumerate(return_variables):
+            bind(variable, (None, (len(return_variables) - i + 1) * 8))
+        for i, variable in enumerate(input_variables):
+            bind(variable, (None, -(slots + 1 + i) * 8))
+    body = -(slots + len(input_variables)) * 8  # Where rsp is when the body starts
+
+    slot = 0
+    for address in range(start, end):
+        token = program[address]
+        if token.operator is Operator.WHERE:
+            variables = token.value
+            if token.depth is None:
+                slot += 1
+                token.location = -slot * 8
+                for i, variable in enumerate(variables):
+                    bind(variable, (token.location, (len(variables) - 1 - i) * 8))
+            else:
+                top = body - token.depth * 8
+                for i, variable in enumerate(variables):
+                    bind(variable, (None, top + (len(variables) - 1 - i) * 8))
+        elif token.operator is Operator.END and program[token.start].operator is Operator.WHERE:
+            for variable in program[token.start].value:
+                scope[variable].pop()
+        elif token.operator in {Operator.RETRIEVE, Operator.MUTATE}:
+            if not scope.get(token.value):
+                raise RuntimeError(f'Unexpected variable {token.value} at {token.where()}')
+            token.location = scope[token.value][-1]
+
+
+def resolve_variables(program: list) -> list:
+    """
+    Give every variable a fixed place in the frame of its procedure.
+
+    Procedures point rbp to their frame, so reading or writing a variable is a
+    single access relative to it. The depths from analyze_stack tell where the
+    variables bound with where are.
+    """
+    address = 0
+    while address < len(program):
+        token = program[address]
+        if token.operator is Operator.PROCEDURE:
+            _resolve_procedure(program, token)
+            address = token.end
+        elif token.operator in {Operator.WHERE, Operator.RETRIEVE, Operator.MUTATE}:
+            raise RuntimeError(f'Variables can only be used inside procedures at {token.where()}')
+        address += 1
+
+    return program
+
+
+def generate_instruction(token: Token, program: list):
     """Generate assembly for a single token"""
-    assembly = token.implementation()
+    if fused_into_do(token, program):
+        return '    ;; Fused into the next do'
+    implementation = get_implementation(token.operator)
+    assembly = implementation(token, program)
 
     return '\n'.join(assembly)
 
 
-def generate_assembly(program: list):
-    """Generate assembly for a Pyre program."""
-    assembly = [
-        r'%define SYS_EXIT 60',
-        r'%define SYS_WRITE 1',
-        r'%define STD_OUT 1',
-        r'%define TRUE 1',
-        r'%define FALSE 0',
-        'global _start',
-
+# Assembler macros, every object needs its own copy
+ASSEMBLY_DEFINES = [
+    r'%define SYS_EXIT 60',
+    r'%define SYS_WRITE 1',
+    r'%define SYS_MMAP 9',
+    r'%define SYS_MUNMAP 11',
+    r'%define SYS_IOCTL 16',
+    r'%define SYS_MREMAP 25',
+    r'%define SYS_MADVISE 28',
+    r'%define TCGETS 0x5401',
+    r'%define STD_OUT 1',
+    r'%define TRUE 1',
+    r'%define FALSE 0',
+]
+
+
+def runtime_symbols() -> list:
+    """What the generated code uses from the runtime."""
+    symbols = ['peek', 'stdout_init', 'stdout_flush', 'stdout_syscall', 'heap_alloc', 'heap_free', 'heap_realloc',
+               'string_strlen', 'string_memchr', 'string_memcmp', 'string_strcmp']
+    return ['memory'] + symbols if global_state.memory_capacity else symbols
+
+
+def generate_runtime() -> list:
+    """The memory and the routines the generated code uses."""
+    memory = [f'memory:   resb {global_state.memory_capacity}'] if global_state.memory_capacity else []
+    return allocator.generate_runtime() + strings.generate_runtime() + [
         'segment .bss',
-        f'memory:   resb {MEM_CAPACITY}',
-        f'symbols:   resb {SYMBOLS_TABLE_SIZE}',
+        *memory,
+        f'stdout_buffer:   resb {STDOUT_CAPACITY}',
+        'stdout_used:     resb 8',
+        'stdout_is_tty:   resb 8',
+        'stdout_termios:  resb 64',
 
         'segment .text',
 
@@ -366,77 +586,443 @@ def generate_assembly(program: list):
         '    lea     rsi, [rsp+32+rdx]',
         '    mov     rdx, r8',
         '    mov     rax, SYS_WRITE',
-        '    syscall',
+        '    call    stdout_syscall',
         '    add     rsp, 40',
         '    ret',
         '',
+
+        # Buffered stdout
+        # Writes to stdout are kept in stdout_buffer until it's full, until
+        # a newline if stdout is a terminal, until any other syscall or until
+        # main ends. Every syscall goes through stdout_syscall.
+        'stdout_init:  ;; Find out if stdout is a terminal',
+        '    mov     rax, SYS_IOCTL',
+        '    mov     rdi, STD_OUT',
+        '    mov     rsi, TCGETS',
+        '    mov     rdx, stdout_termios',
+        '    syscall',
+        '    xor     ecx, ecx',
+        '    test    rax, rax',
+        '    sete    cl',
+        '    mov     [stdout_is_tty], rcx',
+        '    ret',
+        '',
+        'stdout_flush:  ;; Write what the buffer holds, every register is kept',
+        '    cmp     QWORD [stdout_used], 0',
+        '    je      .empty',
+        '    push    rax',
+        '    push    rcx',
+        '    push    rdx',
+        '    push    rsi',
+        '    push    rdi',
+        '    push    r11',
+        '    mov     rsi, stdout_buffer',
+        '    mov     rdx, [stdout_used]',
+        '.write:',
+        '    mov     rax, SYS_WRITE',
+        '    mov     rdi, STD_OUT',
+        '    syscall',
+        '    test    rax, rax',
+        '    jle     .written  ;; Nothing else can be done about an error',
+        '    add     rsi, rax',
+        '    sub     rdx, rax',
+        '    jne     .write',
+        '.written:',
+        '    mov     QWORD [stdout_used], 0',
+        '    pop     r11',
+        '    pop     rdi',
+        '    pop     rsi',
+        '    pop     rdx',
+        '    pop     rcx',
+        '    pop     rax',
+        '.empty:',
+        '    ret',
+        '',
+        'stdout_syscall:  ;; The syscall in rax, writes to stdout go to the buffer',
+        '    cmp     rax, SYS_WRITE',
+        '    jne     .other',
+        '    cmp     rdi, STD_OUT',
+        '    jne     .other',
+        '    mov     rax, [stdout_used]',
+        '    add     rax, rdx',
+        f'    cmp     rax, {STDOUT_CAPACITY}',
+        '    jbe     .append',
+        '    call    stdout_flush',
+        f'    cmp     rdx, {STDOUT_CAPACITY}',
+        '    jbe     .append',
+        '    mov     rax, SYS_WRITE  ;; Bigger than the buffer, it goes straight out',
+        '    syscall',
+        '    ret',
+        '.append:',
+        '    mov     rax, rdx  ;; What write returns',
+        '    mov     rcx, rdx',
+        '    mov     rdi, [stdout_used]',
+        '    add     [stdout_used], rdx',
+        '    lea     rdi, [stdout_buffer + rdi]',
+        '    rep     movsb',
+        '    cmp     QWORD [stdout_is_tty], 0',
+        '    je      .done',
+        '    mov     rcx, rdx  ;; Look for a newline in what was just added',
+        '    sub     rdi, rdx',
+        '    mov     rsi, rax',
+        '    mov     al, 10',
+        '    repne   scasb',
+        '    mov     rax, rsi',
+        '    jne     .done',
+        '    call    stdout_flush',
+        '.done:',
+        '    ret',
+        '.other:',
+        '    call    stdout_flush',
+        '    syscall',
+        '    ret',
+        '',
     ]
 
-    def tag_instructions(instructions, name):
-        lines = instructions.split('\n')
-        tag_position = 29
-        padding = max(0, tag_position - len(lines[0])) * ' '
-        lines[0] += f'{padding} ;; {name}'
 
-        return '\n'.join(lines)
+def _tag_instructions(instructions, name):
+    lines = instructions.split('\n')
+    tag_position = 29
+    padding = max(0, tag_position - len(lines[0])) * ' '
+    lines[0] += f'{padding} ;; {name}'
+
+    return '\n'.join(lines)
 
-    global_state.add_symbols = []
-    for token in program:
-        instructions = generate_instruction(token)
-        instructions = tag_instructions(instructions, token.operator.name)
-        assembly.append(instructions)
 
-    for token in global_state.add_symbols:
-        assembly.extend([
+def _generate_code(program: list, tokens: list, cache_registers: bool) -> list:
+    """Assembly for some tokens of a program and the string literals they use."""
+    code = []
+    global_state.add_symbols = {}
+    stack = RegisterStack()
+    for token in tokens:
+        if cache_registers:
+            instructions = register_stack.generate_instruction(token, program, stack)
+        else:
+            instructions = generate_instruction(token, program)
+        instructions = _tag_instructions(instructions, token.operator.name)
+        code.append(instructions)
+
+    for token in global_state.add_symbols.values():
+        code.extend([
             '',
             f'{token.label}:',
             f'    db    {token.value}',
         ])
 
+    return code
+
+
+def generate_assembly(program: list, cache_registers: bool = False):
+    """
+    Generate assembly for a Pyre program.
+
+    With cache_registers the values on top of the stack are kept in registers.
+    """
+    assembly = ASSEMBLY_DEFINES + ['global _start'] + generate_runtime()
+    assembly.extend(_generate_code(program, program, cache_registers))
+    if global_state.instrument:
+        assembly.extend(instrumentation.generate_runtime())
     return "\n".join(assembly)
 
 
+def generate_modules(program: list, main_file: str, cache_registers: bool = False) -> dict:
+    """
+    Generate assembly for every file with procedures in a Pyre program.
+
+    Each file is assembled on its own. Its procedures are global and the ones
+    of other files it calls are extern. All of them need the runtime, which
+    assemble_runtime generates.
+    """
+    files = {main_file: []}  # File -> its tokens
+    address = 0
+    while address < len(program):
+        token = program[address]
+        if token.operator is Operator.PROCEDURE:
+            file = token.position[0] if token.position is not None else main_file
+            files.setdefault(file, []).extend(program[address:token.end + 1])
+            address = token.end + 1
+        else:
+            files[main_file].append(token)  # Whatever is outside procedures
+            address += 1
+
+    modules = {}
+    for file, tokens in files.items():
+        defined = [token.label for token in tokens if token.operator is Operator.PROCEDURE]
+        called = sorted({token.value for token in tokens if token.operator is Operator.PROCEDURE_CALL} - set(defined))
+        assembly = list(ASSEMBLY_DEFINES)
+        assembly.extend(f'global {label}' for label in defined)
+        assembly.extend(f'extern {label}' for label in called + runtime_symbols())
+        assembly.append('segment .text')
+        assembly.extend(_generate_code(program, tokens, cache_registers))
+        modules[file] = '\n'.join(assembly)
+    return modules
+
+
+def assemble_runtime() -> str:
+    """Assembly of the runtime for programs compiled with generate_modules."""
+    return '\n'.join(ASSEMBLY_DEFINES + [f'global {label}' for label in runtime_symbols()] + generate_runtime())
+
+
+def _run_tool(command: list, error: str):
+    """Run nasm or ld, what they print goes with the output of the program being compiled."""
+    res = subprocess.run(command, capture_output=True, text=True)
+    print(res.stdout + res.stderr, end='')
+    if res.returncode:
+        raise RuntimeError(error)
+
+
+def compile_program(main_file: str, args) -> str:
+    """
+    Compile the program in main_file with the options parsed from the command line.
+
+    Returns the path of the executable.
+    """
+    global_state.reset()
+    global_state.use_token_cache = args.use_token_cache
+    global_state.instrument = 'loops' if args.instrument_loops else 'procedures' if args.instrument else None
+    global_state.memory_capacity = args.memory_capacity
+    global_state.huge_pages = args.huge_pages
+    if global_state.instrument and args.separate:
+        raise RuntimeError('--instrument does not work with --separate, the tables would be in every object')
+    timings = Timings(main_file)
+    phase = timings.phase
+
+    with phase('tokenize'):
+        tokens = tokenize_file(main_file)
+    with phase('load_macros'):
+        tokens = load_macros(tokens)
+    timings.count('tokens_before_expansion', len(tokens))
+    with phase('expand_macros'):
+        tokens = expand_macros(tokens, timings)
+    timings.count('tokens_after_expansion', len(tokens))
+    with phase('create_references'):
+        program = create_references(tokens)
+    if args.fold_constants:
+        with phase('fold_constants'):
+            program = create_references(fold_constants(program, args.verbose))
+    with phase('inline_procedures'):
+        program = create_references(inline_procedures(program, args.inline_threshold, args.verbose))
+    with phase('remove_dead_procedures'):
+        program = create_references(remove_dead_procedures(program, args.verbose))
+    with phase('analyze_stack'):
+        program = analyze_stack(program)
+    with phase('resolve_variables'):
+        program = resolve_variables(program)
+
+    # The real work
+    with phase('generate_assembly'):
+        if args.separate:
+            modules = generate_modules(program, main_file, args.cache_registers)
+            modules[Path(main_file).with_name('runtime').as_posix()] = assemble_runtime()
+        else:
+            modules = {main_file: generate_assembly(program, args.cache_registers)}
+    if args.optimize:
+        with phase('peephole'):
+            removed = {}
+            for file, assembly in modules.items():
+                modules[file], file_removed = peephole.optimize_assembly(assembly)
+                for rule, count in file_removed.items():
+                    removed[rule] = removed.get(rule, 0) + count
+        for rule, count in removed.items():
+            print(f'peephole: {rule} removed {count} instructions')
+    for assembly in modules.values():
+        timings.count('assembly_lines', assembly.count('\n') + 1)
+        timings.count('assembly_bytes', len(assembly.encode()))
+    assembly = modules.pop(main_file)
+    assembly_file = Path(main_file).with_suffix('.asm').as_posix()
+    object_file = Path(main_file).with_suffix('.o').as_posix()
+    executable = Path(main_file).with_suffix('').absolute().as_posix()
+
+    if not (args.nasm or args.separate):
+        with phase('assemble'):
+            assembler.write_executable(executable, assembler.assemble(assembly))
+    else:
+        with open(assembly_file, 'w') as f:
+            f.write(assembly)
+
+        with phase('nasm'):
+            _run_tool(['nasm', '-felf64', assembly_file], 'Could not generate object file')
+
+        objects = [object_file]
+        for file, module in modules.items():
+            with phase('nasm'):
+                module_object, assembled = object_cache.assemble(file, module)
+            if args.verbose:
+                print(f'{file}: {"assembled" if assembled else "object is up to date"}')
+            objects.append(module_object.as_posix())
+
+        with phase('ld'):
+            _run_tool(['ld', *objects, '-o', executable], 'Could not link the object file')
+
+    if args.timings:
+        print(timings.report(args.timings_format))
+    return executable
+
+
+def size(text: str) -> int:
+    """Bytes in a size like 4096, 64K, 16M or 1G."""
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    multiplier = units.get(text[-1:].upper(), 1)
+    digits = text[:-1] if text[-1:].upper() in units else text
+    if not digits.isdigit():
+        raise argparse.ArgumentTypeError(f'invalid size {text}')
+    return int(digits) * multiplier
+
+
+def _compile_job(main_file: str, args) -> tuple:
+    """
+    Compile a program, maybe in a worker process.
+
+    Returns the path of the executable, what compiling it printed and the error
+    that stopped it. Either the path or the error is None.
+    """
+    output = io.StringIO()
+    executable = error = None
+    with redirect_stdout(output):
+        try:
+            executable = compile_program(main_file, args)
+        except RuntimeError as e:
+            error = str(e)
+        except Exception:
+            error = traceback.format_exc()
+    return executable, output.getvalue(), error
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Simple Pyre compiler.')
     parser.add_argument('source', nargs='+',
-                        help='source files')
+                        help='source files, each one a program, or directories to watch with --watch')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        dest='jobs',
+                        default=os.cpu_count() or 1,
+                        metavar='N',
+                        help='Compile up to N programs at the same time, as many as CPUs by default.')
     parser.add_argument('-r',
                         '--run',
                         action='store_true',
                         dest='run',
                         default=False,
-                        help='Run the program after compiling it.')
-
-    args = parser.parse_args()
-
-    main_file = args.source[0]
-    with open(main_file, 'r') as f:
-        program_text = f.read()
-    tokens = tokenize(program_text)
-    tokens = load_macros(tokens)
-    tokens = expand_macros(tokens)
-    program = create_references(tokens)
-
-    # pprint([token.operator for token in program])
-
-    # check_push_count(program)
+                        help='Run the programs after compiling them.')
+    parser.add_argument('-w',
+                        '--watch',
+                        action='store_true',
+                        dest='watch',
+                        default=False,
+                        help='Keep rebuilding the programs whenever they or their imports change, '
+                             'with the compiler and the imported tokens kept in memory.')
+    parser.add_argument('--no-cache',
+                        action='store_false',
+                        dest='use_token_cache',
+                        default=True,
+                        help=f'Tokenize imports again instead of using {token_cache.CACHE_DIRECTORY}.')
+    parser.add_argument('-O',
+                        '--optimize',
+                        action='store_true',
+                        dest='optimize',
+                        default=False,
+                        help='Run the peephole optimizer over the assembly and report what it removed.')
+    parser.add_argument('--no-fold',
+                        action='store_false',
+                        dest='fold_constants',
+                        default=True,
+                        help='Leave the constants in the program as they are.')
+    parser.add_argument('--inline-threshold',
+                        type=int,
+                        dest='inline_threshold',
+                        default=INLINE_THRESHOLD,
+                        metavar='TOKENS',
+                        help='Inline procedures with up to this many tokens, 0 only inlines the ones marked inline.')
+    parser.add_argument('-v',
+                        '--verbose',
+                        action='store_true',
+                        dest='verbose',
+                        default=False,
+                        help='Explain what the optimizations do.')
+    parser.add_argument('--cache-registers',
+                        action='store_true',
+                        dest='cache_registers',
+                        default=False,
+                        help='Keep the values on top of the stack in registers.')
 
-    # The real work
-    assembly = generate_assembly(program)
-    assembly_file = Path(main_file).with_suffix('.asm').as_posix()
-    object_file = Path(main_file).with_suffix('.o').as_posix()
-    executable = Path(main_file).with_suffix('').absolute().as_posix()
+    parser.add_argument('--timings',
+                        action='store_true',
+                        dest='timings',
+                        default=False,
+                        help='Print the time spent in every phase and how big the program got.')
+    parser.add_argument('--timings-format',
+                        choices=['text', 'json'],
+                        dest='timings_format',
+                        default='text',
+                        help='Print the --timings report as a table or as a line of json.')
+    parser.add_argument('--instrument',
+                        action='store_true',
+                        dest='instrument',
+                        default=False,
+                        help='Count the calls and cycles of every procedure and write them to stderr at the '
+                             'end of main.')
+    parser.add_argument('--instrument-loops',
+                        action='store_true',
+                        dest='instrument_loops',
+                        default=False,
+                        help='Like --instrument, also counting the iterations of every while.')
+    parser.add_argument('--memory',
+                        type=size,
+                        dest='memory_capacity',
+                        default=global_state.memory_capacity,
+                        metavar='SIZE',
+                        help='Bytes of the static memory, like 4096, 64K or 16M, 0 leaves it out. '
+                             'alloc, free and realloc work either way.')
+    parser.add_argument('--huge-pages',
+                        action='store_true',
+                        dest='huge_pages',
+                        default=False,
+                        help='Ask for huge pages for blocks of 2 MiB or more from alloc.')
+    parser.add_argument('--separate',
+                        action='store_true',
+                        dest='separate',
+                        default=False,
+                        help=f'Assemble every imported file to its own object in {token_cache.CACHE_DIRECTORY}, '
+                             'only again when its code changes, implies --nasm.')
+    parser.add_argument('--nasm',
+                        action='store_true',
+                        dest='nasm',
+                        default=False,
+                        help='Write the assembly to a .asm file and build it with nasm and ld '
+                             'instead of the built-in assembler.')
 
-    with open(assembly_file, 'w') as f:
-        f.write(assembly)
+    args = parser.parse_args()
 
-    res = subprocess.run(['nasm', '-felf64', assembly_file])
-    if res.returncode:
-        raise RuntimeError('Could not generate object file')
+    if args.watch:
+        watch.watch(args.source, partial(_compile_job, args=args), args.run)
+        sys.exit(0)
+
+    sources = list(dict.fromkeys(args.source))
+    jobs = max(1, min(args.jobs, len(sources)))
+    compile_source = partial(_compile_job, args=args)
+    # Results come in the order of the sources whichever finishes first
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    results = pool.imap(compile_source, sources) if pool else map(compile_source, sources)
+
+    executables = []
+    failed = 0
+    for source, (executable, output, error) in zip(sources, results):
+        print(output, end='', flush=True)
+        if error is None:
+            executables.append(executable)
+        else:
+            print(f'{source}: {error}', file=sys.stderr, flush=True)
+            failed += 1
+    if pool:
+        pool.close()
+        pool.join()
 
-    res = subprocess.run(['ld', object_file, '-o', executable])
-    if res.returncode:
-        raise RuntimeError('Could not link the object file')
+    if failed:
+        if len(sources) > 1:
+            print(f'{failed} of {len(sources)} programs failed to compile', file=sys.stderr)
+        sys.exit(1)
 
     if args.run:
-        subprocess.run([executable])
+        for executable in executables:
+            subprocess.run([executable])
@@ -0,0 +1,338 @@
+# noqa e302
+"""
+Code generation keeping the top of the stack in registers.
+
+The generator tracks which values on top of the stack live in registers (or
+are constants that weren't materialized yet) instead of on the hardware stack.
+Operators work on those directly, shuffles only rename them. Everything goes
+back to the hardware stack before labels, jumps, calls and syscalls, and before
+anything that looks at the stack through memory.
+"""
+import sys
+import global_state
+from definitions import Operator
+from implementations import get_implementation, variable_operand, memory_address
+from implementations import fused_condition, fused_into_do, branch_unless
+
+
+# Neither scratch registers of the templates nor syscall arguments
+REGISTERS = ('rbx', 'r11', 'r12', 'r13', 'r14', 'r15')
+_LOW_BYTES = {'rbx': 'bl', 'r11': 'r11b', 'r12': 'r12b', 'r13': 'r13b', 'r14': 'r14b', 'r15': 'r15b'}
+_SYSCALL_ARGUMENTS = ('rdi', 'rsi', 'rdx', 'r10', 'r8', 'r9')
+
+
+def _is_register(value: str) -> bool:
+    return value in REGISTERS
+
+
+def _is_small(value: str) -> bool:
+    """Whether value can be an immediate operand, those are 32 bits sign extended."""
+    try:
+        return -2 ** 31 <= int(value) < 2 ** 31
+    except ValueError:
+        return False  # Labels
+
+
+class RegisterStack:
+    """The values on top of the stack that aren't on the hardware stack."""
+
+    def __init__(self):
+        self.values = []  # Bottom to top, registers or constants
+        self.free = list(REGISTERS)
+        self.instructions = []
+
+    def emit(self, *instructions):
+        self.instructions.extend(f'    {instruction}' for instruction in instructions)
+
+    def take(self) -> list:
+        """Get the instructions emitted so far."""
+        instructions, self.instructions = self.instructions, []
+        return instructions
+
+    def spill(self, count: int = None):
+        """Push the count values at the bottom to the hardware stack, all of them by default."""
+        count = len(self.values) if count is None else count
+        for value in self.values[:count]:
+            self.emit(f'push    {value}')
+            self.release(value)
+        del self.values[:count]
+
+    def fill(self, count: int):
+        """Make sure at least count values are here, popping the missing ones."""
+        while len(self.values) < count:
+            register = self.allocate()
+            self.emit(f'pop     {register}')
+            self.values.insert(0, register)
+
+    def allocate(self) -> str:
+        while not self.free:
+            self.spill(1)
+        return self.free.pop()
+
+    def release(self, value: str):
+        if _is_register(value):
+            self.free.append(value)
+
+    def push(self, value: str):
+        self.values.append(value)
+
+    def pop(self) -> str:
+        self.fill(1)
+        return self.values.pop()
+
+    def to_register(self, value: str) -> str:
+        """Get value into a register that can be overwritten."""
+        if _is_register(value):
+            return value
+        register = self.allocate()
+        self.emit(f'mov     {register}, {value}')
+        return register
+
+    def to_operand(self, value: str) -> str:
+        """Get value into something an instruction can take as a source."""
+        return value if _is_register(value) or _is_small(value) else self.to_register(value)
+
+    def copy(self, value: str) -> str:
+        if not _is_register(value):
+            return value
+        register = self.allocate()
+        self.emit(f'mov     {register}, {value}')
+        return register
+
+
+def _binary(stack, mnemonic, commutative=False):
+    stack.fill(2)
+    b = stack.pop()
+    a = stack.pop()
+    if commutative and not _is_register(a) and _is_register(b):
+        a, b = b, a
+    a = stack.to_register(a)
+    b = stack.to_operand(b)
+    stack.emit(f'{mnemonic:<8}{a}, {b}')
+    stack.release(b)
+    stack.push(a)
+def _division(stack, result):
+    stack.fill(2)
+    b = stack.pop()
+    a = stack.pop()
+    stack.emit(f'mov     rax, {a}')
+    if not _is_register(b):
+        stack.emit(f'mov     rcx, {b}')
+    stack.emit('xor     rdx, rdx', f'idiv    {b if _is_register(b) else "rcx"}')
+    stack.release(a)
+    stack.release(b)
+    register = stack.allocate()
+    stack.emit(f'mov     {register}, {result}')
+    stack.push(register)
+def _comparison(stack, condition):
+    stack.fill(2)
+    b = stack.pop()
+    a = stack.to_register(stack.pop())
+    b = stack.to_operand(b)
+    stack.emit(f'cmp     {a}, {b}', f'set{condition:<5}al', f'movzx   {a}, al')
+    stack.release(b)
+    stack.push(a)
+
+
+def _ADD(token, program, stack):
+    _binary(stack, 'add', commutative=True)
+def _SUB(token, program, stack):
+    _binary(stack, 'sub')
+def _MUL(token, program, stack):
+    _binary(stack, 'imul', commutative=True)
+def _AND(token, program, stack):
+    _binary(stack, 'and', commutative=True)
+def _OR(token, program, stack):
+    _binary(stack, 'or', commutative=True)
+def _DIV(token, program, stack):
+    _division(stack, 'rax')
+def _MOD(token, program, stack):
+    _division(stack, 'rdx')
+def _EQUAL(token, program, stack):
+    _comparison(stack, 'e')
+def _NOT_EQUAL(token, program, stack):
+    _comparison(stack, 'ne')
+def _LESS_THAN(token, program, stack):
+    _comparison(stack, 'l')
+def _GREATER_THAN(token, program, stack):
+    _comparison(stack, 'g')
+def _LESS_OR_EQUAL_THAN(token, program, stack):
+    _comparison(stack, 'le')
+def _GREATER_OR_EQUAL_THAN(token, program, stack):
+    _comparison(stack, 'ge')
+def _NOT(token, program, stack):
+    a = stack.to_register(stack.pop())
+    stack.emit(f'not     {a}', f'and     {a}, TRUE')
+    stack.push(a)
+def _BOOL(token, program, stack):
+    a = stack.to_register(stack.pop())
+    stack.emit(f'test    {a}, {a}', 'setne   al', f'movzx   {a}, al')
+    stack.push(a)
+def _DROP(token, program, stack):
+    if stack.values:
+        stack.release(stack.pop())
+    else:
+        stack.emit('add     rsp, 8')
+def _SWAP(token, program, stack):
+    stack.fill(2)
+    stack.values[-2:] = stack.values[:-3:-1]
+_ROT2 = _SWAP
+def _ROT3(token, program, stack):
+    stack.fill(3)
+    a, b, c = stack.values[-3:]
+    stack.values[-3:] = [b, c, a]
+def _DROT2(token, program, stack):
+    stack.fill(4)
+    a, b, c, d = stack.values[-4:]
+    stack.values[-4:] = [c, d, a, b]
+def _DUP(token, program, stack):
+    stack.fill(1)
+    stack.push(stack.copy(stack.values[-1]))
+def _DUP2(token, program, stack):
+    stack.fill(2)
+    for _ in range(2):
+        stack.push(stack.copy(stack.values[-2]))
+def _DUP3(token, program, stack):
+    stack.fill(3)
+    for _ in range(3):
+        stack.push(stack.copy(stack.values[-3]))
+def _LOAD(token, program, stack):
+    a = stack.to_register(stack.pop())
+    stack.emit(f'mov     {a}, [{a}]')
+    stack.push(a)
+_DEREFERENCE = _LOAD
+def _LOAD1(token, program, stack):
+    a = stack.to_register(stack.pop())
+    stack.emit(f'movzx   {a}, BYTE [{a}]')
+    stack.push(a)
+def _STORE(token, program, stack):
+    stack.fill(2)
+    address = stack.to_register(stack.pop())
+    value = stack.to_operand(stack.pop())
+    stack.emit(f'mov     {"" if _is_register(value) else "QWORD "}[{address}], {value}')
+    stack.release(address)
+    stack.release(value)
+def _STORE1(token, program, stack):
+    stack.fill(2)
+    address = stack.to_register(stack.pop())
+    value = stack.to_operand(stack.pop())
+    if _is_register(value):
+        stack.emit(f'mov     [{address}], {_LOW_BYTES[value]}')
+    else:
+        stack.emit(f'mov     BYTE [{address}], {int(value) & 0xff}')
+    stack.release(address)
+    stack.release(value)
+def _fixed_registers(stack, registers: tuple, *instructions):
+    """Move the values on top of the stack to the registers instructions take them from and emit them."""
+    stack.fill(len(registers))
+    values = stack.values[-len(registers):]
+    del stack.values[-len(registers):]
+    for register, value in zip(registers, values):
+        stack.emit(f'mov     {register}, {value}')
+        stack.release(value)
+    stack.emit(*instructions)
+def _string_routine(stack, registers: tuple, routine: str):
+    """Call a routine of strings.py, they leave the registers the stack is cached in alone."""
+    _fixed_registers(stack, registers, f'call    {routine}')
+    register = stack.allocate()
+    stack.emit(f'mov     {register}, rax')
+    stack.push(register)
+def _MEMCPY(token, program, stack):
+    _fixed_registers(stack, ('rdi', 'rsi', 'rcx'), 'rep     movsb')
+def _MEMSET(token, program, stack):
+    _fixed_registers(stack, ('rdi', 'rax', 'rcx'), 'rep     stosb')
+def _MEMCMP(token, program, stack):
+    _string_routine(stack, ('rdi', 'rsi', 'rdx'), 'string_memcmp')
+def _MEMCHR(token, program, stack):
+    _string_routine(stack, ('rdi', 'rsi', 'rdx'), 'string_memchr')
+def _STRLEN(token, program, stack):
+    _string_routine(stack, ('rdi',), 'string_strlen')
+def _STRCMP(token, program, stack):
+    _string_routine(stack, ('rdi', 'rsi'), 'string_strcmp')
+def _MEMORY(token, program, stack):
+    stack.push(memory_address(token))
+def _PUSH_UINT(token, program, stack):
+    stack.push(str(token.value))
+_PUSH_CHAR = _PUSH_UINT
+def _PUSH_STRING(token, program, stack):
+    global_state.add_symbols.setdefault(token.label, token)  # Copies of a token share the label
+    stack.push(str(token.length))
+    stack.push(token.label)
+def _RETRIEVE(token, program, stack):
+    inst, operand = variable_operand(token)
+    stack.instructions.extend(inst)
+    register = stack.allocate()
+    stack.emit(f'mov     {register}, {operand}')
+    stack.push(register)
+def _MUTATE(token, program, stack):
+    value = stack.to_operand(stack.pop())
+    inst, operand = variable_operand(token)
+    stack.instructions.extend(inst)
+    stack.emit(f'mov     {"" if _is_register(value) else "QWORD "}{operand}, {value}')
+    stack.release(value)
+def _SYSCALL(token, program, stack):
+    assert 0 <= token.value <= 5
+    stack.fill(token.value + 1)
+    values = stack.values[-token.value - 1:]
+    del stack.values[-token.value - 1:]
+    stack.spill()
+    for register, value in zip(('rax',) + _SYSCALL_ARGUMENTS, reversed(values)):
+        stack.emit(f'mov     {register}, {value}')
+        stack.release(value)
+    stack.emit('call    stdout_syscall')  # Writes to stdout are buffered
+    register = stack.allocate()
+    stack.emit(f'mov     {register}, rax')
+    stack.push(register)
+def _IF(token, program, stack):
+    pass  # Nothing jumps here
+def _DO(token, program, stack):
+    fused = fused_condition(token, program)
+    if fused is not None:
+        start, condition = fused
+        if program[start].operator is Operator.NOT or program[start].operator is Operator.BOOL:
+            a = stack.to_register(stack.pop())
+            b = a if program[start].operator is Operator.BOOL else '1'
+            stack.spill()
+            stack.emit(f'test    {a}, {b}')
+        else:
+            stack.fill(2)
+            b = stack.pop()
+            a = stack.to_register(stack.pop())
+            b = stack.to_operand(b)
+            stack.spill()
+            stack.emit(f'cmp     {a}, {b}')
+            stack.release(b)
+        stack.emit(branch_unless(condition, program[token.end].label))
+        stack.release(a)
+        return
+    condition = stack.pop()
+    stack.spill()
+    if not _is_register(condition):
+        stack.emit(f'mov     rax, {condition}')
+    stack.emit(f'cmp     {condition if _is_register(condition) else "rax"}, TRUE',
+               f'jne     {program[token.end].label}')
+    stack.release(condition)
+def _END(token, program, stack):
+    if program[token.start].operator is Operator.WHERE:
+        return  # Bindings only exist at compile time
+    stack.spill()
+    stack.instructions.extend(get_implementation(token.operator)(token, program))
+
+
+def generate_instruction(token, program, stack: RegisterStack) -> str:
+    """Generate assembly for a single token with the top of the stack in registers."""
+    implementation = _implementations.get(token.operator)
+    if fused_into_do(token, program):
+        return '    ;; Fused into the next do'  # The operands stay where they are for the do
+    if implementation is None:
+        # Operators without their own version need the whole stack in memory
+        stack.spill()
+        stack.instructions.extend(get_implementation(token.operator)(token, program))
+    else:
+        implementation(token, program, stack)
+    return '\n'.join(stack.take())
+
+
+_implementations = {operator: getattr(sys.modules[__name__], '_' + operator.name)
+                    for operator in Operator
+                    if hasattr(sys.modules[__name__], '_' + operator.name)}
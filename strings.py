@@ -0,0 +1,179 @@
+"""
+String routines of the runtime, behind strlen, memchr, memcmp and strcmp.
+
+They look at 16 bytes at a time with SSE2: pcmpeqb compares them all at once
+and pmovmskb turns the result into a bit per byte, bsf finds the first one.
+
+Loads of 16 bytes can't go past the end of a page that has the string, the
+next page may not be mapped. strlen and memchr only load aligned blocks, which
+never cross pages, and ignore the bytes before the start. memcmp loads what's
+in the bytes it was given and compares the last ones one at a time. strcmp
+walks two strings that are aligned differently, it compares one byte at a time
+near the end of a page and 16 everywhere else.
+
+memcmp and strcmp leave 0 when the bytes are equal, 1 when the first ones are
+greater and -1 when they're smaller, comparing bytes as unsigned. They only
+touch rax, rcx, rdx, rsi, rdi and xmm0 to xmm2.
+"""
+
+
+BLOCK = 16
+LAST_BLOCK = 4096 - BLOCK  # Offset in a page of the last block that doesn't cross into the next one
+
+
+def _order(label: str) -> list:
+    """Leave in rax the ordering of the bytes in rax and rcx."""
+    return [
+        f'{label}:',
+        '    cmp     rax, rcx',
+        '    mov     rax, 0',
+        '    mov     rcx, 0',
+        '    seta    al',
+        '    setb    cl',
+        '    sub     rax, rcx',
+        '    ret',
+    ]
+
+
+def generate_runtime() -> list:
+    return [
+        'segment .text',
+        '',
+        'string_strlen:  ;; rdi is the address, returns the length in rax',
+        '    pxor    xmm0, xmm0',
+        '    mov     rcx, rdi',
+        f'    and     rcx, {BLOCK - 1}',
+        '    mov     rax, rdi',
+        f'    and     rax, {-BLOCK}',
+        '    movdqa  xmm1, [rax]',
+        '    pcmpeqb xmm1, xmm0',
+        '    pmovmskb edx, xmm1',
+        '    shr     edx, cl  ;; Bytes before the string',
+        '    test    edx, edx',
+        '    jne     .strlen_first',
+        '.strlen_next:',
+        f'    add     rax, {BLOCK}',
+        '    movdqa  xmm1, [rax]',
+        '    pcmpeqb xmm1, xmm0',
+        '    pmovmskb edx, xmm1',
+        '    test    edx, edx',
+        '    je      .strlen_next',
+        '    bsf     rdx, rdx',
+        '    add     rax, rdx',
+        '    sub     rax, rdi',
+        '    ret',
+        '.strlen_first:',
+        '    bsf     rax, rdx',
+        '    ret',
+        '',
+        'string_memchr:  ;; rdi is the address, rsi the byte and rdx the length, returns the address or 0',
+        '    test    rdx, rdx',
+        '    je      .memchr_none',
+        '    and     rsi, 255',
+        '    mov     rax, 0x0101010101010101',
+        '    imul    rax, rsi',
+        '    movq    xmm0, rax',
+        '    punpcklqdq xmm0, xmm0  ;; The byte 16 times',
+        '    mov     rcx, rdi',
+        f'    and     rcx, {BLOCK - 1}',
+        '    mov     rax, rdi',
+        f'    and     rax, {-BLOCK}',
+        '    add     rdx, rcx  ;; Length from the start of the block',
+        '    movdqa  xmm1, [rax]',
+        '    pcmpeqb xmm1, xmm0',
+        '    pmovmskb esi, xmm1',
+        '    shr     esi, cl  ;; Bytes before the start',
+        '    shl     esi, cl',
+        '.memchr_block:',
+        '    test    esi, esi',
+        '    jne     .memchr_found',
+        f'    sub     rdx, {BLOCK}',
+        '    jbe     .memchr_none',
+        f'    add     rax, {BLOCK}',
+        '    movdqa  xmm1, [rax]',
+        '    pcmpeqb xmm1, xmm0',
+        '    pmovmskb esi, xmm1',
+        '    jmp     .memchr_block',
+        '.memchr_found:',
+        '    bsf     rsi, rsi',
+        '    cmp     rsi, rdx',
+        '    jae     .memchr_none  ;; After the end',
+        '    add     rax, rsi',
+        '    ret',
+        '.memchr_none:',
+        '    mov     rax, 0',
+        '    ret',
+        '',
+        'string_memcmp:  ;; rdi and rsi are the addresses and rdx the length, returns the ordering in rax',
+        f'    cmp     rdx, {BLOCK}',
+        '    jb      .memcmp_tail',
+        '    movdqu  xmm1, [rdi]',
+        '    movdqu  xmm2, [rsi]',
+        '    pcmpeqb xmm1, xmm2',
+        '    pmovmskb eax, xmm1',
+        '    xor     eax, 0xffff  ;; Bytes that differ',
+        '    jne     .memcmp_found',
+        f'    add     rdi, {BLOCK}',
+        f'    add     rsi, {BLOCK}',
+        f'    sub     rdx, {BLOCK}',
+        '    jmp     string_memcmp',
+        '.memcmp_tail:',
+        '    test    rdx, rdx',
+        '    je      .memcmp_equal',
+        '    movzx   rax, BYTE [rdi]',
+        '    movzx   rcx, BYTE [rsi]',
+        '    cmp     rax, rcx',
+        '    jne     .memcmp_order',
+        '    add     rdi, 1',
+        '    add     rsi, 1',
+        '    sub     rdx, 1',
+        '    jmp     .memcmp_tail',
+        '.memcmp_equal:',
+        '    mov     rax, 0',
+        '    ret',
+        '.memcmp_found:',
+        '    bsf     rcx, rax',
+        '    movzx   rax, BYTE [rdi + rcx]',
+        '    movzx   rcx, BYTE [rsi + rcx]',
+        *_order('.memcmp_order'),
+        '',
+        'string_strcmp:  ;; rdi and rsi are the addresses, returns the ordering in rax',
+        '    pxor    xmm0, xmm0',
+        '.strcmp_next:',
+        '    mov     rax, rdi',
+        '    and     rax, 4095',
+        f'    cmp     rax, {LAST_BLOCK}',
+        '    ja      .strcmp_byte',
+        '    mov     rax, rsi',
+        '    and     rax, 4095',
+        f'    cmp     rax, {LAST_BLOCK}',
+        '    ja      .strcmp_byte',
+        '    movdqu  xmm1, [rdi]',
+        '    movdqu  xmm2, [rsi]',
+        '    pcmpeqb xmm2, xmm1',
+        '    pcmpeqb xmm1, xmm0',
+        '    pmovmskb eax, xmm2',
+        '    pmovmskb edx, xmm1',
+        '    xor     eax, 0xffff',
+        '    or      eax, edx  ;; Bytes that differ or end the first string',
+        '    jne     .strcmp_found',
+        f'    add     rdi, {BLOCK}',
+        f'    add     rsi, {BLOCK}',
+        '    jmp     .strcmp_next',
+        '.strcmp_byte:  ;; Near the end of a page',
+        '    movzx   rax, BYTE [rdi]',
+        '    movzx   rcx, BYTE [rsi]',
+        '    cmp     rax, rcx',
+        '    jne     .strcmp_order',
+        '    test    rax, rax',
+        '    je      .strcmp_order',
+        '    add     rdi, 1',
+        '    add     rsi, 1',
+        '    jmp     .strcmp_next',
+        '.strcmp_found:',
+        '    bsf     rcx, rax',
+        '    movzx   rax, BYTE [rdi + rcx]',
+        '    movzx   rcx, BYTE [rsi + rcx]',
+        *_order('.strcmp_order'),
+        '',
+    ]
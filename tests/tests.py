@@ -4,25 +4,36 @@ from pathlib import Path
 import yaml
 import unittest
 import os
+import json
+import peephole
+import call_graph
+import object_cache
+import assembler
+import watch
+import global_state
+from pyre import tokenize, tokenize_file, create_references
+from grammar_checking import analyze_stack
 
 TMP_FILENAME = 'tmp_test_code.tmp'
+TESTS_FILES = ['tests/if_tests.yaml', 'tests/while_tests.yaml', 'tests/stack_tests.yaml',
+               'tests/variable_tests.yaml', 'tests/constant_tests.yaml', 'tests/inline_tests.yaml',
+               'tests/branch_tests.yaml']
 
 
-def run_code(code: str):
+def run_code(code: str, *flags):
     """Compile and a fragment of pyre source code."""
     with open(TMP_FILENAME, 'w') as f:
         f.write(code)
-    subprocess.run(['./pyre.py', TMP_FILENAME])
+    subprocess.run(['./pyre.py', TMP_FILENAME, *flags], stdout=subprocess.DEVNULL)
     assembly_file = Path(TMP_FILENAME).absolute().with_suffix('.asm').as_posix()
     object_file = Path(TMP_FILENAME).absolute().with_suffix('.o').as_posix()
     executable = Path(TMP_FILENAME).absolute().with_suffix('').as_posix()
     completed_process = subprocess.run(executable, capture_output=True)
     output = completed_process.stdout.decode('ascii')
 
-    os.remove(TMP_FILENAME)
-    os.remove(assembly_file)
-    os.remove(object_file)
-    os.remove(executable)
+    # The built-in assembler doesn't leave an assembly or an object file behind
+    for path in [TMP_FILENAME, assembly_file, object_file, executable]:
+        Path(path).unlink(missing_ok=True)
 
     return output
 
@@ -52,6 +63,454 @@ class TestBaseStructures(unittest.TestCase):
             output = run_code(code)
             self.assertEqual(output, expected_output, f'Failed test {test_name}')
 
+    def test_stack(self):
+        """Test the arithmetic and the stack shuffles work."""
+        with open('tests/stack_tests.yaml', 'r') as f:
+            tests = yaml.safe_load(f.read())
+
+        for test_name, test in tests.items():
+            code = 'import "std"\n' + test['code']
+            expected_output = test['expected']
+            output = run_code(code)
+            self.assertEqual(output, expected_output, f'Failed test {test_name}')
+
+    def test_constants(self):
+        """Test constant expressions and conditions give the same results once folded."""
+        with open('tests/constant_tests.yaml', 'r') as f:
+            tests = yaml.safe_load(f.read())
+
+        for test_name, test in tests.items():
+            code = 'import "std"\n' + test['code']
+            expected_output = test['expected']
+            self.assertEqual(run_code(code), expected_output, f'Failed test {test_name}')
+            self.assertEqual(run_code(code, '--no-fold'), expected_output, f'Failed test {test_name} unfolded')
+
+    def test_variables(self):
+        """Test variables are bound and mutated in place."""
+        with open('tests/variable_tests.yaml', 'r') as f:
+            tests = yaml.safe_load(f.read())
+
+        for test_name, test in tests.items():
+            code = 'import "std"\n' + test['code']
+            expected_output = test['expected']
+            output = run_code(code)
+            self.assertEqual(output, expected_output, f'Failed test {test_name}')
+
+    def test_branches(self):
+        """Test conditions fused into the do after them branch the same way."""
+        with open('tests/branch_tests.yaml', 'r') as f:
+            tests = yaml.safe_load(f.read())
+
+        for test_name, test in tests.items():
+            code = 'import "std"\n' + test['code']
+            expected_output = test['expected']
+            output = run_code(code, '--no-fold')
+            self.assertEqual(output, expected_output, f'Failed test {test_name}')
+
+    def test_inlining(self):
+        """Test procedures work the same inlined or called."""
+        with open('tests/inline_tests.yaml', 'r') as f:
+            tests = yaml.safe_load(f.read())
+
+        for test_name, test in tests.items():
+            code = 'import "std"\n' + test['code']
+            expected_output = test['expected']
+            self.assertEqual(run_code(code), expected_output, f'Failed test {test_name}')
+            self.assertEqual(run_code(code, '--inline-threshold', '0'), expected_output, f'Failed test {test_name}')
+
+
+class TestPeephole(unittest.TestCase):
+    """Test case for the peephole optimizer rules."""
+
+    def optimize(self, assembly: str):
+        instructions, removed = peephole.optimize(peephole.parse(assembly))
+        return [instruction.render().split(';')[0].split() for instruction in instructions], removed
+
+    def test_push_pop(self):
+        """Test pushes followed by pops become movs."""
+        code, removed = self.optimize('    push    rax\n    pop     rax\n    push    3\n    pop     rbx')
+        self.assertEqual(code, [['mov', 'rbx,', '3']])
+        self.assertEqual(removed['push-pop'], 3)
+
+    def test_push_pop_across_instructions(self):
+        """Test a push and a pop only merge if what's in between keeps the value."""
+        code, _ = self.optimize('    push    rax\n    mov     rcx, 1\n    pop     rbx')
+        self.assertEqual(code, [['mov', 'rcx,', '1'], ['mov', 'rbx,', 'rax']])
+        code, _ = self.optimize('    push    rax\n    mov     rax, 1\n    pop     rbx')
+        self.assertEqual(code, [['push', 'rax'], ['mov', 'rax,', '1'], ['pop', 'rbx']])
+        code, _ = self.optimize('    push    rax\nlabel:\n    pop     rbx')
+        self.assertEqual(code, [['push', 'rax'], ['label:'], ['pop', 'rbx']])
+
+    def test_dead_mov(self):
+        """Test a mov overwritten right away is removed."""
+        code, removed = self.optimize('    mov     rbx, 0\n    mov     rbx, [rax]')
+        self.assertEqual(code, [['mov', 'rbx,', '[rax]']])
+        self.assertEqual(removed['dead-mov'], 1)
+        code, _ = self.optimize('    mov     rbx, 0\n    mov     bl, [rax]')
+        self.assertEqual(code, [['mov', 'rbx,', '0'], ['mov', 'bl,', '[rax]']])
+
+    def test_jump_to_next(self):
+        """Test jumps to the next label are removed."""
+        code, removed = self.optimize('    jmp     end1\nend2:\n    ;; comment\nend1:')
+        self.assertEqual(code, [['end2:'], [], ['end1:']])
+        self.assertEqual(removed['jump-to-next'], 1)
+
+    def test_optimized_programs(self):
+        """Test the structures still work once optimized."""
+        for tests_file in TESTS_FILES:
+            with open(tests_file, 'r') as f:
+                tests = yaml.safe_load(f.read())
+
+            for test_name, test in tests.items():
+                code = 'import "std"\n' + test['code']
+                output = run_code(code, '-O')
+                self.assertEqual(output, test['expected'], f'Failed test {test_name}')
+
+
+class TestRegisterStack(unittest.TestCase):
+    """Test case for keeping the top of the stack in registers."""
+
+    def test_programs(self):
+        """Test the structures still work with the top of the stack in registers."""
+        for tests_file in TESTS_FILES:
+            with open(tests_file, 'r') as f:
+                tests = yaml.safe_load(f.read())
+
+            for test_name, test in tests.items():
+                code = 'import "std"\n' + test['code']
+                output = run_code(code, '--cache-registers')
+                self.assertEqual(output, test['expected'], f'Failed test {test_name}')
+
+
+class TestSeparateCompilation(unittest.TestCase):
+    """Test case for assembling every imported file on its own."""
+
+    def test_programs(self):
+        """Test the structures still work with the imported files linked in."""
+        for tests_file in TESTS_FILES:
+            with open(tests_file, 'r') as f:
+                tests = yaml.safe_load(f.read())
+
+            for test_name, test in tests.items():
+                code = 'import "std"\n' + test['code']
+                output = run_code(code, '--separate')
+                self.assertEqual(output, test['expected'], f'Failed test {test_name}')
+
+    def test_objects_are_reused(self):
+        """Test the same assembly is only assembled once."""
+        assembly = f'global answer\nsegment .text\nanswer:  ;; {os.getpid()}\n    ret\n'
+        object_file, assembled = object_cache.assemble(TMP_FILENAME, assembly)
+        self.assertTrue(assembled)
+        self.assertEqual(object_cache.assemble(TMP_FILENAME, assembly), (object_file, False))
+        self.assertTrue(object_cache.assemble(TMP_FILENAME, assembly + '\n')[1])
+        for path in object_file.parent.glob(f'{TMP_FILENAME}.*.o'):
+            path.unlink()
+
+
+class TestAssembler(unittest.TestCase):
+    """Test case for the built-in assembler."""
+
+    def encode(self, instruction: str) -> str:
+        mnemonic, _, operands = instruction.partition(' ')
+        state = assembler._Assembler()
+        operands = [state.operand(operand.strip()) for operand in operands.split(',') if operand]
+        return assembler._encode_instruction(mnemonic, operands, 0).hex()
+
+    def test_encodings(self):
+        """Test instructions are encoded the way nasm does."""
+        self.assertEqual(self.encode('push r15'), '4157')
+        self.assertEqual(self.encode('push -5'), '6afb')
+        self.assertEqual(self.encode('mov rax, [r13]'), '498b4500')
+        self.assertEqual(self.encode('mov [rsp], rax'), '48890424')
+        self.assertEqual(self.encode('mov dil, al'), '4088c7')
+        self.assertEqual(self.encode('lea rax, [r13+r12*8+300]'), '4b8d84e52c010000')
+        self.assertEqual(self.encode('movzx rax, BYTE [rsp+31]'), '480fb644241f')
+        self.assertEqual(self.encode('mov QWORD [rbp -16], -1'), '48c745f0ffffffff')
+        self.assertEqual(self.encode('sub rsp, 4096'), '4881ec00100000')
+        self.assertEqual(self.encode('cmovge r14, r9'), '4d0f4df1')
+        self.assertEqual(self.encode('setl sil'), '400f9cc6')
+        self.assertEqual(self.encode('mov r9, -3689348814741910323'), '49b9cdcccccccccccccc')
+        self.assertEqual(self.encode('cmp ecx, 3000000000'), '81f9005ed0b2')
+        self.assertEqual(self.encode('rep movsb'), 'f3a4')
+        self.assertEqual(self.encode('repne scasb'), 'f2ae')
+        self.assertEqual(self.encode('movdqu xmm9, [rdi+16]'), 'f3440f6f4f10')
+        self.assertEqual(self.encode('pcmpeqb xmm10, xmm3'), '66440f74d3')
+        self.assertEqual(self.encode('pmovmskb r9d, xmm12'), '66450fd7cc')
+        self.assertEqual(self.encode('movq xmm8, r10'), '664d0f6ec2')
+        self.assertEqual(self.encode('shr edx, cl'), 'd3ea')
+
+    def test_unsupported(self):
+        """Test operand sizes and immediates that can't be encoded are rejected, not changed."""
+        for instruction in ['cmp BYTE [rdi], 0', 'cmp al, bl', 'add eax, rbx', 'test WORD [rdi], 1',
+                            'add [rdi], 1', 'movzx rax, WORD [rdi]', 'push 3000000000', 'cmp rax, 3000000000',
+                            'mov QWORD [rdi], 2147483648', 'imul rax, 2147483648']:
+            with self.assertRaisesRegex(RuntimeError, 'Unsupported instruction', msg=instruction):
+                self.encode(instruction)
+
+    def test_programs(self):
+        """Test programs behave the same built with the built-in assembler and with nasm."""
+        for tests_file in TESTS_FILES:
+            with open(tests_file, 'r') as f:
+                tests = yaml.safe_load(f.read())
+
+            for test_name, test in tests.items():
+                code = 'import "std"\n' + test['code']
+                for flags in [[], ['--cache-registers']]:
+                    self.assertEqual(run_code(code, *flags), run_code(code, '--nasm', *flags),
+                                     f'Failed test {test_name} with {flags}')
+
+
+class TestManyPrograms(unittest.TestCase):
+    """Test case for compiling many programs in one invocation."""
+
+    def test_failures_are_reported_per_file(self):
+        """Test a program that doesn't compile doesn't stop the others."""
+        sources = {
+            'tmp_test_code_a.tmp': 'import "std"\nprocedure main -- in 1 peek end\n',
+            'tmp_test_code_b.tmp': 'import "std"\nprocedure main -- in drop end\n',
+            'tmp_test_code_c.tmp': 'import "std"\nprocedure main -- in 3 peek end\n',
+        }
+        for source, code in sources.items():
+            Path(source).write_text(code)
+        try:
+            completed_process = subprocess.run(['./pyre.py', *sources, '-j', '2'], capture_output=True, text=True)
+            self.assertEqual(completed_process.returncode, 1)
+            self.assertIn('tmp_test_code_b.tmp: Not enough values on the stack', completed_process.stderr)
+            self.assertEqual(subprocess.run(['./tmp_test_code_a'], capture_output=True).stdout, b'1')
+            self.assertEqual(subprocess.run(['./tmp_test_code_c'], capture_output=True).stdout, b'3')
+        finally:
+            for source in sources:
+                Path(source).unlink()
+                Path(source).with_suffix('').unlink(missing_ok=True)
+
+
+class TestWatch(unittest.TestCase):
+    """Test case for rebuilding programs as they change."""
+
+    def test_rebuilds_changed_programs(self):
+        """Test a program is only rebuilt when it or its imports change."""
+        def build(program):
+            global_state.reset()
+            tokenize_file(program)
+            return None, '', None
+
+        Path(TMP_FILENAME).write_text('import "std"\nprocedure main -- in 1 peek end\n')
+        try:
+            watcher = watch.Watcher([TMP_FILENAME], build)
+            self.assertEqual(watcher.changed(), [TMP_FILENAME])
+            watcher.rebuild(TMP_FILENAME)
+            self.assertIn('std.pyre', watcher.built_from[TMP_FILENAME])
+            self.assertEqual(watcher.changed(), [])
+            watcher.built_from[TMP_FILENAME]['std.pyre'] -= 1  # As if std changed after the build
+            self.assertEqual(watcher.changed(), [TMP_FILENAME])
+        finally:
+            Path(TMP_FILENAME).unlink()
+
+
+class TestTimings(unittest.TestCase):
+    """Test case for the report of --timings."""
+
+    def test_json(self):
+        """Test the json report has every phase and counter."""
+        Path(TMP_FILENAME).write_text('macro one 1 end\nmacro two one one + end\nprocedure main -- in two drop end\n')
+        try:
+            completed_process = subprocess.run(['./pyre.py', TMP_FILENAME, '--timings', '--timings-format', 'json'],
+                                               capture_output=True, text=True)
+            report = json.loads(completed_process.stdout.splitlines()[-1])
+        finally:
+            for path in [TMP_FILENAME, Path(TMP_FILENAME).with_suffix('')]:
+                Path(path).unlink(missing_ok=True)
+
+        self.assertEqual(report['program'], TMP_FILENAME)
+        self.assertEqual(list(report['phases'])[:3], ['tokenize', 'load_macros', 'expand_macros'])
+        self.assertIn('assemble', report['phases'])
+        self.assertAlmostEqual(report['total'], sum(report['phases'].values()))
+        self.assertGreater(report['tokens_after_expansion'], 0)
+        self.assertEqual(report['macro_expansions'], 3)  # two and the ones in it
+        self.assertGreater(report['assembly_lines'], 0)
+        self.assertGreater(report['assembly_bytes'], report['assembly_lines'])
+        self.assertGreater(report['peak_rss'], 0)
+
+
+class TestInstrumentation(unittest.TestCase):
+    """Test case for --instrument."""
+
+    def test_report(self):
+        """Test calls and loop iterations are counted without changing what the program prints."""
+        code = ('import "std"\n'
+                'procedure twice x -- y in x 2 * !y end\n'
+                'procedure main -- in\n'
+                '    0 where i in while i 3 < do i twice peek i 1 + !i end end drop\n'
+                'end\n')
+        Path(TMP_FILENAME).write_text(code)
+        try:
+            subprocess.run(['./pyre.py', TMP_FILENAME, '--instrument-loops', '--inline-threshold', '0'],
+                           stdout=subprocess.DEVNULL)
+            completed_process = subprocess.run(['./tmp_test_code'], capture_output=True, text=True)
+        finally:
+            for path in [TMP_FILENAME, Path(TMP_FILENAME).with_suffix('')]:
+                Path(path).unlink(missing_ok=True)
+
+        self.assertEqual(completed_process.stdout, '024')
+        report = [line.split('\t') for line in completed_process.stderr.splitlines()]
+        self.assertEqual(report[0], ['procedure', 'calls', 'inclusive cycles', 'exclusive cycles'])
+        calls = {line[0]: int(line[1]) for line in report[1:] if len(line) == 4}
+        self.assertEqual((calls['twice'], calls['main']), (3, 1))
+        self.assertEqual(report[-1], [f'{TMP_FILENAME}:4:18', '3'])
+
+
+class TestBufferedOutput(unittest.TestCase):
+    """Test case for the buffer of what programs write to stdout."""
+
+    def test_output(self):
+        """Test output bigger than the buffer is all written and in order with other syscalls."""
+        code = ('import "std"\n'
+                'procedure main -- in\n'
+                '    0 where i in while i 100000 < do \'*\' putchar i 1 + !i end end drop\n'
+                '    "!" 2 SYSCALL_WRITE syscall3 drop\n'
+                '    1 peek\n'
+                'end\n')
+        Path(TMP_FILENAME).write_text(code)
+        try:
+            for flags in [[], ['--cache-registers']]:
+                subprocess.run(['./pyre.py', TMP_FILENAME, *flags], stdout=subprocess.DEVNULL)
+                completed_process = subprocess.run(['./tmp_test_code'], stdout=subprocess.PIPE,
+                                                   stderr=subprocess.STDOUT, text=True)
+                self.assertEqual(completed_process.stdout, '*' * 100000 + '!\0' + '1', f'Failed with {flags}')
+        finally:
+            for path in [TMP_FILENAME, Path(TMP_FILENAME).with_suffix('')]:
+                Path(path).unlink(missing_ok=True)
+
+
+class TestDynamicMemory(unittest.TestCase):
+    """Test case for alloc, free and realloc."""
+
+    def test_blocks(self):
+        """Test small blocks are reused and big ones keep their bytes as they grow."""
+        code = ('import "std"\n'
+                'procedure main -- in\n'
+                '    24 alloc where a in\n'
+                '        a free 24 alloc a = peek drop\n'
+                '        7 a 23 + store1 a 100000 realloc !a\n'
+                '        8 a 99999 + store1 a 5000000 realloc !a\n'
+                '        a 23 + load1 peek drop a 99999 + load1 peek drop a free\n'
+                '    end\n'
+                '    0 where i in while i 10000 < do i 37 % alloc drop i 1 + !i end end drop\n'
+                'end\n')
+        for flags in [[], ['--memory', '0'], ['--huge-pages', '--cache-registers']]:
+            self.assertEqual(run_code(code, *flags), '178', f'Failed with {flags}')
+
+    def test_no_static_memory(self):
+        """Test programs using memory don't compile without it."""
+        Path(TMP_FILENAME).write_text('procedure main -- in 1 memory store1 end\n')
+        try:
+            completed_process = subprocess.run(['./pyre.py', TMP_FILENAME, '--memory', '0'],
+                                               capture_output=True, text=True)
+        finally:
+            Path(TMP_FILENAME).unlink()
+        self.assertEqual(completed_process.returncode, 1)
+        self.assertIn('There is no static memory with --memory 0', completed_process.stderr)
+
+
+class TestStrings(unittest.TestCase):
+    """Test case for strlen, memchr and strcmp."""
+
+    def test_end_of_page(self):
+        """Test strings right before an unmapped page are read without going past them."""
+        code = ('import "std"\n'
+                'procedure main -- in\n'
+                '    8184 alloc 8 - where page in\n'
+                '        4096 page 4096 + 11 syscall2 drop  # Unmap the second page\n'
+                '        page 4090 + "hello" swap drop 6 memcpy\n'
+                '        page 4090 + strlen peek endl drop\n'
+                '        page 4095 + strlen peek endl drop\n'
+                '        page 4090 + dup \'o\' 5 memchr swap - peek endl drop\n'
+                '        page 4090 + \'z\' 6 memchr peek endl drop\n'
+                '        page 4090 + "hello" swap drop strcmp peek endl drop\n'
+                '        "hellp" swap drop page 4090 + strcmp peek endl drop\n'
+                '    end\n'
+                'end\n')
+        for flags in [[], ['--cache-registers'], ['--nasm']]:
+            self.assertEqual(run_code(code, *flags), '5\n0\n4\n0\n0\n1\n', f'Failed with {flags}')
+
+
+def reset_procedures():
+    """Forget the procedures defined by the programs compiled in this process."""
+    global_state.procedures.clear()
+    global_state.procedure_to_variables.clear()
+
+
+class TestCallGraph(unittest.TestCase):
+    """Test case for leaving out the procedures nobody calls."""
+
+    def setUp(self):
+        reset_procedures()
+
+    def test_remove_dead_procedures(self):
+        """Test only the procedures reachable from main are kept."""
+        code = ('procedure unused -- in "never printed" end\n'
+                'procedure inner -- in end\n'
+                'procedure outer -- in inner end\n'
+                'procedure main -- in outer end\n')
+        with open(TMP_FILENAME, 'w') as f:
+            f.write(code)
+        program = create_references(tokenize_file(TMP_FILENAME))
+        os.remove(TMP_FILENAME)
+
+        self.assertEqual(call_graph.reachable_procedures(call_graph.call_graph(program)),
+                         {'main', 'outer', 'inner'})
+        kept = call_graph.remove_dead_procedures(program)
+        self.assertEqual([token.value for token in kept if token.operator.name == 'PROCEDURE'],
+                         ['inner', 'outer', 'main'])
+        self.assertFalse(any(token.operator.name == 'PUSH_STRING' for token in kept))
+
+    def test_unterminated_procedure(self):
+        """Test a procedure without its end is reported where it starts."""
+        message = f'The procedure second has no matching in or end at {TMP_FILENAME}:2:1'
+        Path(TMP_FILENAME).write_text('procedure first -- in 1 drop end\nprocedure second -- in 1 drop\n')
+        try:
+            with self.assertRaisesRegex(RuntimeError, message):
+                create_references(tokenize_file(TMP_FILENAME))
+            completed_process = subprocess.run(['./pyre.py', TMP_FILENAME], capture_output=True, text=True)
+        finally:
+            Path(TMP_FILENAME).unlink()
+        self.assertEqual(completed_process.stderr, f'{TMP_FILENAME}: {message}\n')
+
+
+class TestStackAnalysis(unittest.TestCase):
+    """Test case for the depth of the stack known at compile time."""
+
+    def depths(self, code: str) -> list:
+        reset_procedures()
+        program = analyze_stack(create_references(tokenize(code)))
+        return [(token.value, token.depth) for token in program]
+
+    def test_blocks(self):
+        """Test the depths of the branches meet after them."""
+        depths = self.depths('procedure main -- in 1 if 1 do 2 elif 3 do 4 else 5 end drop end')
+        self.assertEqual(depths, [('main', 0), (1, 0), ('if', 1), (1, 1), ('do', 2), (2, 1), ('elif', 1),
+                                  (3, 1), ('do', 2), (4, 1), ('else', 1), (5, 1), ('end', 2), ('drop', 2),
+                                  ('end', 1)])
+        depths = self.depths('procedure main -- in if 1 do 2 else end end')
+        self.assertEqual(depths[-2:], [('end', None), ('end', None)])
+
+    def test_loops(self):
+        """Test only the depths in and after loops that change the stack are unknown."""
+        depths = self.depths('procedure main -- in 0 while 1 do 2 drop end while 1 do while 1 do 1 end end end')
+        self.assertEqual(depths[:8], [('main', 0), (0, 0), ('while', 1), (1, 1), ('do', 2), (2, 1),
+                                      ('drop', 2), ('end', 1)])
+        self.assertTrue(all(depth is None for _, depth in depths[8:]))
+
+    def test_procedures(self):
+        """Test calls use the signature of the procedure and bodies can take their inputs."""
+        depths = self.depths('procedure f a b -- c in drop drop end procedure main -- in 1 2 f 3 end')
+        self.assertEqual(depths, [('f', 0), ('drop', 0), ('drop', -1), ('end', -2), ('main', 0), (1, 0),
+                                  (2, 1), ('procedure_f', 2), (3, 1), ('end', 2)])
+        with self.assertRaises(RuntimeError):
+            self.depths('procedure g a -- in drop drop end')
+        with self.assertRaises(RuntimeError):
+            self.depths('procedure main -- in 1 + end')
+
 
 if __name__ == '__main__':
     unittest.main(failfast=True)
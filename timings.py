@@ -0,0 +1,67 @@
+"""
+Time spent in every phase of compiling a program, for --timings.
+
+Along with the phases some counters are kept: the tokens before and after
+expanding the macros, the macro expansions, the size of the assembly and the
+peak resident memory of the compiler and of the tools it ran.
+
+The peak memory is the most the process used since it started, not what this
+program took. With -j or --watch a process compiles many programs, the peak of
+each one is the highest of all the programs that process compiled up to it.
+"""
+from contextlib import contextmanager
+import json
+import resource
+import time
+
+
+class Timings:
+    """Phases and counters of the compilation of a program."""
+
+    def __init__(self, program: str):
+        self.program = program
+        self.phases = {}    # Phase -> seconds, in the order they first ran
+        self.counters = {}  # Name -> value
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time what runs inside, phases that run more than once add up."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def count(self, name: str, value: int):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self) -> dict:
+        # ru_maxrss is in KiB on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        tools_peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        return {
+            'program': self.program,
+            'phases': self.phases,
+            'total': sum(self.phases.values()),
+            **self.counters,
+            'peak_rss': peak_rss,
+            'tools_peak_rss': tools_peak_rss,
+        }
+
+    def report(self, format: str = 'text') -> str:
+        """The timings as a table, or as one line of json with format='json'."""
+        data = self.as_dict()
+        if format == 'json':
+            return json.dumps(data)
+
+        lines = [f'timings for {self.program}:']
+        lines.extend(f'    {phase:<24}{seconds * 1000:9.1f} ms' for phase, seconds in data['phases'].items())
+        lines.append(f'    {"total":<24}{data["total"] * 1000:9.1f} ms')
+        lines.append(f'    {"tokens":<24}{data.get("tokens_before_expansion", 0):9} before expanding macros, '
+                     f'{data.get("tokens_after_expansion", 0)} after')
+        lines.append(f'    {"macro expansions":<24}{data.get("macro_expansions", 0):9}')
+        lines.append(f'    {"assembly":<24}{data.get("assembly_lines", 0):9} lines, '
+                     f'{data.get("assembly_bytes", 0)} bytes')
+        lines.append(f'    {"peak RSS":<24}{data["peak_rss"] / 2 ** 20:9.1f} MiB, '
+                     f'{data["tools_peak_rss"] / 2 ** 20:.1f} MiB for nasm and ld, of the process so far')
+        return '\n'.join(lines)
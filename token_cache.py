@@ -0,0 +1,163 @@
+"""
+On-disk cache of the tokens of imported libraries.
+
+Each entry holds the tokens of one file, the places where that file imports
+other files and the procedures it defines. Entries live in a .pyre_cache
+directory next to the file they belong to.
+
+Lexing depends on the procedures and macros known at the point of the import,
+so entries are also keyed by those. An entry is thrown away when the file, any
+file it imported or the compiler itself changed.
+
+Entries also stay in memory once loaded, a process compiling many programs
+reads each of them once and only checks it's still valid afterwards.
+"""
+from hashlib import sha256
+from pathlib import Path
+import os
+import pickle
+import global_state
+from definitions import Token, Operator
+
+
+CACHE_DIRECTORY = '.pyre_cache'
+CACHE_FORMAT = 2
+
+_compiler_version = None
+_entries = {}  # Path -> entry this process already loaded, for compiling many programs
+
+
+def compiler_version() -> str:
+    """Hash of the compiler sources, any change to them invalidates the cache."""
+    global _compiler_version
+    if _compiler_version is None:
+        digest = sha256()
+        for source in sorted(Path(__file__).resolve().parent.glob('*.py')):
+            digest.update(source.read_bytes())
+        _compiler_version = digest.hexdigest()
+    return _compiler_version
+
+
+def content_hash(filename: str) -> str:
+    with open(filename, 'rb') as f:
+        return sha256(f.read()).hexdigest()
+
+
+def entry_path(filename: str) -> Path:
+    """Where the entry for importing filename in the current state lives."""
+    environment = repr((sorted(global_state.procedures),
+                        sorted(global_state.macros),
+                        global_state.imports))
+    environment_hash = sha256(environment.encode()).hexdigest()[:16]
+    path = Path(filename)
+    return path.parent / CACHE_DIRECTORY / f'{path.name}.{environment_hash}.pickle'
+
+
+def _serialize_token(token: Token) -> tuple:
+    # Operators are stored by name, blocks aren't linked yet when tokenizing
+    return token.operator.name, token.value, token.length, token.label, token.position
+
+
+def _deserialize_token(operator_name: str, *state) -> Token:
+    return Token(Operator[operator_name], *state)
+
+
+def store(path: Path, filename: str, tokens: list, imports: list, dependencies: list):
+    """
+    Save the tokens of filename in the entry at path.
+
+    imports has a (start, end, imported file) item for every import directive,
+    tokens[start:end] being what it brought in.
+    dependencies are all the files imported while tokenizing filename.
+    """
+    items = []
+    procedures = []
+    position = 0
+    for start, end, imported_file in imports + [(len(tokens), len(tokens), None)]:
+        for token in tokens[position:start]:
+            if token.operator is Operator.PROCEDURE:
+                procedures.append(token.value)
+            items.append(_serialize_token(token))
+        if imported_file is not None:
+            items.append(imported_file)
+        position = end
+
+    entry = {
+        'format': CACHE_FORMAT,
+        'compiler': compiler_version(),
+        'content': content_hash(filename),
+        'dependencies': {dependency: content_hash(dependency) for dependency in dependencies},
+        'items': items,
+        'procedure_to_variables': {name: global_state.procedure_to_variables[name] for name in procedures},
+        'inline_procedures': [name for name in procedures if name in global_state.inline_procedures],
+    }
+
+    _entries[path] = entry
+    temporary_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        path.parent.mkdir(exist_ok=True)
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)  # Never leave a half written entry behind
+    except OSError:
+        pass  # The cache is an optimization, not being able to write it is fine
+    finally:
+        temporary_path.unlink(missing_ok=True)
+
+
+def load(path: Path, filename: str):
+    """
+    Get the cache entry at path for filename or None if there's no valid one.
+
+    Use replay to get the tokens out of it.
+    """
+    entry = _entries.get(path)
+    if entry is None:
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+
+    try:
+        valid = (entry['format'] == CACHE_FORMAT
+                 and entry['compiler'] == compiler_version()
+                 and entry['content'] == content_hash(filename)
+                 and all(content_hash(dependency) == digest
+                         for dependency, digest in entry['dependencies'].items()))
+    except (OSError, KeyError, TypeError):
+        return None
+
+    if not valid:
+        _entries.pop(path, None)
+        return None
+    _entries[path] = entry
+    return entry
+
+
+def replay(entry: dict):
+    """
+    Yield the tokens in a cache entry and the names of the files it imports.
+
+    The tokens get the same side effects tokenizing them had, new string labels
+    included.
+    """
+    for item in entry['items']:
+        if isinstance(item, str):
+            yield item
+            continue
+
+        token = _deserialize_token(*item)
+        if token.operator is Operator.PROCEDURE:
+            if token.value in global_state.procedures:
+                raise RuntimeError(f'The procedure {token.value} was previously defined')
+            global_state.procedures.add(token.value)
+            global_state.procedure_to_variables[token.value] = entry['procedure_to_variables'][token.value]
+            if token.value in entry['inline_procedures']:
+                global_state.inline_procedures.add(token.value)
+        elif token.operator is Operator.MACRO:
+            global_state.macros[token.value] = list()
+        elif token.operator is Operator.PUSH_STRING:
+            token.label = f'string_literal{global_state.string_literals}'
+            global_state.string_literals += 1
+        yield token
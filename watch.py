@@ -0,0 +1,82 @@
+"""
+Watch mode, rebuilding programs as their sources change.
+
+The compiler stays loaded between builds and the token cache keeps the tokens
+of the imported files in memory, so a rebuild only tokenizes the files that
+changed. Files are polled, a program is rebuilt when its source or any file it
+imported was modified since it was last built.
+"""
+from pathlib import Path
+import os
+import re
+import subprocess
+import time
+import global_state
+
+
+POLL_INTERVAL = 0.2  # Seconds between checks for changes
+
+_MAIN = re.compile(r'^\s*procedure\s+main\b', re.MULTILINE)
+
+
+def _modification_time(filename: str):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None  # Deleting a file is a change too
+
+
+class Watcher:
+    """Programs being watched and the files each of them was built from."""
+
+    def __init__(self, paths: list, build):
+        self.paths = paths
+        self.build = build  # Main file -> executable, what was printed and the error or None
+        self.built_from = {}  # Program -> {file: modification time}
+
+    def programs(self) -> list:
+        """The files given and the files with a main procedure in the directories given."""
+        programs = []
+        for path in map(Path, self.paths):
+            if path.is_dir():
+                programs.extend(source.as_posix() for source in sorted(path.glob('*.pyre'))
+                                if _MAIN.search(source.read_text()))
+            else:
+                programs.append(path.as_posix())
+        return programs
+
+    def changed(self) -> list:
+        """Programs that were never built or whose files changed since."""
+        return [program for program in self.programs()
+                if program not in self.built_from
+                or any(_modification_time(file) != built for file, built in self.built_from[program].items())]
+
+    def rebuild(self, program: str) -> tuple:
+        """Build a program, returns what build does and the seconds it took."""
+        before = _modification_time(program)  # Changes while building trigger another build
+        start = time.perf_counter()
+        executable, output, error = self.build(program)
+        elapsed = time.perf_counter() - start
+        self.built_from[program] = {program: before,
+                                    **{file: _modification_time(file) for file in global_state.imports}}
+        return executable, output, error, elapsed
+
+
+def watch(paths: list, build, run: bool = False, interval: float = POLL_INTERVAL):
+    """Rebuild the programs in paths whenever they change until interrupted, maybe running them."""
+    watcher = Watcher(paths, build)
+    print(f'watching {", ".join(paths)}, Ctrl-C to stop', flush=True)
+    try:
+        while True:
+            for program in watcher.changed():
+                executable, output, error, elapsed = watcher.rebuild(program)
+                print(output, end='')
+                if error is None:
+                    print(f'{program}: built in {elapsed * 1000:.0f} ms', flush=True)
+                    if run:
+                        subprocess.run([executable])
+                else:
+                    print(f'{program}: {error}', flush=True)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass